@@ -4,38 +4,33 @@ from engine import *
 
 # Imports fra Pyhton standard
 from pathlib import Path
-import zipfile
 
 # Definer reader, worker og output
 reader = Input_Reader
 worker = Worker
 output = Output_Writer
 
-# Download zip fil fra URL
-zip_file_url = 'URL TIL ZIP FIL MED GEOJSON FILER'
-local_file_path = Path('c:/temp/geojson_data.zip')
-extract_path = Path('c:/temp/geojson_data')
+# Indlæser én geojson fil i databasen. Funktionen køres i flere processer af worker.File.batch,
+# og skal derfor ligge øverst i scriptet
+def indlaes_geojson(geojson_filepath):
+    tablename = Path(geojson_filepath).stem
+    geojson_file = reader.geojson(geojson_filepath)
+    output.postgis(geojson_file, 'MyPostGIS', 'div_test', 'geojson_zip', tablename, True, method='copy')
 
-# Download fil
-download_successful = worker.download_file(zip_file_url, local_file_path)
+# Resten af scriptet køres kun i hovedprocessen
+if __name__ == '__main__':
+    # Download zip fil fra URL
+    zip_file_url = 'URL TIL ZIP FIL MED GEOJSON FILER'
+    local_file_path = Path('c:/temp/geojson_data.zip')
 
-# Unzip fil
-try:
-    with zipfile.ZipFile(local_file_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_path)
-    print(f'Extraction completed. Files are extracted to: {extract_path}')
-except zipfile.BadZipFile:
-    print(f'Error: {local_file_path} is not at zip file or it is corrupted')
+    # Download fil
+    download_successful = worker.File.download_file(zip_file_url, local_file_path)
 
-# Bearbejd data i Q-ETL og gem i database
-# Find alle geojson filer fra zip fil
-geoJson_filer = [file for file in Path(extract_path).rglob('*.geojson')]
+    # Find alle geojson filer i zip filen. Filerne læses direkte fra zip filen, uden at pakke den ud
+    geoJson_filer = worker.File.archive_lister(local_file_path.as_posix(), '.geojson')
 
-# Klargøring af database
-worker.Vector.execute_sql('MyPostGIS', 'Postgres', 'CREATE SCHEMA IF NOT EXISTS geojson_zip', 'gis')
+    # Klargøring af database
+    worker.Vector.execute_sql('MyPostGIS', 'Postgres', 'CREATE SCHEMA IF NOT EXISTS geojson_zip', 'gis')
 
-# Henter og gemmer data i database et datasæt ad gangen
-for geojson_filepath in geoJson_filer:
-    tablename = Path(geojson_filepath).stem
-    geojson_file = reader.geojson(geojson_filepath.as_posix())
-    output.postgis(geojson_file, 'MyPostGIS', 'div_test', 'geojson_zip', tablename, True)
\ No newline at end of file
+    # Henter og gemmer data i database, fire filer ad gangen
+    worker.File.batch(geoJson_filer, indlaes_geojson, workers=4, stop_on_error=False)
@@ -1,44 +1,40 @@
 import sys, os
 from qgis.core import QgsApplication, Qgis
 from core.logger import *
-from core.misc import get_config, createJobRun, get_version, install_dependencies
+from core.misc import get_config, createJobRun, get_version, install_dependencies, is_worker_process, is_daemon_process, start_job
 from core.db import *
 import atexit
 import tracemalloc
 import random
+import time
 
 
-tracemalloc.start()
 now = datetime.now()
+## Startup timings, logged when the engine is ready
+startup = {}
+startup_timer = time.time()
 
 #settings = _local_configuration.loadConfig()
 settings = get_config()
-logger = initialize_logger(settings)
 version = get_version()
-start_logfile(now)
-
-## installing dependencies
-install_dependencies()
-
-#Creating job run 
-jobrun = random.getrandbits(36)
-createJobRun(jobrun)
-
-#Internal DB startup
-initdb()
-
-##Write job to db
-startjob(jobrun, argv[0], now, get_logfile())
+startup['settings'] = time.time() - startup_timer
+
+if is_worker_process():
+    ## Worker processes started by a parallel worker only load QGIS, the parent job owns the job bookkeeping
+    logger = initialize_worker_logger(os.environ.get('QETL_LOGFILE'))
+elif is_daemon_process():
+    ## The engine daemon only loads QGIS, and starts the bookkeeping for each job it runs
+    logger = initialize_daemon_logger(settings)
+else:
+    logger = start_job(settings, now)
+startup['job'] = time.time() - startup_timer - sum(startup.values())
 
 from core.misc import validateEnvironment, describeEngine, get_postgres_connections, get_bin_folder, script_finished
-settings['bin_path'] = get_bin_folder(settings)
-validateEnvironment(settings)
-
-settings['Postgres_Ponnections'] = get_postgres_connections(settings)
 
 QgsApplication.setPrefixPath(settings["Qgs_PrefixPath"], True)
 qgs = QgsApplication([], False)
 qgs.initQgis()
+startup['qgis'] = time.time() - startup_timer - sum(startup.values())
 
 ## Loading the Processing plugin...
 try:
@@ -50,6 +46,7 @@ try:
     Processing.initialize()
     QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
     from processing.script import ScriptUtils
+    startup['processing'] = time.time() - startup_timer - sum(startup.values())
     logger.info('QGIS ressources loaded sucesfully')
 
 except Exception as e :
@@ -58,9 +55,10 @@ except Exception as e :
     logger.critical('Program terminated')
     sys.exit()
 
-describeEngine(ScriptUtils.scriptsFolders(), QgsApplication.processingRegistry().providerById("script").algorithms(), Qgis.QGIS_VERSION, version)
-
-
+if not is_worker_process() and not is_daemon_process():
+    describeEngine(ScriptUtils.scriptsFolders(), QgsApplication.processingRegistry().providerById("script").algorithms(), Qgis.QGIS_VERSION, version)
+    startup['describe'] = time.time() - startup_timer - sum(startup.values())
 
+    atexit.register(script_finished)
 
-atexit.register(script_finished)
+logger.info('Startup: ' + ', '.join(f'{step} {round(seconds, 2)} s' for step, seconds in startup.items()) + f', total {round(time.time() - startup_timer, 2)} s')
@@ -15,6 +15,7 @@ def initdb():
             pass
         else:
             populatedb(conn)
+        migratedb(conn)
     except:
         logger.info(f'Unable to use internal DB')
     
@@ -31,19 +32,49 @@ def populatedb(conn):
                 logfile TEXT 
             );"""
         
+        sql_initsteps = """
+            CREATE TABLE IF NOT EXISTS steps (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                step TEXT NOT NULL,
+                algorithms TEXT,
+                input_features INTEGER,
+                output_features INTEGER,
+                wall_time REAL,
+                cpu_time REAL,
+                rss_delta REAL,
+                peak_memory REAL,
+                start_time TEXT
+            );"""
+        
         cursor = conn.cursor()
         cursor.execute(sql_inittable) 
+        cursor.execute(sql_initsteps) 
+        cursor.execute("CREATE INDEX IF NOT EXISTS steps_run_id ON steps (run_id)")
         conn.commit()
     except:
         pass
     
+def migratedb(conn):
+    ## Adding the columns introduced after the steps table was created
+    try:
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA table_info(steps)")
+        columns = [row[1] for row in cursor.fetchall()]
+        if 'peak_memory' not in columns:
+            cursor.execute("ALTER TABLE steps ADD COLUMN peak_memory REAL")
+            conn.commit()
+    except:
+        pass
+
 def is_db_populated (conn):
     try:
-        sql_check = """SELECT count(*) FROM sqlite_master WHERE type='table' AND name='jobs';""" 
+        sql_check = """SELECT count(*) FROM sqlite_master WHERE type='table' AND name IN ('jobs', 'steps');""" 
         cursor = conn.cursor()
         cursor.execute(sql_check) 
         rows = cursor.fetchall()  
-        if rows[0][0] == 1:
+        if rows[0][0] == 2:
             return True
         else:
             return False
@@ -76,4 +107,80 @@ def update_job(jobrun, status, time):
     except:
         pass
 
-    
\ No newline at end of file
+    
+
+def record_step(jobrun, position, step, algorithms, input_features, output_features, wall_time, cpu_time, rss_delta, peak_memory, time):
+    try:
+        db_dir = os.getcwd() + '/db'
+        db_file = db_dir + '/internal.db'
+        conn = sqlite3.connect(db_file) 
+        cursor = conn.cursor()
+        sql_insert = """INSERT INTO steps (run_id, position, step, algorithms, input_features, output_features, wall_time, cpu_time, rss_delta, peak_memory, start_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+        cursor.execute(sql_insert, (jobrun, position, step, algorithms, input_features, output_features, wall_time, cpu_time, rss_delta, peak_memory, str(time)))
+        conn.commit()
+        conn.close()
+    except:
+        pass
+
+def query_steps(sql, parameters=()):
+    db_file = os.getcwd() + '/db/internal.db'
+    conn = sqlite3.connect(db_file)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute(sql, parameters)
+    rows = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    return rows
+
+def slowest_steps(jobname=None, limit=10):
+    """
+    Returns the slowest recorded steps, optionally for one script only.
+
+    Args:
+        jobname (string): The path of the script, as recorded in the jobs table. Defaults to None, for all scripts.
+        limit (integer): Number of steps to return. Defaults to 10.
+
+    Returns:
+        steps (list of dictionaries): The steps, with the jobname and start time of their job, slowest first
+    """
+
+    sql = """SELECT jobs.jobname, jobs.start_time AS job_start, steps.*
+             FROM steps JOIN jobs ON jobs.run_id = steps.run_id"""
+    parameters = []
+    if jobname is not None:
+        sql += " WHERE jobs.jobname = ?"
+        parameters.append(jobname)
+    sql += " ORDER BY steps.wall_time DESC LIMIT ?"
+    parameters.append(limit)
+    return query_steps(sql, parameters)
+
+def step_regressions(jobname, runs=5, threshold=1.5):
+    """
+    Compares the steps of the latest finished run of a script with the average of the runs before it.
+    Steps are matched on their position in the job and their name.
+
+    Args:
+        jobname (string): The path of the script, as recorded in the jobs table
+        runs (integer): Number of earlier runs to compare with. Defaults to 5.
+        threshold (float): Report steps slower than threshold times the earlier average. Defaults to 1.5.
+
+    Returns:
+        regressions (list of dictionaries): position, step, wall_time, baseline and ratio of each slower step, worst first
+    """
+
+    jobs = query_steps("""SELECT run_id FROM jobs WHERE jobname = ? AND status = 'Finished' ORDER BY id DESC LIMIT ?""", (jobname, runs + 1))
+    if len(jobs) < 2:
+        return []
+    latest = jobs[0]['run_id']
+    earlier = [job['run_id'] for job in jobs[1:]]
+    placeholders = ', '.join('?' * len(earlier))
+    sql = f"""SELECT latest.position, latest.step, latest.wall_time, avg(earlier.wall_time) AS baseline
+              FROM steps latest JOIN steps earlier ON earlier.position = latest.position AND earlier.step = latest.step
+              WHERE latest.run_id = ? AND earlier.run_id IN ({placeholders})
+              GROUP BY latest.position, latest.step, latest.wall_time"""
+    regressions = []
+    for row in query_steps(sql, [latest] + earlier):
+        if row['baseline'] and row['wall_time'] > row['baseline'] * threshold:
+            row['ratio'] = round(row['wall_time'] / row['baseline'], 2)
+            regressions.append(row)
+    return sorted(regressions, key=lambda row: row['ratio'], reverse=True)
@@ -13,6 +13,7 @@ def initialize_logger(settings):
     global logfile
     logfile = logdir + '/' +  filename + '_' + now.strftime("%d%m%Y_%H_%M") + '.txt'
     global logger
+    close_logger()
     logger = logging.getLogger('Q-ETL')
     logger.setLevel(logging.DEBUG)
     fh = logging.FileHandler(logfile)
@@ -30,6 +31,53 @@ def initialize_logger(settings):
     
     return logger
     
+def initialize_worker_logger(logfile_path):
+    ## Worker processes append to the logfile of the parent job
+    global logfile
+    logfile = logfile_path
+    global logger
+    logger = logging.getLogger('Q-ETL')
+    logger.setLevel(logging.DEBUG)
+    logFormatter = logging.Formatter(f'%(asctime)s - %(levelname)s : [worker {os.getpid()}] %(message)s ')
+    if logfile is not None:
+        fh = logging.FileHandler(logfile)
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(logFormatter)
+        logger.addHandler(fh)
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    consoleHandler.setLevel(logging.DEBUG)
+    logger.addHandler(consoleHandler)
+    sys.excepthook = exc_handler
+
+    return logger
+
+def initialize_daemon_logger(settings):
+    ## The engine daemon logs to its own logfile between jobs, each job gets its own logfile from initialize_logger
+    global logfile
+    logfile = None
+    global logger
+    close_logger()
+    logger = logging.getLogger('Q-ETL')
+    logger.setLevel(logging.DEBUG)
+    logFormatter = logging.Formatter(f'%(asctime)s - %(levelname)s : [daemon {os.getpid()}] %(message)s ')
+    fh = logging.FileHandler(settings['logdir'] + '/qetl_daemon.txt')
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(logFormatter)
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    consoleHandler.setLevel(logging.DEBUG)
+    logger.addHandler(consoleHandler)
+    logger.addHandler(fh)
+
+    return logger
+
+def close_logger():
+    ## Removes the handlers from the logger, closing the logfile
+    for handler in list(logging.getLogger('Q-ETL').handlers):
+        logging.getLogger('Q-ETL').removeHandler(handler)
+        handler.close()
+
 def exc_handler(exctype, value, tb):
     logger.exception(''.join(traceback.format_exception(exctype, value, tb)))
 
@@ -13,8 +13,127 @@ from email.mime.text import MIMEText
 from qgis.core import QgsVectorFileWriter, QgsProject
 from random import randrange
 import tracemalloc
+from core.profiler import Profiler
+import random
+import hashlib
+import copy
 
 
+def is_worker_process():
+    return 'QETL_WORKER' in os.environ
+
+def is_daemon_process():
+    return 'QETL_DAEMON' in os.environ
+
+## Set when the running job fails, read by the engine daemon to record the outcome of a job
+job_failed = False
+
+def start_job(settings, now):
+    """
+    Starts the bookkeeping of a job: logfile, job run, internal DB record and validation of the environment.
+    Called when core is imported by a script, and by the engine daemon for each job it runs.
+
+    Args:
+        settings (dictionary): The settings of the job
+        now (datetime): The start time of the job
+
+    Returns:
+        logger (Logger): The logger of the job
+    """
+
+    global job_failed
+    job_failed = False
+    fast = fast_start(settings)
+    Profiler.start(settings)
+    logger = initialize_logger(settings)
+    start_logfile(now)
+
+    environment = read_environment_cache(settings) if fast else None
+
+    ## installing dependencies
+    if environment is None:
+        install_dependencies()
+
+    #Creating job run 
+    jobrun = random.getrandbits(36)
+    createJobRun(jobrun)
+
+    #Internal DB startup
+    initdb()
+
+    ##Write job to db
+    startjob(jobrun, argv[0], now, get_logfile())
+
+    if environment is None:
+        settings['bin_path'] = get_bin_folder(settings)
+        validateEnvironment(settings)
+
+        settings['Postgres_Ponnections'] = get_postgres_connections(settings)
+        if fast:
+            write_environment_cache(settings)
+    else:
+        settings.update(environment['settings'])
+        logger.info(f'Fast start: using the environment validated {environment["validated"]}')
+    return logger
+
+def fast_start(settings: dict = None):
+    if settings is None:
+        settings = get_config()
+    return bool(settings.get('FastStart', False))
+
+def environment_cache_file():
+    return os.getcwd() + '/db/environment.json'
+
+def environment_key(settings):
+    ## The cached environment is valid for the same settings file, QGIS ini file, QGIS version, Q-ETL version and python
+    from qgis.core import Qgis
+    key = [get_settings_file(), Qgis.QGIS_VERSION, str(get_version()), sys.executable]
+    for file in (get_settings_file(), settings.get('QGIS_ini_Path', '')):
+        try:
+            stat = os.stat(file)
+            key.append(f'{stat.st_mtime_ns}:{stat.st_size}')
+        except OSError:
+            key.append('missing')
+    return hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest()
+
+def read_environment_cache(settings):
+    """
+    Reads the validated environment cached by fast start.
+
+    Returns:
+        environment (dictionary): The cached environment, or None if there is no valid cache
+    """
+
+    try:
+        with open(environment_cache_file(), 'r') as file:
+            environment = json.load(file)
+        if environment['key'] != environment_key(settings):
+            return None
+        return environment
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_environment_cache(settings):
+    environment = {
+        'key': environment_key(settings),
+        'validated': datetime.now().strftime("%d/%m/%Y, %H:%M"),
+        'settings': {key: settings[key] for key in ('bin_path', 'Postgres_Ponnections', 'logdir', 'TempFolder')},
+        'engine': engine_info()
+    }
+    try:
+        os.makedirs(os.path.dirname(environment_cache_file()), exist_ok=True)
+        with open(environment_cache_file(), 'w') as file:
+            json.dump(environment, file)
+    except OSError:
+        get_logger().info('Fast start: unable to write the environment cache')
+
+def get_core_count():
+    try:
+        import psutil
+        return psutil.cpu_count()
+    except ImportError:
+        return os.cpu_count()
+
 def install_dependencies():
     logfile = get_logfile()
     try:
@@ -191,14 +310,8 @@ def validateEnvironment(settings):
     logger.info('')  
     logger.info('Environement and settings OK !')     
 
-def describeEngine(scriptfolder, algorithms, version, qetl_version):
-    logger = get_logger()
-    qgis_supported = get_qgis_support()
-
-    try:
-        supported = qgis_supported[version]
-    except:
-        supported = 'Not tested'
+def engine_info():
+    ## Describes the machine running the engine. The hostname lookup can be slow, so fast start caches the result
     try:
         import psutil
     except ImportError:
@@ -214,11 +327,23 @@ def describeEngine(scriptfolder, algorithms, version, qetl_version):
     info['ip-address']=socket.gethostbyname(socket.gethostname())
     info['mac-address']=':'.join(re.findall('..', '%012x' % uuid.getnode()))
     info['processor']=platform.processor()
+    info['cores'] = get_core_count()
     try:
         info['ram']=str(round(psutil.virtual_memory().total / (1024.0 **3)))+" GB"
-        info['cores'] = psutil.cpu_count()
     except:
         info['ram'] ='Not available'
+    return info
+
+def describeEngine(scriptfolder, algorithms, version, qetl_version):
+    logger = get_logger()
+    qgis_supported = get_qgis_support()
+
+    try:
+        supported = qgis_supported[version]
+    except:
+        supported = 'Not tested'
+    environment = read_environment_cache(get_config()) if fast_start() else None
+    info = environment['engine'] if environment is not None else engine_info()
 
     logger.info("")
     logger.info("##################################################")
@@ -229,7 +354,7 @@ def describeEngine(scriptfolder, algorithms, version, qetl_version):
     logger.info("Processor: " + info['processor'] +  " ")
     logger.info("Number of cores : " + str(info['cores']) + " ")
     logger.info("Available memory: " + info['ram'] + " ")
-    logger.info("Memory-profiling : Active ")
+    logger.info("Memory-profiling : " + Profiler.level + " ")
     logger.info("")
     logger.info("Q-ETL version: " + str(qetl_version) + "                ")
     logger.info("QGIS version: " + str(version) + "                ")
@@ -245,19 +370,34 @@ def describeEngine(scriptfolder, algorithms, version, qetl_version):
     logger.info("----- Starting Script -----")
 
 
+def get_settings_file():
+    ## Worker processes are told where the settings of the parent job are
+    if 'QETL_SETTINGS_FILE' in os.environ:
+        return os.environ['QETL_SETTINGS_FILE']
+    return path.abspath(path.join(argv[0] ,"../..")) + '\\settings.json'
+
+## The parsed settings, reused until the settings file changes
+config_cache = {}
+
 def get_config():
-    settings_file =  path.abspath(path.join(argv[0] ,"../..")) + '\\settings.json'
+    settings_file = get_settings_file()
+    stat = os.stat(settings_file)
+    key = (settings_file, stat.st_mtime_ns, stat.st_size, argv[0])
 
-    with open(settings_file, 'r') as file:
-        settings = json.load(file)
+    if config_cache.get('key') != key:
+        with open(settings_file, 'r') as file:
+            settings = json.load(file)
 
-        ##Setting the plugin path based on Qgs_PrefixPath 
-        settings['QGIS_Plugin_Path'] = settings['Qgs_PrefixPath'] + '/python/plugins'
+            ##Setting the plugin path based on Qgs_PrefixPath 
+            settings['QGIS_Plugin_Path'] = settings['Qgs_PrefixPath'] + '/python/plugins'
 
-        if not os.path.exists(settings['logdir']):
-            settings['logdir'] = path.abspath(path.join(argv[0] ,"../..")) + '/logs'
+            if not os.path.exists(settings['logdir']):
+                settings['logdir'] = path.abspath(path.join(argv[0] ,"../..")) + '/logs'
+        config_cache['key'] = key
+        config_cache['settings'] = settings
 
-    return settings
+    ## Callers get their own copy, as some of them modify the settings
+    return copy.deepcopy(config_cache['settings'])
 
 def get_qgis_support():
     inputfile =  path.abspath(path.join(argv[0] ,"../..")) + '\\qgis_versions.json'
@@ -294,7 +434,6 @@ def get_bin_folder(settings):
 def script_finished():
     logger = get_logger()
     now = datetime.now()
-    current, peak = tracemalloc.get_traced_memory()
     jobrun = read_jobrun()
     update_job(jobrun['id'], 'Finished', now)
     logger.info('')
@@ -302,14 +441,20 @@ def script_finished():
     logger.info('##################################################')
     logger.info('JOB: ' + argv[0] + ' FINISHED')
     logger.info('ENDTIME: ' + now.strftime("%d/%m/%Y, %H:%M"))
-    logger.info(f'Peak memory usage: {round((peak / 10**7), 2)} GB')
+    Profiler.report()
     logger.info('##################################################')
 
-    tracemalloc.stop()
+    Profiler.stop()
 
 def script_failed():
+    global job_failed
     logger = get_logger()
     now = datetime.now()
+    if is_worker_process():
+        ## The parent job reports the failure. Batches run serially in the job process, where the job has not failed
+        logger.critical(f'Worker process {os.getpid()} failed')
+        sys.exit(1)
+    job_failed = True
     config = get_config()
     jobrun = read_jobrun()
     update_job(jobrun['id'], 'Failed', now)
@@ -357,7 +502,9 @@ def script_failed():
     logger.info('##################################################')
     logger.info('JOB: ' + argv[0] + ' FAILED')
     logger.info('ENDTIME: ' + now.strftime("%d/%m/%Y, %H:%M"))
+    Profiler.report()
     logger.info('##################################################')
+    Profiler.stop()
     sys.exit()
     
 
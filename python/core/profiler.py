@@ -0,0 +1,152 @@
+from core.logger import *
+import threading
+import tracemalloc
+import time
+
+## The profiling levels, from the lowest to the highest overhead
+LEVELS = ('off', 'rss', 'tracemalloc')
+
+
+class RssSampler(threading.Thread):
+    '''
+    A background thread sampling the resident memory (RSS) of the process, keeping the peak of the job and of the running step.
+    '''
+
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        import psutil
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = self.process.memory_info().rss
+        self.step_peak = self.peak
+        self.running = True
+
+    def run(self):
+        while self.running:
+            rss = self.process.memory_info().rss
+            self.peak = max(self.peak, rss)
+            self.step_peak = max(self.step_peak, rss)
+            time.sleep(self.interval)
+
+    def sample(self):
+        rss = self.process.memory_info().rss
+        self.peak = max(self.peak, rss)
+        self.step_peak = max(self.step_peak, rss)
+        return rss
+
+    def stop(self):
+        self.running = False
+
+
+class Profiler:
+    '''
+    Memory profiling of a job, at the level set in settings.json:
+
+    "Profiling" : {
+        "level" : "rss",     off, rss for sampling the memory of the process in a background thread, or tracemalloc for python allocations
+        "interval" : 0.1,    seconds between the samples of the rss level
+        "top" : 10           number of allocation sites reported by the tracemalloc level
+    }
+
+    The rss level sees all memory of the process, including the memory used by QGIS. The tracemalloc level only sees
+    memory allocated by python, but reports where it was allocated, and slows down every allocation.
+    '''
+
+    level = 'off'
+    top = 10
+    sampler = None
+    traced_peak = 0
+
+    def settings(config: dict):
+        profiling = {
+            'level': 'rss',
+            'interval': 0.1,
+            'top': 10
+        }
+        profiling.update(config.get('Profiling', {}))
+        profiling['level'] = str(profiling['level']).lower()
+        if profiling['level'] not in LEVELS:
+            profiling['level'] = 'off'
+        return profiling
+
+    def start(config: dict):
+        """
+        Starts profiling a job at the level in the settings.
+        """
+
+        Profiler.stop()
+        profiling = Profiler.settings(config)
+        Profiler.level = profiling['level']
+        Profiler.top = profiling['top']
+        Profiler.traced_peak = 0
+        if Profiler.level == 'rss':
+            try:
+                Profiler.sampler = RssSampler(profiling['interval'])
+                Profiler.sampler.start()
+            except ImportError:
+                Profiler.level = 'off'
+        elif Profiler.level == 'tracemalloc':
+            tracemalloc.start()
+
+    def stop():
+        Profiler.level = 'off'
+        if Profiler.sampler is not None:
+            Profiler.sampler.stop()
+            Profiler.sampler = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def step_start():
+        ## Resets the peak of the running step
+        if Profiler.level == 'rss' and Profiler.sampler is not None:
+            Profiler.sampler.step_peak = Profiler.sampler.sample()
+        elif Profiler.level == 'tracemalloc' and tracemalloc.is_tracing():
+            ## The peak of the job is kept, as tracemalloc only tracks one peak
+            Profiler.traced_peak = max(Profiler.traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+    def step_peak():
+        """
+        Returns the peak memory in MB since the running step started, or None when profiling is off.
+        """
+
+        if Profiler.level == 'rss' and Profiler.sampler is not None:
+            Profiler.sampler.sample()
+            return Profiler.sampler.step_peak / 1024**2
+        if Profiler.level == 'tracemalloc' and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            Profiler.traced_peak = max(Profiler.traced_peak, peak)
+            return peak / 1024**2
+        return None
+
+    def job_peak():
+        """
+        Returns the peak memory in bytes of the job, or None when profiling is off.
+        With tracemalloc, the peak is reset by each step, so the job peak is the highest peak seen.
+        """
+
+        if Profiler.level == 'rss' and Profiler.sampler is not None:
+            Profiler.sampler.sample()
+            return Profiler.sampler.peak
+        if Profiler.level == 'tracemalloc' and tracemalloc.is_tracing():
+            return max(tracemalloc.get_traced_memory()[1], Profiler.traced_peak)
+        return None
+
+    def report():
+        """
+        Logs the peak memory of the job, and the top allocation sites with tracemalloc.
+        """
+
+        logger = get_logger()
+        peak = Profiler.job_peak()
+        if peak is None:
+            logger.info('Peak memory usage: not measured, profiling is off')
+            return
+        if Profiler.level == 'rss':
+            logger.info(f'Peak memory usage (RSS): {round(peak / 1024**3, 2)} GB')
+            return
+        logger.info(f'Peak memory usage (python allocations): {round(peak / 1024**3, 2)} GB')
+        statistics = tracemalloc.take_snapshot().statistics('lineno')
+        logger.info(f'Top {Profiler.top} allocation sites still in use:')
+        for statistic in statistics[:Profiler.top]:
+            logger.info(f'    {round(statistic.size / 1024**2, 2)} MB in {statistic.count} blocks: {statistic.traceback}')
@@ -0,0 +1,168 @@
+## Q-ETL engine daemon.
+## Keeps QGIS and Processing loaded between jobs, and runs job scripts sent by submit.py over a local socket.
+##
+## Start the daemon with:   <PATH TO>\python-qgis.bat <FULL_PATH_TO>\python\daemon.py
+## Submit a job with:       <PATH TO>\python-qgis.bat <FULL_PATH_TO>\python\submit.py <FULL_PATH_TO_PYTHON_SCRIPT>
+##
+## The daemon is a supervisor process, starting an engine process that loads QGIS once and runs the jobs one at a time.
+## The engine process is recycled after max_jobs jobs, or when its memory passes max_rss_mb.
+
+import sys, os, json, time
+import subprocess
+
+## Exit code of an engine process that should be replaced by a fresh one
+RECYCLE = 75
+
+
+def daemon_settings(settings):
+    daemon = {
+        'host': '127.0.0.1',
+        'port': 7575,
+        'max_jobs': 50,
+        'max_rss_mb': 4096
+    }
+    daemon.update(settings.get('Daemon', {}))
+    return daemon
+
+def supervise():
+    ## Starts engine processes until one is stopped, replacing recycled and crashed engines
+    environment = dict(os.environ)
+    environment['QETL_DAEMON'] = '1'
+    while True:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--engine'], env=environment)
+        try:
+            code = process.wait()
+        except KeyboardInterrupt:
+            process.terminate()
+            process.wait()
+            return
+        if code == 0:
+            print('Q-ETL engine stopped')
+            return
+        if code != RECYCLE:
+            print(f'Q-ETL engine exited with code {code}, restarting in 5 seconds')
+            time.sleep(5)
+
+def engine_classes():
+    ## The engine classes holding state at class level, e.g. Worker.lazy_pipeline and the Ledger counters
+    return [Worker, Worker.Vector, Worker.File, Input_Reader, Output_Writer, Constructor, Integrations, Ledger]
+
+def save_class_state():
+    """
+    Saves the class attributes of the engine, so a job changing them does not change how the following jobs run.
+    """
+
+    import copy
+    return {cls: {name: copy.copy(value) if isinstance(value, (list, dict, set)) else value
+                  for name, value in vars(cls).items() if not name.startswith('__')}
+            for cls in engine_classes()}
+
+def restore_class_state(state):
+    for cls, saved in state.items():
+        for name in [name for name in vars(cls) if not name.startswith('__') and name not in saved]:
+            delattr(cls, name)
+        for name, value in saved.items():
+            setattr(cls, name, value)
+
+def run_job(request):
+    """
+    Runs a job script in a fresh namespace, with its own logfile, job run and internal DB record.
+
+    Returns:
+        status (string): 'Finished' or 'Failed'
+    """
+
+    import core.misc
+    script = request['script']
+    original = list(sys.argv)
+    os.chdir(request['cwd'])
+    ## argv is imported by name in the core modules, so the list is updated in place
+    sys.argv[:] = [script] + request.get('args', [])
+    sys.path.insert(0, os.path.dirname(script))
+
+    namespace = {'__name__': '__main__', '__file__': script, '__builtins__': __builtins__}
+    state = save_class_state()
+    try:
+        start_job(get_config(), datetime.now())
+        describeEngine(ScriptUtils.scriptsFolders(), QgsApplication.processingRegistry().providerById("script").algorithms(), Qgis.QGIS_VERSION, get_version())
+        with open(script, 'r', encoding='utf-8') as file:
+            code = compile(file.read(), script, 'exec')
+        exec(code, namespace)
+        script_finished()
+    except SystemExit:
+        if not core.misc.job_failed:
+            script_finished()
+    except Exception as error:
+        logger.exception(f'{type(error).__name__}  –  {str(error)}')
+        try:
+            script_failed()
+        except SystemExit:
+            pass
+    finally:
+        namespace.clear()
+        restore_class_state(state)
+        sys.argv[:] = original
+        if os.path.dirname(script) in sys.path:
+            sys.path.remove(os.path.dirname(script))
+        ConnectionPool.close_all()
+        cleanup_intermediates()
+        QgsProject.instance().clear()
+    return 'Failed' if core.misc.job_failed else 'Finished'
+
+def serve():
+    ## Accepts jobs on the local socket until the engine should be recycled or is stopped
+    import socket
+    import psutil
+    import gc
+    daemon = daemon_settings(get_config())
+    process = psutil.Process()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((daemon['host'], daemon['port']))
+    server.listen(16)
+    logger.info(f'Q-ETL engine ready on {daemon["host"]}:{daemon["port"]}')
+
+    jobs = 0
+    while True:
+        connection, address = server.accept()
+        with connection:
+            request = json.loads(connection.makefile('r', encoding='utf-8').readline())
+            if request.get('command') == 'stop':
+                connection.sendall((json.dumps({'status': 'Stopped'}) + '\n').encode('utf-8'))
+                logger.info('Q-ETL engine stopped')
+                server.close()
+                return 0
+
+            logger.info(f'Running job {request["script"]}')
+            start = time.time()
+            status = run_job(request)
+            jobs += 1
+            logfile = get_logfile()
+            initialize_daemon_logger(get_config())
+            gc.collect()
+            rss = process.memory_info().rss / 1024**2
+            logger.info(f'Job {request["script"]} {status.lower()} in {round(time.time() - start, 2)} s, engine has run {jobs} jobs and uses {round(rss)} MB')
+            response = {'status': status, 'logfile': logfile, 'seconds': round(time.time() - start, 2)}
+            try:
+                connection.sendall((json.dumps(response) + '\n').encode('utf-8'))
+            except OSError:
+                logger.info('The client disconnected before the job finished')
+
+        if jobs >= daemon['max_jobs'] or rss > daemon['max_rss_mb']:
+            logger.info(f'Recycling the engine after {jobs} jobs using {round(rss)} MB')
+            server.close()
+            return RECYCLE
+
+
+if __name__ == '__main__':
+    if '--engine' in sys.argv:
+        os.environ['QETL_DAEMON'] = '1'
+        from core import *
+        from engine import *
+        from engine.databases import ConnectionPool
+        from engine.storage import cleanup_intermediates
+        from core.misc import start_job, script_failed
+        from qgis.core import QgsProject
+        sys.exit(serve())
+    else:
+        supervise()
@@ -1,5 +1,19 @@
+import time
+engine_timer = time.time()
+
+from engine.pipeline import *
+from engine.parallel import *
 from engine.inputs import *
 from engine.outputs import *
 from engine.workers import *
 from engine.constructors import *
-from engine.integrations import *
\ No newline at end of file
+from engine.integrations import *
+from engine.ledger import Ledger
+
+## Recording the calls of the workers, readers and writers in the steps table of the internal DB
+Ledger.instrument(Worker.Vector, 'Worker.Vector')
+Ledger.instrument(Worker.File, 'Worker.File')
+Ledger.instrument(Input_Reader, 'Input_Reader')
+Ledger.instrument(Output_Writer, 'Output_Writer')
+
+logger.info(f'Engine modules loaded in {round(time.time() - engine_timer, 2)} s')
@@ -0,0 +1,77 @@
+from core.logger import *
+import os
+import fnmatch
+import zipfile
+import tarfile
+
+## File extensions of the vector formats that are listed in archives. .json and .csv files are often metadata or tables
+## without geometries, and are only listed when asked for with file_extension
+VECTOR_EXTENSIONS = ('.shp', '.geojson', '.gpkg', '.fgb', '.gml', '.kml', '.tab', '.mif', '.sqlite', '.gdb')
+
+## GDAL virtual file system prefix for each archive type
+PREFIXES = {
+    '.zip': '/vsizip/',
+    '.tar': '/vsitar/',
+    '.tar.gz': '/vsitar/',
+    '.tgz': '/vsitar/'
+}
+
+
+class Archive:
+    '''
+    Helpers for reading the members of zip and tar archives in place, with the GDAL virtual file systems /vsizip/ and /vsitar/.
+    '''
+
+    def prefix(archive: str):
+        for extension, prefix in PREFIXES.items():
+            if archive.lower().endswith(extension):
+                return prefix
+        raise ValueError(f'{archive} is not a zip, tar, tar.gz or tgz archive')
+
+    def names(archive: str):
+        """
+        Lists the files in an archive without unpacking it.
+        """
+
+        if Archive.prefix(archive) == '/vsizip/':
+            with zipfile.ZipFile(archive) as file:
+                return [info.filename for info in file.infolist() if not info.is_dir()]
+        with tarfile.open(archive) as file:
+            return [member.name for member in file.getmembers() if member.isfile()]
+
+    def vector_members(archive: str, file_extension: str = None):
+        """
+        Lists the vector datasets in an archive. A File Geodatabase is listed once, as its .gdb folder.
+
+        Args:
+            archive (string): The path to the archive
+            file_extension (string): Only list datasets with this extension, e.g. '.geojson'
+
+        Returns:
+            members (list of strings): The paths of the datasets inside the archive
+        """
+
+        extensions = (file_extension.lower(),) if file_extension else VECTOR_EXTENSIONS
+        members = []
+        for name in Archive.names(archive):
+            parts = name.replace('\\', '/').split('/')
+            gdb = [index for index, part in enumerate(parts[:-1]) if part.lower().endswith('.gdb')]
+            if gdb:
+                name = '/'.join(parts[:gdb[0] + 1])
+            if name.lower().endswith(extensions) and name not in members:
+                members.append(name)
+        return members
+
+    def vsi_path(archive: str, member: str):
+        ## The path GDAL reads a member of an archive from
+        return f'{Archive.prefix(archive)}{os.path.abspath(archive).replace(os.sep, "/")}/{member}'
+
+    def match(archive: str, member: str):
+        """
+        Finds the vector datasets in an archive matching a name or a pattern, e.g. 'data/*.geojson'.
+        """
+
+        extension = os.path.splitext(member)[1].lower()
+        ## A member named with another extension, e.g. .json or .csv, is looked for among the files with that extension
+        members = Archive.vector_members(archive, extension if extension and extension not in VECTOR_EXTENSIONS else None)
+        return [name for name in members if name == member or fnmatch.fnmatch(name, member) or fnmatch.fnmatch(os.path.basename(name), member)]
@@ -0,0 +1,159 @@
+from core.logger import *
+from core.misc import get_settings_file, get_core_count, script_failed, is_daemon_process
+import os
+import time
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+## Environment variables telling the spawned processes to start as workers of this job
+WORKER_ENVIRONMENT = ('QETL_WORKER', 'QETL_SETTINGS_FILE', 'QETL_LOGFILE')
+
+## Return values of a pipeline that are kept in the summary, anything else is not sent back from the worker
+SIMPLE_TYPES = (type(None), bool, int, float, str)
+
+
+def run_file(pipeline, file: str):
+    """
+    Runs the pipeline on one file, catching any failure, including the exit of script_failed in a worker process.
+
+    Returns:
+        result (dictionary): The file, status, seconds, error and the return value of the pipeline if it is a simple value
+    """
+
+    start = time.time()
+    try:
+        value = pipeline(file)
+        return {'file': file, 'status': 'Finished', 'seconds': time.time() - start, 'error': None,
+                'result': value if isinstance(value, SIMPLE_TYPES) else None}
+    except BaseException as error:
+        return {'file': file, 'status': 'Failed', 'seconds': time.time() - start, 'error': f'{type(error).__name__}  –  {str(error)}', 'result': None}
+
+
+@contextmanager
+def worker_environment():
+    ## Runs the pipelines as workers of this job, so a failing file ends in an exception instead of failing the job.
+    ## Spawned processes read the environment when they start, and it is restored afterwards
+    saved = {name: os.environ.get(name) for name in WORKER_ENVIRONMENT}
+    os.environ['QETL_WORKER'] = '1'
+    os.environ['QETL_SETTINGS_FILE'] = get_settings_file()
+    if get_logfile() is not None:
+        os.environ['QETL_LOGFILE'] = get_logfile()
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+class Batch:
+    '''
+    Runs a pipeline function on a list of files, e.g. from Worker.File.lister, in a bounded pool of worker processes.
+    Each process loads its own QGIS instance and runs the pipeline on one file at a time.
+
+    The processes are started with the spawn method, which imports the job script again in each process, so the job script must:
+        - define the pipeline function at the top level of the script, taking the path of a file as its only argument
+        - keep everything else below the line if __name__ == '__main__':, or it will run again in every process
+    '''
+
+    def run(files: list, pipeline, workers: int = None, stop_on_error: bool = False):
+        """
+        Runs the pipeline on the files and logs a summary with the time and status of each file.
+
+        Args:
+            files (list of strings): The files to process
+            pipeline (function): A function at the top level of the job script, called with the path of one file
+            workers (integer): Number of processes. Defaults to the number of cores. With 1, the files are processed in this process
+            stop_on_error (boolean): Defaults to False. Stop at the first failing file and fail the job, or continue with the other files
+
+        Returns:
+            results (list of dictionaries): The file, status, seconds, error and simple return value of each file
+        """
+
+        files = [str(file) for file in files]
+        if not files:
+            logger.info('No files to process')
+            return []
+        if not workers:
+            workers = get_core_count()
+        workers = max(1, min(workers, len(files)))
+        if workers > 1 and is_daemon_process():
+            ## Jobs in the daemon are not a __main__ module, which the spawned processes need to find the pipeline
+            logger.info('Jobs run by the daemon process their files in the engine process')
+            workers = 1
+
+        start = time.time()
+        logger.info(f'Processing {len(files)} files with {pipeline.__name__} in {workers} {"processes" if workers > 1 else "process"}')
+        if workers == 1:
+            results = Batch.run_serial(files, pipeline, stop_on_error)
+        else:
+            results = Batch.run_pool(files, pipeline, workers, stop_on_error)
+
+        failed = Batch.summary(results, files, time.time() - start)
+        if failed and stop_on_error:
+            logger.critical("Program terminated")
+            script_failed()
+        return results
+
+    def run_serial(files: list, pipeline, stop_on_error: bool):
+        results = []
+        with worker_environment():
+            for file in files:
+                result = run_file(pipeline, file)
+                Batch.report(result, len(results) + 1, len(files))
+                results.append(result)
+                if result['status'] == 'Failed' and stop_on_error:
+                    break
+        return results
+
+    def run_pool(files: list, pipeline, workers: int, stop_on_error: bool):
+        results = []
+        with worker_environment():
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(run_file, pipeline, file) for file in files]
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+                    try:
+                        result = future.result()
+                    except BaseException as error:
+                        ## The process died, e.g. a crash in QGIS, and the pool can not be used any more
+                        result = {'file': files[futures.index(future)], 'status': 'Failed', 'seconds': None, 'error': f'{type(error).__name__}  –  {str(error)}', 'result': None}
+                    Batch.report(result, len(results) + 1, len(files))
+                    results.append(result)
+                    if result['status'] == 'Failed' and stop_on_error:
+                        logger.info('Stopping at the first error, cancelling the remaining files')
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        break
+        return results
+
+    def report(result: dict, done: int, total: int):
+        if result['status'] == 'Failed':
+            logger.error(f'{os.path.basename(result["file"])} failed ({done}/{total}): {result["error"]}')
+        else:
+            logger.info(f'{os.path.basename(result["file"])} finished in {round(result["seconds"], 2)} s ({done}/{total})')
+
+    def summary(results: list, files: list, seconds: float):
+        """
+        Logs the time and status of each file, and the files that were not processed.
+
+        Returns:
+            failed (integer): The number of failed files
+        """
+
+        failed = [result for result in results if result['status'] == 'Failed']
+        processed = set(result['file'] for result in results)
+        skipped = [file for file in files if file not in processed]
+        logger.info('')
+        logger.info('##################################################')
+        logger.info(f'Batch summary: {len(results) - len(failed)} finished, {len(failed)} failed, {len(skipped)} not processed, in {round(seconds, 2)} s')
+        for result in sorted(results, key=lambda result: result['file']):
+            duration = f'{round(result["seconds"], 2)} s' if result['seconds'] is not None else '-'
+            logger.info(f'    {result["status"]:<8} {duration:>10}  {result["file"]}' + (f'  {result["error"]}' if result['error'] else ''))
+        for file in skipped:
+            logger.info(f'    {"Skipped":<8} {"-":>10}  {file}')
+        logger.info('##################################################')
+        return len(failed)
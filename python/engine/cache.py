@@ -0,0 +1,212 @@
+from core.logger import *
+from core.misc import get_config, get_version
+import os
+import re
+import time
+import shutil
+import hashlib
+from qgis.core import Qgis, QgsVectorLayer, QgsVectorFileWriter, QgsProject, QgsWkbTypes, QgsCoordinateReferenceSystem
+from engine.storage import tempfile_path, open_intermediate
+
+## Expression functions returning a new value on each evaluation, making the result of an algorithm unrepeatable
+VOLATILE = re.compile(r'(\b(rand|randf|now|uuid|random)\s*\()|(\$now\b)', re.IGNORECASE)
+
+## Sidecar files of a data source, checked together with the file itself
+SIDECARS = ('.dbf', '.shx', '.prj', '.cpg')
+
+## Custom property holding the cache key of a layer read from or written to the cache
+KEY_PROPERTY = 'qetl_cache_key'
+
+## Part of every key, so results cached before a QGIS or Q-ETL upgrade are not served after it
+VERSIONS = f'qgis:{Qgis.QGIS_VERSION}|qetl:{get_version()}'
+
+
+class ResultCache:
+    '''
+    An opt-in, content-addressed cache of algorithm results, used by run_algorithm.
+    The key is a hash of the QGIS and Q-ETL versions, the algorithm, its parameters and a fingerprint of each input layer. File based inputs are
+    fingerprinted by path, size and modification time, all other layers by their content. A hit returns a copy of the
+    stored FlatGeobuf, and processing.run is skipped. The cache is bounded in size, evicting the least recently used results.
+
+    "ResultCache" : {
+        "enabled" : false,
+        "folder" : "",      the cache folder, defaults to qetl_cache in the TempFolder
+        "max_mb" : 5120     the cache size, older results are evicted above this size in MB
+    }
+    '''
+
+    def settings():
+        config = get_config()
+        cache = {
+            'enabled': False,
+            'folder': '',
+            'max_mb': 5120
+        }
+        cache.update(config.get('ResultCache', {}))
+        if not cache['folder']:
+            cache['folder'] = os.path.join(config['TempFolder'], 'qetl_cache')
+        return cache
+
+    def enabled():
+        return bool(ResultCache.settings()['enabled'])
+
+    def cacheable(algorithm: str, parameter: dict):
+        ## Random algorithms and volatile expressions give a new result on every run
+        if 'random' in algorithm.lower():
+            return False
+        for value in parameter.values():
+            for item in (value if isinstance(value, (list, tuple)) else [value]):
+                if isinstance(item, str) and VOLATILE.search(item):
+                    return False
+        return True
+
+    def key(algorithm: str, parameter: dict):
+        """
+        Computes the cache key of an algorithm run.
+
+        Args:
+            algorithm (string): The id of the processing algorithm
+            parameter (dictionary): The parameters, with lazy layers resolved
+
+        Returns:
+            key (string): The hex digest of the key, or None if the run can not be cached
+        """
+
+        if not ResultCache.cacheable(algorithm, parameter):
+            return None
+        digest = hashlib.sha256(VERSIONS.encode('utf-8'))
+        digest.update(f'|{algorithm}'.encode('utf-8'))
+        for name in sorted(parameter):
+            if name == 'OUTPUT':
+                continue
+            value = parameter[name]
+            values = value if isinstance(value, (list, tuple)) else [value]
+            digest.update(f'|{name}='.encode('utf-8'))
+            for item in values:
+                digest.update(ResultCache.fingerprint(item).encode('utf-8'))
+                digest.update(b';')
+        return digest.hexdigest()
+
+    def fingerprint(value):
+        ## A string identifying a parameter value, reading the content only for layers without a stable source
+        if isinstance(value, QgsVectorLayer):
+            key = value.customProperty(KEY_PROPERTY)
+            if key:
+                return f'cached:{key}:{value.featureCount()}'
+            source = ResultCache.source_file(value)
+            if source is not None:
+                return f'file:{ResultCache.file_fingerprint(source)}|{value.source()}|{value.subsetString()}'
+            return f'content:{ResultCache.content_hash(value)}'
+        if isinstance(value, QgsCoordinateReferenceSystem):
+            return f'crs:{value.authid() or value.toWkt()}'
+        if isinstance(value, str) and os.path.isfile(value.split('|')[0]):
+            return f'file:{ResultCache.file_fingerprint(value.split("|")[0])}|{value}'
+        return f'{type(value).__name__}:{value}'
+
+    def source_file(layer: QgsVectorLayer):
+        ## The file behind a file based layer, except intermediate files, which get a new name in every run
+        if layer.providerType() != 'ogr':
+            return None
+        path = layer.source().split('|')[0]
+        if not os.path.isfile(path):
+            return None
+        if os.path.basename(path).startswith('QETL_') and os.path.abspath(os.path.dirname(path)) == os.path.abspath(get_config()['TempFolder']):
+            return None
+        return path
+
+    def file_fingerprint(path: str):
+        stem = os.path.splitext(path)[0]
+        parts = []
+        for file in [path] + [stem + extension for extension in SIDECARS]:
+            if os.path.isfile(file):
+                stat = os.stat(file)
+                parts.append(f'{os.path.abspath(file)}:{stat.st_size}:{stat.st_mtime_ns}')
+        return ','.join(parts)
+
+    def content_hash(layer: QgsVectorLayer):
+        ## Hashes the crs, fields, geometries and attributes of a layer
+        digest = hashlib.sha256()
+        digest.update(layer.crs().authid().encode('utf-8'))
+        digest.update(str(layer.wkbType()).encode('utf-8'))
+        for field in layer.fields():
+            digest.update(f'{field.name()}:{field.typeName()}:{field.length()}:{field.precision()};'.encode('utf-8'))
+        for feature in layer.getFeatures():
+            if feature.hasGeometry():
+                digest.update(bytes(feature.geometry().asWkb()))
+            digest.update(repr(feature.attributes()).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(key: str):
+        return os.path.join(ResultCache.settings()['folder'], f'{key}.fgb')
+
+    def get(key: str, algorithm: str, output: str):
+        """
+        Returns the cached result of a key as an intermediate layer, or None on a miss.
+        The cached file is copied, so the cache is never modified by the job.
+        """
+
+        path = ResultCache.path(key)
+        if not os.path.isfile(path):
+            logger.info(f'Result cache miss for {algorithm} ({key[:12]})')
+            return None
+        try:
+            os.utime(path)
+            copy = tempfile_path(output, 'flatgeobuf')
+            shutil.copyfile(path, copy)
+        except OSError as error:
+            logger.info(f'Result cache could not read {path}: {type(error).__name__}  –  {str(error)}')
+            return None
+        layer = open_intermediate(copy, output)
+        layer.setCustomProperty(KEY_PROPERTY, key)
+        logger.info(f'Result cache hit for {algorithm} ({key[:12]}), {layer.featureCount()} features')
+        return layer
+
+    def put(key: str, layer):
+        """
+        Stores the result of an algorithm run in the cache, and evicts old results above the size limit.
+        """
+
+        if not isinstance(layer, QgsVectorLayer) or not layer.isValid() or layer.wkbType() == QgsWkbTypes.NoGeometry:
+            return
+        cache = ResultCache.settings()
+        path = ResultCache.path(key)
+        partial = path + '.partial'
+        start = time.time()
+        try:
+            os.makedirs(cache['folder'], exist_ok=True)
+            if layer.providerType() == 'ogr' and layer.source().split('|')[0].lower().endswith('.fgb'):
+                shutil.copyfile(layer.source().split('|')[0], partial)
+            else:
+                options = QgsVectorFileWriter.SaveVectorOptions()
+                options.driverName = 'FlatGeobuf'
+                error = QgsVectorFileWriter.writeAsVectorFormatV3(layer, partial, QgsProject.instance().transformContext(), options)
+                if error[0] != QgsVectorFileWriter.NoError:
+                    raise IOError(error[1])
+            os.replace(partial, path)
+        except (OSError, IOError) as error:
+            logger.info(f'Result cache could not store {key[:12]}: {type(error).__name__}  –  {str(error)}')
+            if os.path.exists(partial):
+                os.remove(partial)
+            return
+        layer.setCustomProperty(KEY_PROPERTY, key)
+        logger.info(f'Result cache stored {key[:12]} in {round(time.time() - start, 2)} s')
+        ResultCache.evict(cache['folder'], cache['max_mb'])
+
+    def evict(folder: str, max_mb: float):
+        ## Deletes the least recently used results until the cache is below max_mb
+        files = []
+        for name in os.listdir(folder):
+            if name.endswith('.fgb'):
+                stat = os.stat(os.path.join(folder, name))
+                files.append((stat.st_mtime, stat.st_size, os.path.join(folder, name)))
+        total = sum(file[1] for file in files)
+        limit = max_mb * 1024**2
+        for mtime, size, path in sorted(files):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f'Result cache evicted {os.path.basename(path)} ({round(size / 1024**2, 2)} MB)')
+            except OSError:
+                pass
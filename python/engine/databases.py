@@ -0,0 +1,654 @@
+from core.logger import *
+from core.misc import get_config
+import struct
+import hashlib
+import time
+import atexit
+from qgis.core import QgsGeometry, QgsWkbTypes, QgsFeatureRequest, QgsExpression
+from qgis.PyQt.QtCore import QVariant, QDate, QDateTime, QTime
+
+## PostgreSQL column types for QGIS field types, following the types ogr2ogr creates
+POSTGRES_TYPES = {
+    QVariant.Bool: 'boolean',
+    QVariant.Int: 'integer',
+    QVariant.UInt: 'bigint',
+    QVariant.LongLong: 'bigint',
+    QVariant.ULongLong: 'numeric',
+    QVariant.Double: 'double precision',
+    QVariant.String: 'character varying',
+    QVariant.Date: 'date',
+    QVariant.Time: 'time',
+    QVariant.DateTime: 'timestamp with time zone',
+    QVariant.ByteArray: 'bytea'
+}
+
+## SQL Server column types for QGIS field types, strings get their length or nvarchar(max)
+MSSQL_TYPES = {
+    QVariant.Bool: 'bit',
+    QVariant.Int: 'int',
+    QVariant.UInt: 'bigint',
+    QVariant.LongLong: 'bigint',
+    QVariant.ULongLong: 'numeric(20)',
+    QVariant.Double: 'float',
+    QVariant.Date: 'date',
+    QVariant.Time: 'time',
+    QVariant.DateTime: 'datetime2',
+    QVariant.ByteArray: 'varbinary(max)'
+}
+
+## Characters escaped in the text format of COPY
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def launder(name: str):
+    ## Laundering field names the way ogr2ogr does by default
+    return name.lower().replace('-', '_').replace('#', '_').replace(' ', '_').replace("'", '')
+
+def ewkb(wkb: bytes, srid: int):
+    """
+    Converts ISO WKB, as returned by QgsGeometry.asWkb(), to EWKB with an embedded SRID.
+    Only the header of the outer geometry is rewritten, PostGIS reads the ISO type codes of nested geometries.
+
+    Args:
+        wkb (bytes): The ISO WKB geometry
+        srid (integer): The SRID to embed
+
+    Returns:
+        ewkb (bytes): The EWKB geometry
+    """
+
+    byteorder = '<' if wkb[0] == 1 else '>'
+    code = struct.unpack(byteorder + 'I', wkb[1:5])[0]
+    flags = 0x20000000
+    if code & 0x80000000:
+        ## QGIS 2.5D types already use the EWKB Z flag
+        flags |= 0x80000000
+        base = code & 0xffff
+    else:
+        base = code % 1000
+        dimensions = code // 1000
+        if dimensions in (1, 3):
+            flags |= 0x80000000
+        if dimensions in (2, 3):
+            flags |= 0x40000000
+    return wkb[:1] + struct.pack(byteorder + 'II', base | flags, srid) + wkb[5:]
+
+
+class Postgres:
+    '''
+    Helpers for loading layers into PostgreSQL / PostGIS without leaving the process.
+    '''
+
+    def connect(connection: str, dbname: str):
+        """
+        Opens a psycopg2 connection from a connection in settings.json.
+
+        Args:
+            connection (string): The name of the connection in the settings file
+            dbname (string): The database name
+
+        Returns:
+            connection (psycopg2 connection): The open connection
+        """
+
+        import psycopg2
+        config = get_config()
+        dbConnection = config['DatabaseConnections'][connection]
+        return psycopg2.connect(user=dbConnection['user'], password=dbConnection['password'], host=dbConnection['host'], port=dbConnection['port'], database=dbname)
+
+    def quote(identifier: str):
+        return '"' + identifier.replace('"', '""') + '"'
+
+    def table_exists(cursor, schema: str, table: str):
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (f'{Postgres.quote(schema)}.{Postgres.quote(table)}',))
+        return cursor.fetchone()[0]
+
+    def geometry_type(wkbType, srid: int):
+        if wkbType == QgsWkbTypes.NoGeometry:
+            return None
+        flat = QgsWkbTypes.flatType(wkbType)
+        name = 'Geometry' if flat == QgsWkbTypes.Unknown else QgsWkbTypes.displayString(flat)
+        if QgsWkbTypes.hasZ(wkbType):
+            name += 'Z'
+        if QgsWkbTypes.hasM(wkbType):
+            name += 'M'
+        return f'geometry({name}, {srid})'
+
+    def create_table(cursor, schema: str, table: str, fields, wkbType, srid: int, geometryname: str = 'wkb_geometry', fidname: str = 'ogc_fid'):
+        """
+        Creates a table for a layer, with an ogc_fid serial key and a typed geometry column, like ogr2ogr does.
+        """
+
+        columns = [f'{Postgres.quote(fidname)} serial PRIMARY KEY']
+        for field in fields:
+            columns.append(f'{Postgres.quote(launder(field.name()))} {POSTGRES_TYPES.get(field.type(), "character varying")}')
+        geometry = Postgres.geometry_type(wkbType, srid)
+        if geometry is not None:
+            columns.append(f'{Postgres.quote(geometryname)} {geometry}')
+        cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {Postgres.quote(schema)}')
+        cursor.execute(f'CREATE TABLE {Postgres.quote(schema)}.{Postgres.quote(table)} ({", ".join(columns)})')
+
+    def table_columns(cursor, schema: str, table: str):
+        """
+        Returns the attribute columns and the geometry column of an existing table.
+        """
+
+        cursor.execute('SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s', (schema, table))
+        columns = [row[0] for row in cursor.fetchall()]
+        cursor.execute('SELECT f_geometry_column FROM geometry_columns WHERE f_table_schema = %s AND f_table_name = %s', (schema, table))
+        row = cursor.fetchone()
+        return columns, row[0] if row else None
+
+    def copy_value(value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, QVariant):
+            if value.isNull():
+                return '\\N'
+            value = value.value()
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        if isinstance(value, QDateTime):
+            return value.toString('yyyy-MM-ddTHH:mm:ss.zzz') if value.isValid() else '\\N'
+        if isinstance(value, QDate):
+            return value.toString('yyyy-MM-dd') if value.isValid() else '\\N'
+        if isinstance(value, QTime):
+            return value.toString('HH:mm:ss.zzz') if value.isValid() else '\\N'
+        if isinstance(value, (bytes, bytearray)):
+            return '\\\\x' + bytes(value).hex()
+        return str(value).translate(COPY_ESCAPES)
+
+    def copy_columns(cursor, schema: str, table: str, fields, geometryname: str = 'wkb_geometry'):
+        """
+        Matches the fields of a layer with the columns of an existing table.
+
+        Returns:
+            columns (tuple): The indexes of the loaded fields, the quoted column names, and whether the geometry is loaded
+        """
+
+        existing, geometrycolumn = Postgres.table_columns(cursor, schema, table)
+        if geometrycolumn is not None:
+            geometryname = geometrycolumn
+        indexes = []
+        columns = []
+        for index, field in enumerate(fields):
+            name = launder(field.name())
+            if name in existing:
+                indexes.append(index)
+                columns.append(Postgres.quote(name))
+            else:
+                logger.info(f'Field {field.name()} does not exist in {schema}.{table}, skipping it')
+        load_geometry = geometryname is not None and geometryname in existing
+        if load_geometry:
+            columns.append(Postgres.quote(geometryname))
+        return indexes, columns, load_geometry
+
+    def copy_features(cursor, schema: str, table: str, features, fields, srid: int, geometryname: str = 'wkb_geometry', hashcolumn: str = None, into: str = None):
+        """
+        Streams features into a table with COPY, in the text format with hex EWKB geometries.
+
+        Args:
+            cursor (psycopg2 cursor): The cursor to run the COPY on
+            schema (string): Schema name
+            table (string): Table name
+            features (iterable of QgsFeatures): The features to load
+            fields (QgsFields): The fields of the features
+            srid (integer): The SRID of the geometries
+            geometryname (string): Name of the geometry column, or None to skip the geometries
+            hashcolumn (string): Optional column receiving an md5 hash of the attributes and geometry of each row
+            into (string): Optional quoted table to COPY into instead, with the columns of schema.table
+
+        Returns:
+            rows (integer): Number of rows loaded
+        """
+
+        indexes, columns, load_geometry = Postgres.copy_columns(cursor, schema, table, fields, geometryname)
+        if hashcolumn is not None:
+            columns.append(Postgres.quote(hashcolumn))
+
+        counter = {'rows': 0}
+        def rows():
+            for feature in features:
+                attributes = feature.attributes()
+                values = [Postgres.copy_value(attributes[index]) for index in indexes]
+                if load_geometry:
+                    if feature.hasGeometry():
+                        values.append(ewkb(bytes(feature.geometry().asWkb()), srid).hex())
+                    else:
+                        values.append('\\N')
+                if hashcolumn is not None:
+                    values.append(hashlib.md5('\t'.join(values).encode('utf-8')).hexdigest())
+                counter['rows'] += 1
+                yield '\t'.join(values) + '\n'
+
+        if into is None:
+            into = f'{Postgres.quote(schema)}.{Postgres.quote(table)}'
+        sql = f'COPY {into} ({", ".join(columns)}) FROM STDIN'
+        cursor.copy_expert(sql, CopyStream(rows()), size=65536)
+        return counter['rows']
+
+    def load(layer, connection: str, dbname: str, schema: str, tablename: str, overwrite: bool):
+        """
+        Loads a layer into PostGIS in one transaction, using COPY over a psycopg2 connection.
+        With overwrite the table is dropped and recreated, otherwise the features are appended, creating the table if needed.
+
+        Returns:
+            rows (integer): Number of rows loaded
+        """
+
+        srid = layer.crs().postgisSrid()
+        start = time.time()
+        conn = ConnectionPool.get('Postgres', connection, dbname)
+        cursor = conn.cursor()
+        try:
+            exists = Postgres.table_exists(cursor, schema, tablename)
+            if exists and overwrite:
+                logger.info(f'Dropping existing table {schema}.{tablename}')
+                cursor.execute(f'DROP TABLE {Postgres.quote(schema)}.{Postgres.quote(tablename)}')
+            created = overwrite or not exists
+            if created:
+                Postgres.create_table(cursor, schema, tablename, layer.fields(), layer.wkbType(), srid)
+
+            rows = Postgres.copy_features(cursor, schema, tablename, layer.getFeatures(), layer.fields(), srid)
+
+            if created and layer.wkbType() != QgsWkbTypes.NoGeometry:
+                cursor.execute(f'CREATE INDEX ON {Postgres.quote(schema)}.{Postgres.quote(tablename)} USING GIST ({Postgres.quote("wkb_geometry")})')
+            conn.commit()
+            cursor.execute(f'ANALYZE {Postgres.quote(schema)}.{Postgres.quote(tablename)}')
+            conn.commit()
+        except Exception as error:
+            conn.rollback()
+            diag = getattr(error, 'diag', None)
+            if diag is not None and diag.context:
+                logger.error(f'COPY failed at: {diag.context}')
+            raise
+        finally:
+            cursor.close()
+
+        seconds = time.time() - start
+        logger.info(f'Loaded {rows} rows into {schema}.{tablename} in {round(seconds, 2)} s ({round(rows / seconds) if seconds > 0 else rows} rows/s)')
+        return rows
+
+    def upsert(layer, connection: str, dbname: str, schema: str, tablename: str, key: str, hashcolumn: str = 'qetl_hash'):
+        """
+        Synchronizes a table with a layer, applying only the rows that changed, in one transaction.
+        The layer is loaded with COPY into a temporary table, with an md5 hash of the attributes and geometry of each row.
+        Rows are matched on the key column, and the hash column of the table tells which rows changed since the last load.
+        Rows missing from the layer are deleted. A new table is created and loaded when it does not exist.
+
+        Args:
+            layer (QgsVectorLayer): The layer holding the complete, current data
+            connection (string): The name of the connection in the settings file
+            dbname (string): The database name
+            schema (string): Schema name
+            tablename (string): Table name
+            key (string): The field identifying a row, unique and not NULL in the layer
+            hashcolumn (string): The column holding the row hash, added to the table if missing
+
+        Returns:
+            counts (dictionary): The number of inserted, updated, deleted and unchanged rows
+        """
+
+        srid = layer.crs().postgisSrid()
+        if layer.fields().lookupField(key) == -1:
+            raise KeyError(f'The key field {key} does not exist in the layer')
+        ## Rows with a NULL key never match a row of the table, and would be inserted again on every load
+        request = QgsFeatureRequest().setFilterExpression(f'{QgsExpression.quotedColumnRef(key)} IS NULL')
+        request.setFlags(QgsFeatureRequest.NoGeometry).setNoAttributes()
+        nulls = sum(1 for feature in layer.getFeatures(request))
+        if nulls:
+            raise ValueError(f'{nulls} features have a NULL value in the key field {key}')
+        target = f'{Postgres.quote(schema)}.{Postgres.quote(tablename)}'
+        keycolumn = Postgres.quote(launder(key))
+        start = time.time()
+        conn = ConnectionPool.get('Postgres', connection, dbname)
+        cursor = conn.cursor()
+        try:
+            if not Postgres.table_exists(cursor, schema, tablename):
+                logger.info(f'Table {schema}.{tablename} does not exist, creating it')
+                Postgres.create_table(cursor, schema, tablename, layer.fields(), layer.wkbType(), srid)
+                cursor.execute(f'ALTER TABLE {target} ADD COLUMN {Postgres.quote(hashcolumn)} character varying')
+                rows = Postgres.copy_features(cursor, schema, tablename, layer.getFeatures(), layer.fields(), srid, hashcolumn=hashcolumn)
+                cursor.execute(f'CREATE UNIQUE INDEX ON {target} ({keycolumn})')
+                if layer.wkbType() != QgsWkbTypes.NoGeometry:
+                    cursor.execute(f'CREATE INDEX ON {target} USING GIST ({Postgres.quote("wkb_geometry")})')
+                counts = {'inserted': rows, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+            else:
+                cursor.execute(f'ALTER TABLE {target} ADD COLUMN IF NOT EXISTS {Postgres.quote(hashcolumn)} character varying')
+                indexes, columns, load_geometry = Postgres.copy_columns(cursor, schema, tablename, layer.fields())
+                if keycolumn not in columns:
+                    raise KeyError(f'The key column {launder(key)} does not exist in {schema}.{tablename}')
+                columns.append(Postgres.quote(hashcolumn))
+                hash = Postgres.quote(hashcolumn)
+
+                cursor.execute(f'CREATE TEMP TABLE qetl_delta ON COMMIT DROP AS SELECT {", ".join(columns)} FROM {target} WITH NO DATA')
+                rows = Postgres.copy_features(cursor, schema, tablename, layer.getFeatures(), layer.fields(), srid, hashcolumn=hashcolumn, into='qetl_delta')
+                cursor.execute(f'CREATE INDEX ON qetl_delta ({keycolumn})')
+                cursor.execute('ANALYZE qetl_delta')
+                cursor.execute(f'SELECT {keycolumn} FROM qetl_delta GROUP BY {keycolumn} HAVING count(*) > 1 LIMIT 1')
+                duplicate = cursor.fetchone()
+                if duplicate is not None:
+                    raise ValueError(f'The key {key} is not unique in the layer, e.g. {duplicate[0]}')
+
+                cursor.execute(f'DELETE FROM {target} t WHERE NOT EXISTS (SELECT 1 FROM qetl_delta d WHERE d.{keycolumn} = t.{keycolumn})')
+                deleted = cursor.rowcount
+                assignments = ', '.join(f'{column} = d.{column}' for column in columns if column != keycolumn)
+                cursor.execute(f'UPDATE {target} t SET {assignments} FROM qetl_delta d WHERE t.{keycolumn} = d.{keycolumn} AND t.{hash} IS DISTINCT FROM d.{hash}')
+                updated = cursor.rowcount
+                cursor.execute(f'INSERT INTO {target} ({", ".join(columns)}) SELECT {", ".join(columns)} FROM qetl_delta d WHERE NOT EXISTS (SELECT 1 FROM {target} t WHERE t.{keycolumn} = d.{keycolumn})')
+                inserted = cursor.rowcount
+                counts = {'inserted': inserted, 'updated': updated, 'deleted': deleted, 'unchanged': rows - inserted - updated}
+            conn.commit()
+            if counts['inserted'] + counts['updated'] + counts['deleted'] > 0:
+                cursor.execute(f'ANALYZE {target}')
+                conn.commit()
+        except Exception as error:
+            conn.rollback()
+            diag = getattr(error, 'diag', None)
+            if diag is not None and diag.context:
+                logger.error(f'Delta load failed at: {diag.context}')
+            raise
+        finally:
+            cursor.close()
+
+        seconds = time.time() - start
+        logger.info(f'Delta load of {rows} rows into {schema}.{tablename} in {round(seconds, 2)} s: {counts["inserted"]} inserted, {counts["updated"]} updated, {counts["deleted"]} deleted, {counts["unchanged"]} unchanged')
+        return counts
+
+
+class Mssql:
+    '''
+    Helpers for loading layers into SQL Server with batched parameterized inserts.
+    '''
+
+    def connect(connection: str, driver: str = ''):
+        """
+        Opens a pyodbc connection from a connection in settings.json.
+        Connections without user and password use a trusted connection.
+
+        Args:
+            connection (string): The name of the connection in the settings file
+            driver (string): The ODBC driver. Defaults to 'SQL Server'.
+
+        Returns:
+            connection (pyodbc connection): The open connection
+        """
+
+        import pyodbc
+        config = get_config()
+        dbconnection = config['DatabaseConnections'][connection]
+        driver = driver or 'SQL Server'
+        connectionstring = f"DRIVER={{{driver}}};SERVER={dbconnection['host']};DATABASE={dbconnection['databasename']}"
+        if dbconnection['user'] == '' and dbconnection['password'] == '':
+            connectionstring += ';Trusted_Connection=yes'
+        else:
+            connectionstring += f";UID={dbconnection['user']};PWD={dbconnection['password']}"
+        return pyodbc.connect(connectionstring, autocommit=False)
+
+    def quote(identifier: str):
+        return '[' + identifier.replace(']', ']]') + ']'
+
+    def column_type(field):
+        if field.type() == QVariant.String:
+            if 0 < field.length() <= 4000:
+                return f'nvarchar({field.length()})'
+            return 'nvarchar(max)'
+        return MSSQL_TYPES.get(field.type(), 'nvarchar(max)')
+
+    def table_columns(cursor, schema: str, table: str):
+        cursor.execute('SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?', schema, table)
+        return [row[0] for row in cursor.fetchall()]
+
+    def create_table(cursor, schema: str, table: str, fields, geom_type: str, geom_name: str, fidname: str = 'ogr_fid'):
+        """
+        Creates a table for a layer, with an ogr_fid identity key and a geometry or geography column, like ogr2ogr does.
+        """
+
+        columns = [f'{Mssql.quote(fidname)} int IDENTITY(1,1) PRIMARY KEY']
+        for field in fields:
+            columns.append(f'{Mssql.quote(launder(field.name()))} {Mssql.column_type(field)}')
+        if geom_name:
+            columns.append(f'{Mssql.quote(geom_name)} {geom_type}')
+        cursor.execute(f"IF SCHEMA_ID(?) IS NULL EXEC('CREATE SCHEMA {Mssql.quote(schema)}')", schema)
+        cursor.execute(f'CREATE TABLE {Mssql.quote(schema)}.{Mssql.quote(table)} ({", ".join(columns)})')
+
+    def value(value):
+        if value is None:
+            return None
+        if isinstance(value, QVariant):
+            if value.isNull():
+                return None
+            value = value.value()
+        if isinstance(value, QDateTime):
+            return value.toPyDateTime() if value.isValid() else None
+        if isinstance(value, QDate):
+            return value.toPyDate() if value.isValid() else None
+        if isinstance(value, QTime):
+            return value.toPyTime() if value.isValid() else None
+        if isinstance(value, bytearray):
+            return bytes(value)
+        return value
+
+    def wkb(feature):
+        ## SQL Server only reads 2D WKB, so Z and M values are dropped
+        if not feature.hasGeometry():
+            return None
+        geometry = QgsGeometry(feature.geometry())
+        if QgsWkbTypes.hasZ(geometry.wkbType()) or QgsWkbTypes.hasM(geometry.wkbType()):
+            geometry.get().dropZValue()
+            geometry.get().dropMValue()
+        return bytes(geometry.asWkb())
+
+    def load(layer, connection: str, driver: str, schema: str, table: str, overwrite: bool, geom_type: str = 'geometry', geom_name: str = 'ogr_geometry', batch_size: int = 10000):
+        """
+        Loads a layer into SQL Server in one transaction, sending the features in batches with pyodbc fast_executemany
+        and the geometries as WKB. With overwrite the table is dropped and recreated, otherwise the features are appended,
+        creating the table if needed. New tables get a spatial index over the extent of the layer.
+
+        Returns:
+            rows (integer): Number of rows loaded
+        """
+
+        geom_type = geom_type or 'geometry'
+        if layer.wkbType() == QgsWkbTypes.NoGeometry:
+            geom_name = None
+        srid = layer.crs().postgisSrid()
+        name = f'{Mssql.quote(schema)}.{Mssql.quote(table)}'
+        start = time.time()
+        conn = ConnectionPool.get('Mssql', connection, driver=driver)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT OBJECT_ID(?, 'U')", name)
+            exists = cursor.fetchone()[0] is not None
+            if exists and overwrite:
+                logger.info(f'Dropping existing table {schema}.{table}')
+                cursor.execute(f'DROP TABLE {name}')
+            created = overwrite or not exists
+            if created:
+                Mssql.create_table(cursor, schema, table, layer.fields(), geom_type, geom_name)
+
+            existing = Mssql.table_columns(cursor, schema, table)
+            indexes = []
+            columns = []
+            for index, field in enumerate(layer.fields()):
+                column = launder(field.name())
+                if column in existing:
+                    indexes.append(index)
+                    columns.append(Mssql.quote(column))
+                else:
+                    logger.info(f'Field {field.name()} does not exist in {schema}.{table}, skipping it')
+            placeholders = ['?'] * len(columns)
+            load_geometry = geom_name is not None and geom_name in existing
+            if load_geometry:
+                columns.append(Mssql.quote(geom_name))
+                placeholders.append(f'{geom_type}::STGeomFromWKB(?, {srid})')
+
+            sql = f'INSERT INTO {name} ({", ".join(columns)}) VALUES ({", ".join(placeholders)})'
+            cursor.fast_executemany = True
+            rows = 0
+            batch = []
+            for feature in layer.getFeatures():
+                attributes = feature.attributes()
+                values = [Mssql.value(attributes[index]) for index in indexes]
+                if load_geometry:
+                    values.append(Mssql.wkb(feature))
+                batch.append(values)
+                if len(batch) >= batch_size:
+                    cursor.executemany(sql, batch)
+                    rows += len(batch)
+                    batch = []
+                    logger.info(f'Inserted {rows} rows')
+            if batch:
+                cursor.executemany(sql, batch)
+                rows += len(batch)
+
+            if created and load_geometry and rows > 0:
+                extent = layer.extent()
+                if extent.width() == 0 or extent.height() == 0:
+                    extent.grow(1)
+                if geom_type.lower() == 'geography':
+                    cursor.execute(f'CREATE SPATIAL INDEX {Mssql.quote("ix_" + table + "_" + geom_name)} ON {name} ({Mssql.quote(geom_name)}) USING GEOGRAPHY_AUTO_GRID')
+                else:
+                    bbox = f'{extent.xMinimum()}, {extent.yMinimum()}, {extent.xMaximum()}, {extent.yMaximum()}'
+                    cursor.execute(f'CREATE SPATIAL INDEX {Mssql.quote("ix_" + table + "_" + geom_name)} ON {name} ({Mssql.quote(geom_name)}) USING GEOMETRY_AUTO_GRID WITH (BOUNDING_BOX = ({bbox}))')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        seconds = time.time() - start
+        logger.info(f'Loaded {rows} rows into {schema}.{table} in {round(seconds, 2)} s ({round(rows / seconds) if seconds > 0 else rows} rows/s)')
+        return rows
+
+
+class ConnectionPool:
+    '''
+    Database connections shared by the steps of a job, keyed by the connection name in settings.json,
+    the database and the driver. The connections are opened on first use and closed when the job ends.
+    Users of a pooled connection must commit or roll back their work, and must not close the connection.
+    '''
+
+    connections = {}
+
+    def get(databasetype: str, connection: str, dbname: str = None, driver: str = ''):
+        """
+        Returns an open connection from the pool, connecting if needed.
+
+        Args:
+            databasetype (string): The database type, one of 'Postgres' or 'Mssql'
+            connection (string): The name of the connection in the settings file
+            dbname (string): The database name, for Postgres
+            driver (string): The ODBC driver, for Mssql. Defaults to 'SQL Server'.
+
+        Returns:
+            connection (psycopg2 or pyodbc connection): The pooled connection
+        """
+
+        key = (databasetype, connection, dbname, driver or '')
+        conn = ConnectionPool.connections.get(key)
+        if conn is not None and ConnectionPool.alive(databasetype, conn):
+            return conn
+        start = time.time()
+        if databasetype == 'Postgres':
+            conn = Postgres.connect(connection, dbname)
+        elif databasetype == 'Mssql':
+            conn = Mssql.connect(connection, driver)
+        else:
+            raise ValueError(f'Unsupported database: {databasetype}, use one of "Mssql" or "Postgres"')
+        logger.info(f'Opened pooled {databasetype} connection {connection} in {round(time.time() - start, 2)} s')
+        ConnectionPool.connections[key] = conn
+        return conn
+
+    def alive(databasetype: str, conn):
+        if databasetype == 'Postgres':
+            return conn.closed == 0
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def close_all():
+        """
+        Closes all pooled connections, rolling back uncommitted work.
+        """
+
+        for key, conn in list(ConnectionPool.connections.items()):
+            try:
+                conn.rollback()
+                conn.close()
+            except Exception:
+                pass
+        if ConnectionPool.connections:
+            logger.info(f'Closed {len(ConnectionPool.connections)} pooled database connections')
+        ConnectionPool.connections = {}
+
+    def run(databasetype: str, connection: str, statements: list, dbname: str = None, driver: str = ''):
+        """
+        Runs a list of statements on a pooled connection in one transaction.
+        Each statement is either an SQL string, or a tuple of an SQL string and a list of parameter rows run with executemany.
+
+        Returns:
+            results (list of dictionaries): The sql, the affected row count and the time in seconds of each statement
+        """
+
+        conn = ConnectionPool.get(databasetype, connection, dbname, driver)
+        cursor = conn.cursor()
+        results = []
+        try:
+            for statement in statements:
+                start = time.time()
+                if isinstance(statement, str):
+                    sql = statement
+                    cursor.execute(sql)
+                else:
+                    sql, parameters = statement
+                    if databasetype == 'Mssql':
+                        cursor.fast_executemany = True
+                    cursor.executemany(sql, parameters)
+                results.append({'sql': sql, 'rowcount': cursor.rowcount, 'seconds': round(time.time() - start, 3)})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return results
+
+atexit.register(ConnectionPool.close_all)
+
+
+class CopyStream:
+    '''
+    A file-like object reading the lines of a generator, used as input for COPY FROM STDIN.
+    '''
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = ''
+
+    def read(self, size: int = -1):
+        while self.lines is not None and (size < 0 or len(self.buffer) < size):
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                self.lines = None
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size: int = -1):
+        if self.lines is not None and '\n' not in self.buffer:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                self.lines = None
+        line, separator, self.buffer = self.buffer.partition('\n')
+        return line + separator
@@ -0,0 +1,263 @@
+from core.logger import *
+from core.misc import get_config
+import os
+import json
+import time
+import threading
+from urllib.parse import urlsplit, unquote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+## Suffixes of the partial download and of the file holding its progress, kept until the download completes
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.part.json'
+
+
+class Downloader:
+    '''
+    Concurrent, resumable HTTP downloads over a shared connection pool.
+    Files are downloaded to a .part file next to the target, with the progress in a .part.json file. An interrupted
+    download continues where it stopped with HTTP Range requests, as long as the file on the server is unchanged.
+    Large files are split into byte ranges downloaded at the same time, when the server accepts Range requests.
+
+    "Downloads" : {
+        "workers" : 4,            files downloaded at the same time
+        "segments" : 4,           byte ranges downloaded at the same time for each large file
+        "segment_min_mb" : 64,    files smaller than this are downloaded in one piece
+        "chunk_size_mb" : 1,      size of the chunks read from the connection and written to the file
+        "retries" : 3             retries of a failing file or byte range, with exponential backoff
+    }
+    '''
+
+    def settings():
+        downloads = {
+            'workers': 4,
+            'segments': 4,
+            'segment_min_mb': 64,
+            'chunk_size_mb': 1,
+            'retries': 3
+        }
+        downloads.update(get_config().get('Downloads', {}))
+        return downloads
+
+    def session(connections: int):
+        """
+        Returns a requests session with room for the given number of concurrent connections to each host.
+        """
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(10, connections), pool_maxsize=max(10, connections))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def filename(url: str):
+        name = os.path.basename(unquote(urlsplit(url).path))
+        return name or 'download'
+
+    def probe(session, url: str):
+        """
+        Asks the server for the size of a file, whether it accepts Range requests, and the validators telling if it changed.
+
+        Returns:
+            remote (dictionary): size (or None), ranges (boolean), etag and last_modified
+        """
+
+        response = session.head(url, allow_redirects=True, timeout=60)
+        if response.status_code >= 400:
+            ## Some servers refuse HEAD requests, a one byte range tells the same
+            response = session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=60)
+            response.raise_for_status()
+            response.close()
+            if response.status_code == 206 and '/' in response.headers.get('Content-Range', ''):
+                total = response.headers['Content-Range'].split('/')[-1]
+                return {'size': int(total) if total.isdigit() else None, 'ranges': True,
+                        'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        length = response.headers.get('Content-Length')
+        encoded = response.headers.get('Content-Encoding', 'identity') != 'identity'
+        return {
+            'size': int(length) if length and length.isdigit() and not encoded else None,
+            'ranges': response.headers.get('Accept-Ranges', '').lower() == 'bytes',
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        }
+
+    def read_state(path: str, url: str, remote: dict):
+        ## The progress of an earlier attempt, if it was for the same, unchanged file
+        try:
+            with open(path + STATE_SUFFIX, 'r') as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(path + PART_SUFFIX):
+            return None
+        if state.get('url') != url or state.get('size') != remote['size']:
+            return None
+        if state.get('etag') != remote['etag'] or state.get('last_modified') != remote['last_modified']:
+            logger.info(f'{os.path.basename(path)} changed on the server, restarting the download')
+            return None
+        return state
+
+    def write_state(path: str, state: dict):
+        with open(path + STATE_SUFFIX + '.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(path + STATE_SUFFIX + '.tmp', path + STATE_SUFFIX)
+
+    def download(session, url: str, path: str, segments: int = None, chunk_size: int = None, retries: int = None, skip_existing: bool = False):
+        """
+        Downloads one file, resuming an earlier attempt and splitting it into byte ranges when possible.
+
+        Args:
+            session (requests.Session): The session, shared by concurrent downloads
+            url (string): The url of the file
+            path (string): The local path of the file
+            segments (integer): Number of byte ranges downloaded at the same time for large files
+            chunk_size (integer): Bytes read from the connection at a time
+            retries (integer): Retries of a failing byte range
+            skip_existing (boolean): Skip the download when the file exists with the size of the file on the server.
+                A changed file of the same size is not detected, so this is only for files that do not change
+
+        Returns:
+            download (dictionary): The url, path, bytes downloaded in this run, seconds and whether it was resumed
+        """
+
+        settings = Downloader.settings()
+        segments = segments or settings['segments']
+        chunk_size = chunk_size or int(settings['chunk_size_mb'] * 1024**2)
+        retries = settings['retries'] if retries is None else retries
+        start = time.time()
+
+        remote = Downloader.probe(session, url)
+        size = remote['size']
+        if skip_existing and size is not None and os.path.isfile(path) and os.path.getsize(path) == size and not os.path.exists(path + STATE_SUFFIX):
+            logger.info(f'{os.path.basename(path)} is already downloaded, skipping it')
+            return {'url': url, 'path': path, 'bytes': 0, 'seconds': time.time() - start, 'resumed': False}
+
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        state = Downloader.read_state(path, url, remote) if remote['ranges'] and size is not None else None
+        resumed = state is not None
+        if state is None:
+            if remote['ranges'] and size and size >= settings['segment_min_mb'] * 1024**2 and segments > 1:
+                step = -(-size // segments)
+                ranges = [[offset, min(offset + step, size) - 1, 0] for offset in range(0, size, step)]
+            else:
+                ranges = [[0, size - 1 if size is not None else None, 0]]
+            state = {'url': url, 'size': size, 'etag': remote['etag'], 'last_modified': remote['last_modified'], 'ranges': ranges}
+            with open(path + PART_SUFFIX, 'wb') as file:
+                if size is not None:
+                    file.truncate(size)
+            if remote['ranges'] and size is not None:
+                Downloader.write_state(path, state)
+        else:
+            done = sum(segment[2] for segment in state['ranges'])
+            logger.info(f'Resuming {os.path.basename(path)} at {round(done / 1024**2, 2)} of {round(size / 1024**2, 2)} MB')
+
+        lock = threading.Lock()
+        progress = {'bytes': 0, 'saved': time.time()}
+        resumable = remote['ranges'] and size is not None
+
+        def fetch(segment):
+            for attempt in range(retries + 1):
+                first, last, done = segment
+                if last is not None and first + done > last:
+                    return
+                headers = {}
+                if resumable and (done > 0 or len(state['ranges']) > 1):
+                    headers['Range'] = f'bytes={first + done}-{last}'
+                try:
+                    with session.get(url, headers=headers, stream=True, timeout=300) as response:
+                        response.raise_for_status()
+                        if headers and response.status_code != 206:
+                            raise IOError(f'The server ignored the Range request, status {response.status_code}')
+                        with open(path + PART_SUFFIX, 'r+b') as file:
+                            file.seek(first + done)
+                            for chunk in response.iter_content(chunk_size=chunk_size):
+                                file.write(chunk)
+                                with lock:
+                                    segment[2] += len(chunk)
+                                    progress['bytes'] += len(chunk)
+                                    if resumable and time.time() - progress['saved'] > 5:
+                                        file.flush()
+                                        Downloader.write_state(path, state)
+                                        progress['saved'] = time.time()
+                    if last is None or first + segment[2] > last:
+                        return
+                    raise IOError(f'The connection closed after {segment[2]} of {last - first + 1} bytes')
+                except Exception as error:
+                    if attempt == retries:
+                        raise
+                    if not resumable:
+                        ## Without Range requests the file starts over
+                        segment[2] = 0
+                    wait = 2 ** attempt
+                    logger.info(f'Download of {os.path.basename(path)} failed ({type(error).__name__}  –  {str(error)[:200]}), retrying in {wait} s')
+                    time.sleep(wait)
+
+        try:
+            if len(state['ranges']) == 1:
+                fetch(state['ranges'][0])
+            else:
+                logger.info(f'Downloading {os.path.basename(path)} ({round(size / 1024**2, 2)} MB) in {len(state["ranges"])} byte ranges')
+                with ThreadPoolExecutor(max_workers=len(state['ranges'])) as executor:
+                    for future in as_completed([executor.submit(fetch, segment) for segment in state['ranges']]):
+                        future.result()
+        finally:
+            if resumable:
+                with lock:
+                    Downloader.write_state(path, state)
+
+        if size is None:
+            ## Without a known size, a retry can leave the end of a longer earlier attempt
+            with open(path + PART_SUFFIX, 'r+b') as file:
+                file.truncate(state['ranges'][0][2])
+        elif os.path.getsize(path + PART_SUFFIX) != size:
+            raise IOError(f'Downloaded {os.path.getsize(path + PART_SUFFIX)} bytes, expected {size}')
+        os.replace(path + PART_SUFFIX, path)
+        if os.path.exists(path + STATE_SUFFIX):
+            os.remove(path + STATE_SUFFIX)
+
+        seconds = time.time() - start
+        megabytes = progress['bytes'] / 1024**2
+        logger.info(f'Downloaded {os.path.basename(path)}: {round(megabytes, 2)} MB in {round(seconds, 2)} s ({round(megabytes / seconds, 2) if seconds > 0 else megabytes} MB/s)')
+        return {'url': url, 'path': path, 'bytes': progress['bytes'], 'seconds': seconds, 'resumed': resumed}
+
+    def download_many(downloads: dict, workers: int = None, segments: int = None, chunk_size: int = None, retries: int = None, skip_existing: bool = False):
+        """
+        Downloads files concurrently over one connection pool.
+
+        Args:
+            downloads (dictionary): The local path of each url
+
+        Returns:
+            results (list of dictionaries): The result of each download, with the error of failed downloads
+        """
+
+        settings = Downloader.settings()
+        workers = max(1, min(workers or settings['workers'], len(downloads)))
+        segments = segments or settings['segments']
+        session = Downloader.session(workers * segments)
+        start = time.time()
+        logger.info(f'Downloading {len(downloads)} files, {workers} at a time')
+
+        results = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(Downloader.download, session, url, path, segments, chunk_size, retries, skip_existing): url for url, path in downloads.items()}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    result = future.result()
+                    result['error'] = None
+                except Exception as error:
+                    result = {'url': url, 'path': downloads[url], 'bytes': 0, 'seconds': None, 'resumed': False, 'error': f'{type(error).__name__}  –  {str(error)}'}
+                    logger.error(f'Download of {url} failed: {result["error"]}')
+                results.append(result)
+                logger.info(f'{len(results)}/{len(downloads)} downloads done')
+
+        seconds = time.time() - start
+        megabytes = sum(result['bytes'] for result in results) / 1024**2
+        failed = len([result for result in results if result['error']])
+        logger.info(f'Downloaded {round(megabytes, 2)} MB in {round(seconds, 2)} s ({round(megabytes / seconds, 2) if seconds > 0 else megabytes} MB/s), {failed} failed')
+        session.close()
+        return results
@@ -0,0 +1,446 @@
+from core.logger import *
+import time
+from qgis.core import (
+                       QgsExpression,
+                       QgsExpressionNode,
+                       QgsExpressionNodeBinaryOperator,
+                       QgsExpressionNodeUnaryOperator,
+                       QgsVectorLayer,
+                       QgsFeature,
+                       QgsField,
+                       QgsFields,
+                       QgsProject,
+                       QgsUnitTypes,
+                       QgsWkbTypes)
+from qgis.PyQt.QtCore import QVariant, QDateTime
+from engine.pipeline import resolve, FIELD_TYPES, BATCH_SIZE
+from engine.storage import IntermediateSink
+
+## Field types read as numeric columns
+NUMERIC_TYPES = (QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong, QVariant.Double)
+
+## The kinds of values each field type of native:fieldcalculator can be written from
+OUTPUT_KINDS = {
+    0: ('num', 'bool', 'null'),
+    1: ('num', 'bool', 'null'),
+    2: ('str', 'null'),
+    5: ('datetime', 'null'),
+    6: ('bool', 'null')
+}
+
+## Functions of one numeric argument, and their numpy implementation
+NUMERIC_FUNCTIONS = {
+    'abs': 'absolute',
+    'floor': 'floor',
+    'ceil': 'ceil'
+}
+
+## Functions of one string argument
+STRING_FUNCTIONS = ('upper', 'lower', 'trim', 'length')
+
+
+class Unsupported(Exception):
+    '''
+    Raised when an expression uses something the vectorised engine does not implement.
+    '''
+
+
+class VectorExpression:
+    '''
+    A QGIS expression compiled to numpy column operations, evaluated over a batch of features at a time.
+
+    The supported subset is literals, fields (numbers, strings and booleans), arithmetic, comparisons, AND/OR/NOT, IS NULL,
+    string concatenation with || and concat(), CASE, coalesce(), abs(), floor(), ceil(), round(), upper(), lower(), trim(),
+    length(), now(), and $area and $length in projected layers measured in meters. NULL follows the rules of QGIS expressions:
+    arithmetic and comparisons with NULL give NULL, and CASE treats NULL as false.
+    Anything else raises Unsupported when the expression is compiled.
+    '''
+
+    def __init__(self, formula: str, layer: QgsVectorLayer, fieldtype: int):
+        global np
+        try:
+            import numpy as np
+        except ImportError:
+            raise Unsupported('numpy is not installed')
+        expression = QgsExpression(formula)
+        if expression.hasParserError():
+            raise Unsupported(f'parser error: {expression.parserErrorString()}')
+        self.layer = layer
+        self.fields = layer.fields()
+        self.columns = {}
+        self.geometry = False
+        self.kind, self.function = self.compile(expression.rootNode())
+        if fieldtype not in OUTPUT_KINDS or self.kind not in OUTPUT_KINDS[fieldtype]:
+            raise Unsupported(f'writing a {self.kind} value to a field of type {fieldtype}')
+        self.fieldtype = fieldtype
+
+    def compile(self, node):
+        ## Returns the kind of the values of a node, and a function computing them from a batch as (values, nulls)
+        type = node.nodeType()
+        if type == QgsExpressionNode.ntLiteral:
+            return self.literal(node.value())
+        if type == QgsExpressionNode.ntColumnRef:
+            return self.column(node.name())
+        if type == QgsExpressionNode.ntUnaryOperator:
+            return self.unary(node)
+        if type == QgsExpressionNode.ntBinaryOperator:
+            return self.binary(node)
+        if type == QgsExpressionNode.ntFunction:
+            return self.call(node)
+        if type == QgsExpressionNode.ntCondition:
+            return self.condition(node)
+        raise Unsupported(f'the expression {node.dump()}')
+
+    def literal(self, value):
+        if isinstance(value, QVariant):
+            value = None if value.isNull() else value.value()
+        if value is None:
+            return 'null', lambda batch: (np.zeros(batch['n']), np.ones(batch['n'], dtype=bool))
+        if isinstance(value, bool):
+            kind = 'bool'
+        elif isinstance(value, (int, float)):
+            kind = 'num'
+        elif isinstance(value, str):
+            kind = 'str'
+        else:
+            raise Unsupported(f'the literal {value}')
+        return kind, lambda batch: (np.full(batch['n'], value, dtype=object if kind == 'str' else None), np.zeros(batch['n'], dtype=bool))
+
+    def column(self, name: str):
+        index = self.fields.lookupField(name)
+        if index == -1:
+            raise Unsupported(f'the unknown field {name}')
+        fieldtype = self.fields.at(index).type()
+        if fieldtype in NUMERIC_TYPES:
+            kind = 'num'
+        elif fieldtype == QVariant.String:
+            kind = 'str'
+        elif fieldtype == QVariant.Bool:
+            kind = 'bool'
+        else:
+            raise Unsupported(f'the field {name} of type {self.fields.at(index).typeName()}')
+        self.columns[index] = kind
+        return kind, lambda batch: batch['columns'][index]
+
+    def unary(self, node):
+        kind, operand = self.compile(node.operand())
+        if node.op() == QgsExpressionNodeUnaryOperator.uoNot and kind in ('bool', 'null'):
+            return 'bool', lambda batch: VectorExpression.apply(np.logical_not, operand(batch))
+        if node.op() == QgsExpressionNodeUnaryOperator.uoMinus and kind in ('num', 'null'):
+            return 'num', lambda batch: VectorExpression.apply(np.negative, operand(batch))
+        raise Unsupported(f'the operator {node.dump()}')
+
+    def binary(self, node):
+        op = node.op()
+        left_kind, left = self.compile(node.opLeft())
+        right_kind, right = self.compile(node.opRight())
+        kinds = set([left_kind, right_kind]) - {'null'}
+        operators = QgsExpressionNodeBinaryOperator
+
+        if op in (operators.boIs, operators.boIsNot) and 'null' in (left_kind, right_kind):
+            other = right if left_kind == 'null' else left
+            if op == operators.boIs:
+                return 'bool', lambda batch: (other(batch)[1].copy(), np.zeros(batch['n'], dtype=bool))
+            return 'bool', lambda batch: (~other(batch)[1], np.zeros(batch['n'], dtype=bool))
+
+        if op in (operators.boAnd, operators.boOr) and kinds <= {'bool'}:
+            def logical(batch):
+                (a, a_null), (b, b_null) = left(batch), right(batch)
+                a = a.astype(bool) & ~a_null
+                b = b.astype(bool) & ~b_null
+                if op == operators.boAnd:
+                    false = (~a & ~a_null) | (~b & ~b_null)
+                    return a & b, ~false & (a_null | b_null)
+                true = a | b
+                return true, ~true & (a_null | b_null)
+            return 'bool', logical
+
+        arithmetic = {
+            operators.boPlus: np.add,
+            operators.boMinus: np.subtract,
+            operators.boMul: np.multiply,
+            operators.boPow: np.power
+        }
+        if op in arithmetic and kinds <= {'num'}:
+            function = arithmetic[op]
+            if op == operators.boPow:
+                function = lambda a, b: np.power(a.astype(float), b)
+            return 'num', lambda batch: VectorExpression.apply(function, left(batch), right(batch))
+        if op in (operators.boDiv, operators.boIntDiv, operators.boMod) and kinds <= {'num'}:
+            function = {operators.boDiv: np.true_divide, operators.boIntDiv: np.floor_divide, operators.boMod: np.fmod}[op]
+            def divide(batch):
+                (a, a_null), (b, b_null) = left(batch), right(batch)
+                ## Division by zero gives NULL
+                zero = (b == 0) & ~b_null
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    values = function(a, np.where(zero, 1, b))
+                return values, a_null | b_null | zero
+            return 'num', divide
+
+        comparisons = {
+            operators.boEQ: np.equal,
+            operators.boNE: np.not_equal,
+            operators.boLT: np.less,
+            operators.boGT: np.greater,
+            operators.boLE: np.less_equal,
+            operators.boGE: np.greater_equal
+        }
+        if op in comparisons and len(kinds) <= 1 and kinds <= {'num', 'str', 'bool'}:
+            function = comparisons[op]
+            def compare(batch):
+                (a, a_null), (b, b_null) = left(batch), right(batch)
+                nulls = a_null | b_null
+                if 'str' in kinds:
+                    a = np.where(a_null, '', a).astype(str)
+                    b = np.where(b_null, '', b).astype(str)
+                return function(a, b), nulls
+            return 'bool', compare
+
+        if op == operators.boConcat and kinds <= {'str'}:
+            return 'str', lambda batch: VectorExpression.apply(VectorExpression.concat, left(batch), right(batch))
+
+        raise Unsupported(f'the operator {node.dump()}')
+
+    def call(self, node):
+        name = QgsExpression.Functions()[node.fnIndex()].name().lower()
+        arguments = [self.compile(argument) for argument in node.args().list()] if node.args() is not None else []
+        kinds = [kind for kind, function in arguments]
+        functions = [function for kind, function in arguments]
+
+        if name == 'now' and not arguments:
+            return 'datetime', lambda batch: (np.full(batch['n'], batch['now'], dtype=object), np.zeros(batch['n'], dtype=bool))
+
+        if name in ('$area', '$length') and not arguments:
+            self.measurable()
+            self.geometry = True
+            measure = 'area' if name == '$area' else 'length'
+            return 'num', lambda batch: (getattr(batch['shapely'], measure)(batch['geometries']), batch['nogeometry'])
+
+        if name in NUMERIC_FUNCTIONS and kinds in (['num'], ['null']):
+            function = getattr(np, NUMERIC_FUNCTIONS[name])
+            return 'num', lambda batch: VectorExpression.apply(function, functions[0](batch))
+
+        if name == 'round' and kinds in (['num'], ['num', 'num']):
+            places = 0
+            if len(arguments) == 2:
+                literal = node.args().list()[1]
+                if literal.nodeType() != QgsExpressionNode.ntLiteral:
+                    raise Unsupported('round() with a computed number of decimals')
+                places = int(literal.value())
+            ## QGIS rounds halves away from zero
+            factor = 10.0 ** places
+            rounding = lambda a: np.trunc(a * factor + np.copysign(0.5, a)) / factor
+            return 'num', lambda batch: VectorExpression.apply(rounding, functions[0](batch))
+
+        if name in STRING_FUNCTIONS and kinds in (['str'], ['null']):
+            if name == 'length':
+                return 'num', lambda batch: VectorExpression.apply(lambda a: np.array([len(value) for value in a], dtype=float), functions[0](batch))
+            method = {'upper': 'upper', 'lower': 'lower', 'trim': 'strip'}[name]
+            return 'str', lambda batch: VectorExpression.apply(lambda a: np.array([getattr(value, method)() for value in a], dtype=object), functions[0](batch))
+
+        if name == 'concat' and arguments and set(kinds) <= {'str', 'null'}:
+            def concat(batch):
+                ## concat() treats NULL as an empty string
+                values = np.full(batch['n'], '', dtype=object)
+                for function in functions:
+                    a, a_null = function(batch)
+                    values = values + np.where(a_null, '', a)
+                return values, np.zeros(batch['n'], dtype=bool)
+            return 'str', concat
+
+        if name == 'coalesce' and arguments and len(set(kinds) - {'null'}) <= 1:
+            kind = (set(kinds) - {'null'} or {'null'}).pop()
+            def coalesce(batch):
+                values, nulls = functions[0](batch)
+                values = values.astype(object) if kind == 'str' else values.copy()
+                nulls = nulls.copy()
+                for function in functions[1:]:
+                    a, a_null = function(batch)
+                    values = np.where(nulls, a, values)
+                    nulls = nulls & a_null
+                return values, nulls
+            return kind, coalesce
+
+        raise Unsupported(f'the function {name}()')
+
+    def condition(self, node):
+        conditions = []
+        for condition in node.conditions():
+            when_kind, when = self.compile(condition.whenExp())
+            then_kind, then = self.compile(condition.thenExp())
+            if when_kind not in ('bool', 'null'):
+                raise Unsupported('CASE with a condition that is not a boolean')
+            conditions.append((when, then_kind, then))
+        if node.elseExp() is not None:
+            otherwise_kind, otherwise = self.compile(node.elseExp())
+        else:
+            otherwise_kind, otherwise = self.literal(None)
+        kinds = set([then_kind for when, then_kind, then in conditions] + [otherwise_kind]) - {'null'}
+        if len(kinds) > 1:
+            raise Unsupported(f'CASE returning values of different kinds {kinds}')
+        kind = kinds.pop() if kinds else 'null'
+
+        def case(batch):
+            values, nulls = otherwise(batch)
+            values = values.astype(object) if kind in ('str', 'datetime') else values
+            chosen = np.zeros(batch['n'], dtype=bool)
+            for when, then_kind, then in conditions:
+                test, test_null = when(batch)
+                hit = test.astype(bool) & ~test_null & ~chosen
+                a, a_null = then(batch)
+                values = np.where(hit, a, values)
+                nulls = np.where(hit, a_null, nulls)
+                chosen = chosen | hit
+            return values, nulls
+        return kind, case
+
+    def measurable(self):
+        ## $area and $length are planar in meters when the project has no ellipsoid and the layer is projected in meters
+        project = QgsProject.instance()
+        if project.ellipsoid() not in ('', 'NONE'):
+            raise Unsupported(f'$area and $length on the ellipsoid {project.ellipsoid()}')
+        if self.layer.crs().mapUnits() != QgsUnitTypes.DistanceMeters:
+            raise Unsupported('$area and $length in a layer not projected in meters')
+        if project.distanceUnits() != QgsUnitTypes.DistanceMeters or project.areaUnits() != QgsUnitTypes.AreaSquareMeters:
+            raise Unsupported('$area and $length in project units other than meters')
+        if QgsWkbTypes.isCurvedType(self.layer.wkbType()) or QgsWkbTypes.hasM(self.layer.wkbType()):
+            raise Unsupported('$area and $length of curved geometries or geometries with M values')
+        try:
+            import shapely
+            if not hasattr(shapely, 'from_wkb'):
+                raise ImportError
+        except ImportError:
+            raise Unsupported('$area and $length without Shapely 2')
+
+    def apply(function, *operands):
+        ## Applies a function to the values of the operands, the result is NULL where any operand is NULL
+        nulls = np.zeros(len(operands[0][0]), dtype=bool)
+        for values, null in operands:
+            nulls = nulls | null
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            values = function(*[values for values, null in operands])
+        return values, nulls
+
+    def concat(a, b):
+        return np.array([str(x) + str(y) for x, y in zip(a, b)], dtype=object)
+
+    def batch(self, features: list, now):
+        """
+        Builds the columns read by the expression from a batch of features.
+        """
+
+        batch = {'n': len(features), 'columns': {}, 'now': now}
+        attributes = [feature.attributes() for feature in features]
+        for index, kind in self.columns.items():
+            raw = [row[index] for row in attributes]
+            nulls = np.array([value is None or (isinstance(value, QVariant) and value.isNull()) for value in raw], dtype=bool)
+            if kind == 'num':
+                integer = self.fields.at(index).type() != QVariant.Double
+                values = np.array([0 if null else value for value, null in zip(raw, nulls)], dtype='int64' if integer else 'float64')
+            elif kind == 'bool':
+                values = np.array([False if null else bool(value) for value, null in zip(raw, nulls)], dtype=bool)
+            else:
+                values = np.array(['' if null else str(value) for value, null in zip(raw, nulls)], dtype=object)
+            batch['columns'][index] = (values, nulls)
+        if self.geometry:
+            import shapely
+            batch['shapely'] = shapely
+            wkb = [bytes(feature.geometry().asWkb()) if feature.hasGeometry() else None for feature in features]
+            batch['nogeometry'] = np.array([value is None for value in wkb], dtype=bool)
+            batch['geometries'] = shapely.from_wkb(np.array(wkb, dtype=object))
+        return batch
+
+    def evaluate(self, features: list, now):
+        """
+        Evaluates the expression over a batch of features.
+
+        Returns:
+            values (list): The value of each feature, converted to the type of the output field, None for NULL
+        """
+
+        values, nulls = self.function(self.batch(features, now))
+        if self.kind == 'num':
+            nulls = nulls | np.isnan(values.astype(float))
+            if self.fieldtype == 1:
+                ## Decimals are rounded like QGIS converts a double to an integer
+                values = np.trunc(values + np.copysign(0.5, values)).astype('int64') if values.dtype.kind == 'f' else values
+        output = []
+        for value, null in zip(values.tolist() if hasattr(values, 'tolist') else values, nulls.tolist()):
+            if null:
+                output.append(None)
+            elif self.fieldtype == 0:
+                output.append(float(value))
+            elif self.fieldtype == 1:
+                output.append(int(value))
+            elif self.fieldtype == 6:
+                output.append(bool(value))
+            else:
+                output.append(value)
+        return output
+
+
+def calculate(layer, fieldname: str, fieldtype: int, fieldlength: int, fieldprecision: int, formula: str):
+    """
+    Calculates a field with the vectorised engine.
+
+    Returns:
+        layer (QgsVectorLayer): The layer with the calculated field, or None if the expression is not supported,
+        in which case the reason is logged and the caller falls back to the QGIS evaluator
+    """
+
+    layer = resolve(layer)
+    try:
+        expression = VectorExpression(formula, layer, fieldtype)
+    except Unsupported as reason:
+        logger.info(f'The numpy engine does not support {reason}, evaluating {formula} with QGIS')
+        return None
+
+    start = time.time()
+    fields = QgsFields(layer.fields())
+    index = fields.lookupField(fieldname)
+    if index != -1 and fields.at(index).type() != FIELD_TYPES[fieldtype]:
+        ## native:fieldcalculator replaces the definition of the field
+        logger.info(f'The numpy engine does not change the type of the existing field {fieldname}, evaluating {formula} with QGIS')
+        return None
+    if index == -1:
+        fields.append(QgsField(fieldname, FIELD_TYPES[fieldtype], '', fieldlength, fieldprecision))
+    sink = IntermediateSink('calculated', fields, layer.wkbType(), layer.crs(), [layer])
+    now = QDateTime.currentDateTime()
+    read = 0
+
+    def flush(features):
+        try:
+            values = expression.evaluate(features, now)
+        except Exception as error:
+            raise Unsupported(f'the values of the features ({type(error).__name__}  –  {str(error)[:200]})')
+        batch = []
+        for feature, value in zip(features, values):
+            output = QgsFeature(fields)
+            output.setGeometry(feature.geometry())
+            attributes = feature.attributes()
+            if index == -1:
+                attributes.append(value)
+            else:
+                attributes[index] = value
+            output.setAttributes(attributes)
+            batch.append(output)
+        sink.addFeatures(batch)
+
+    features = []
+    try:
+        for feature in layer.getFeatures():
+            features.append(feature)
+            read += 1
+            if len(features) >= BATCH_SIZE:
+                flush(features)
+                features = []
+        if features:
+            flush(features)
+    except Unsupported as reason:
+        ## The partly written output is deleted with the layer
+        sink.finish()
+        logger.info(f'The numpy engine failed on {reason}, evaluating {formula} with QGIS')
+        return None
+    result = sink.finish()
+    logger.info(f'Evaluated {formula} with the numpy engine on {read} features in {round(time.time() - start, 2)} s')
+    return result
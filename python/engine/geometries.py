@@ -0,0 +1,218 @@
+from core.logger import *
+from core.misc import get_config, get_core_count
+import time
+from concurrent.futures import ThreadPoolExecutor
+from qgis.core import QgsVectorLayer, QgsFeature, QgsField, QgsFields, QgsGeometry, QgsWkbTypes
+from qgis.PyQt.QtCore import QVariant
+from engine.pipeline import resolve, BATCH_SIZE
+from engine.storage import IntermediateSink
+
+## Cap and join styles of native:buffer, and their names in Shapely
+CAP_STYLES = {0: 'round', 1: 'flat', 2: 'square'}
+JOIN_STYLES = {0: 'round', 1: 'mitre', 2: 'bevel'}
+
+## Geometries in one chunk handed to a thread. Shapely releases the GIL while it runs a function over an array
+CHUNK_SIZE = 1000
+
+
+class Unsupported(Exception):
+    '''
+    Raised when an operation or layer can not be processed with Shapely, and the QGIS algorithm is used instead.
+    '''
+
+
+class ShapelyEngine:
+    '''
+    Geometry operations run with the vectorised functions of Shapely 2 over arrays of geometries, instead of a processing algorithm.
+    Features are read in batches, their geometries are converted from WKB to a Shapely array, the function runs over the array
+    split into chunks on a pool of threads, and the results are written back as WKB. The attributes are not modified.
+    Buffers, centroids and convex hulls are written without Z values, as GEOS computes them in two dimensions.
+
+    "ShapelyEngine" : {
+        "threads" : 0       threads running the Shapely functions, 0 for the number of cores, 1 to run them in the main thread
+    }
+    '''
+
+    def threads():
+        threads = get_config().get('ShapelyEngine', {}).get('threads', 0)
+        return threads if threads and threads > 0 else get_core_count()
+
+    def check(layer):
+        """
+        Raises Unsupported if Shapely 2 is missing or the geometries of the layer can not be handled by Shapely.
+        """
+
+        try:
+            import shapely
+            if not hasattr(shapely, 'from_wkb'):
+                raise Unsupported(f'Shapely {shapely.__version__} is installed, the engine needs Shapely 2')
+        except ImportError:
+            raise Unsupported('Shapely is not installed')
+        if not isinstance(layer, QgsVectorLayer):
+            raise Unsupported(f'the input {layer} is not a vector layer')
+        if layer.geometryType() not in (QgsWkbTypes.PointGeometry, QgsWkbTypes.LineGeometry, QgsWkbTypes.PolygonGeometry):
+            raise Unsupported('layers without geometries')
+        if QgsWkbTypes.isCurvedType(layer.wkbType()):
+            raise Unsupported('curved geometries')
+        if QgsWkbTypes.hasM(layer.wkbType()):
+            raise Unsupported('geometries with M values')
+
+    def run(layer: QgsVectorLayer, name: str, function, wkbType, fields: QgsFields = None, attributes=None):
+        """
+        Runs a Shapely function over the geometries of a layer.
+
+        Args:
+            layer (QgsVectorLayer): The input layer
+            name (string): The name of the operation, used for the output layer and the log
+            function (function): Takes a Shapely array of geometries and returns an array of the results
+            wkbType (QgsWkbTypes): The geometry type of the output layer
+            fields (QgsFields): The fields of the output layer. Defaults to the fields of the input layer
+            attributes (function): Takes the attributes of a feature and its resulting Shapely geometry, and returns the output attributes
+
+        Returns:
+            layer (QgsVectorLayer): The output layer, stored according to the intermediate storage policy
+        """
+
+        import numpy as np
+        import shapely
+        import shapely.errors
+        start = time.time()
+        threads = ShapelyEngine.threads()
+        fields = fields if fields is not None else layer.fields()
+        sink = IntermediateSink(name, fields, wkbType, layer.crs(), [layer])
+        output_z = QgsWkbTypes.hasZ(wkbType)
+
+        def compute(geometries):
+            if threads <= 1 or len(geometries) <= CHUNK_SIZE:
+                return function(geometries)
+            chunks = [geometries[i:i + CHUNK_SIZE] for i in range(0, len(geometries), CHUNK_SIZE)]
+            return np.concatenate(list(executor.map(function, chunks)))
+
+        def flush(features):
+            wkb = np.array([bytes(feature.geometry().asWkb()) if feature.hasGeometry() else None for feature in features], dtype=object)
+            results = compute(shapely.from_wkb(wkb))
+            empty = shapely.is_missing(results) | shapely.is_empty(results)
+            output_wkb = shapely.to_wkb(results, output_dimension=3 if output_z else 2)
+            batch = []
+            for feature, geometry, value, missing in zip(features, results, output_wkb, empty):
+                output = QgsFeature(fields)
+                if not missing:
+                    converted = QgsGeometry()
+                    converted.fromWkb(value)
+                    output.setGeometry(converted)
+                output.setAttributes(attributes(feature.attributes(), geometry) if attributes else feature.attributes())
+                batch.append(output)
+            sink.addFeatures(batch)
+
+        executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        try:
+            read = 0
+            features = []
+            for feature in layer.getFeatures():
+                features.append(feature)
+                read += 1
+                if len(features) >= BATCH_SIZE:
+                    flush(features)
+                    features = []
+            if features:
+                flush(features)
+        except shapely.errors.GEOSException as error:
+            ## The partly written output is deleted with the layer, and the QGIS algorithm runs instead
+            sink.finish()
+            raise Unsupported(f'geometries GEOS could not process ({str(error)[:200]})')
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        result = sink.finish()
+        logger.info(f'{name} with the shapely engine on {read} features in {round(time.time() - start, 2)} s ({threads} threads)')
+        return result
+
+    def buffer(layer, distance, segments: int, endcapStyle: int, joinStyle: int, miterLimit: float, dissolve: bool):
+        if dissolve:
+            raise Unsupported('dissolving the buffers')
+        if not isinstance(distance, (int, float)):
+            raise Unsupported('data defined buffer distances')
+        ShapelyEngine.check(layer)
+        import shapely
+        function = lambda geometries: shapely.buffer(geometries, distance, quad_segs=segments, cap_style=CAP_STYLES[endcapStyle],
+                                                     join_style=JOIN_STYLES[joinStyle], mitre_limit=miterLimit or 1)
+        ## native:buffer writes multipolygons
+        return ShapelyEngine.run(layer, 'buffer', lambda geometries: ShapelyEngine.multi(function(geometries)),
+                                 QgsWkbTypes.MultiPolygon)
+
+    def centroids(layer):
+        ShapelyEngine.check(layer)
+        import shapely
+        return ShapelyEngine.run(layer, 'centroids', shapely.centroid, QgsWkbTypes.Point)
+
+    def simplify(layer, method: int, tolerance: float):
+        if method != 0:
+            raise Unsupported('the snap to grid and Visvalingam simplification methods')
+        ShapelyEngine.check(layer)
+        import shapely
+        if layer.geometryType() == QgsWkbTypes.PointGeometry:
+            raise Unsupported('simplifying points')
+        ## Douglas-Peucker preserving the topology, like QgsGeometry.simplify used by native:simplifygeometries
+        return ShapelyEngine.run(layer, 'simplify', lambda geometries: shapely.simplify(geometries, tolerance, preserve_topology=True),
+                                 layer.wkbType())
+
+    def convexhull(layer):
+        ShapelyEngine.check(layer)
+        import numpy as np
+        import shapely
+
+        def hull(geometries):
+            ## Hulls of single points and straight lines are not polygons, native:convexhull leaves them without geometry
+            hulls = shapely.convex_hull(geometries)
+            return np.where(shapely.get_type_id(hulls) == 3, hulls, None)
+
+        ## native:convexhull adds the area and perimeter of the hull
+        fields = QgsFields(layer.fields())
+        for name in ('area', 'perimeter'):
+            unique, suffix = name, 2
+            while fields.lookupField(unique) != -1:
+                unique, suffix = f'{name}_{suffix}', suffix + 1
+            fields.append(QgsField(unique, QVariant.Double, '', 20, 6))
+
+        def attributes(values, geometry):
+            if geometry is None:
+                return values + [None, None]
+            return values + [float(shapely.area(geometry)), float(shapely.length(geometry))]
+
+        return ShapelyEngine.run(layer, 'convexhull', hull, QgsWkbTypes.Polygon, fields, attributes)
+
+    def multipart(layer):
+        ShapelyEngine.check(layer)
+        return ShapelyEngine.run(layer, 'multipart', ShapelyEngine.multi, QgsWkbTypes.multiType(layer.wkbType()))
+
+    def multi(geometries):
+        """
+        Converts single part geometries to multipart geometries with one part, leaving multipart geometries and NULL untouched.
+        """
+
+        import numpy as np
+        import shapely
+        output = np.array(geometries, dtype=object)
+        types = shapely.get_type_id(geometries)
+        for single, collect in ((0, shapely.multipoints), (1, shapely.multilinestrings), (3, shapely.multipolygons)):
+            indices = np.nonzero(types == single)[0]
+            if len(indices):
+                output[indices] = collect(geometries[indices], indices=np.arange(len(indices)))
+        return output
+
+
+def shapely_engine(operation: str, layer, *args):
+    """
+    Runs a geometry operation with the shapely engine.
+
+    Returns:
+        layer (QgsVectorLayer): The output layer, or None if the operation or layer is not supported,
+        in which case the reason is logged and the caller runs the QGIS algorithm
+    """
+
+    layer = resolve(layer)
+    try:
+        return getattr(ShapelyEngine, operation)(layer, *args)
+    except Unsupported as reason:
+        logger.info(f'The shapely engine does not support {reason}, running {operation} with QGIS')
+        return None
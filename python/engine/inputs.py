@@ -1,22 +1,34 @@
 from core.logger import *
 from core.misc import layerHasFeatures
 import sys
-from qgis.core import QgsVectorLayer, QgsDataSourceUri
+from qgis.core import QgsVectorLayer, QgsDataSourceUri, QgsFeature, QgsFields, QgsFeatureRequest, QgsRectangle, QgsCoordinateTransform, QgsProject
 from random import randrange
 from core.misc import script_failed
 from pathlib import Path
 from core.misc import get_config
+from engine.wfs import Wfs
+from engine.pipeline import BATCH_SIZE
+from engine.storage import IntermediateSink
+from engine.stream import FeatureStream
+from engine.archives import Archive
 
 
 class Input_Reader:
     logger = get_logger()
 
-    def wfs(uri):
+    def wfs(uri, paged: bool = False, page_size: int = 1000, workers: int = 4, retries: int = 3):
         """
         A function that reads a WFS service.
+        With paged set to True, the number of features is requested from the server, and the features are downloaded in
+        pages of page_size features, with up to workers pages downloaded at the same time. GeoJSON is requested when the server
+        advertises it. Services that do not support paging, and uris with sql, authcfg or QGIS expression filters, are read with the WFS provider.
 
         Args:
             uri (string): The uri can be a HTTP url to a WFS server (http://foobar/wfs?TYPENAME=xxx&SRSNAME=yyy[&FILTER=zzz) or a URI constructed using the QgsDataSourceURI class with the following parameters: - url=string (mandatory): HTTP url to a WFS server endpoint. e.g http://foobar/wfs - typename=string (mandatory): WFS typename - srsname=string (recommended): SRS like ‘EPSG:XXXX’ - username=string - password=string - authcfg=string - version=auto/1.0.0/1.1.0/2.0.0 -sql=string: full SELECT SQL statement with optional WHERE, ORDER BY and possibly with JOIN if supported on server - filter=string: QGIS expression or OGC/FES filter - restrictToRequestBBOX=1: to download only features in the view extent (or more generally in the bounding box of the feature iterator) - maxNumFeatures=number - IgnoreAxisOrientation=1: to ignore EPSG axis order for WFS 1.1 or 2.0 - InvertAxisOrientation=1: to invert axis order - hideDownloadProgressDialog=1: to hide the download progress dialog
+            paged (boolean): Defaults to False. Download the features in concurrent pages.
+            page_size (integer): Defaults to 1000. Number of features in each page.
+            workers (integer): Defaults to 4. Number of pages downloaded at the same time.
+            retries (integer): Defaults to 3. Number of retries for a failing page.
 
         Returns:
             layer (QgsVectorLayer): A QgsVectorLayer object containing data from the WFS service.
@@ -24,6 +36,11 @@ class Input_Reader:
               
         try:
             logger.info(f'Reading WFS layer: {uri}')
+            if paged:
+                layer = Wfs.download(uri, page_size, workers, retries)
+                if layer is not None:
+                    logger.info("Finished reading the WFS service")
+                    return layer
             layer = QgsVectorLayer(uri, "WFS_Layer" , 'WFS')
             logger.info("Finished reading the WFS service")
             return layer
@@ -79,7 +96,8 @@ class Input_Reader:
 
     def fileBasedDB(file, layername, format):
 
-        if Path(file).exists() == False:
+        ## Paths into archives from Worker.File.archive_lister are checked by GDAL when the layer is opened
+        if not str(file).startswith('/vsi') and Path(file).exists() == False:
             logger.error(f'{file} does not exist')
             script_failed()
         
@@ -87,6 +105,8 @@ class Input_Reader:
         try:
             uri = f'{file}|layername={layername}'
             layer = QgsVectorLayer(uri, f'QgsLayer_{str(randrange(1000))}', 'ogr')
+            if str(file).startswith('/vsi') and not layer.isValid():
+                raise IOError(f'Could not open {uri}')
             logger.info(f'Finished reading {format}')
             return layer
         except Exception as error:
@@ -110,6 +130,81 @@ class Input_Reader:
         layer = Input_Reader.fileBasedDB(file, layername, 'Geopackage')
         return layer
 
+    def archive(archive: str, member: str, layername: str = None):
+        """
+        Reads a vector dataset from a zip, tar, tar.gz or tgz archive in place, without extracting it,
+        through the GDAL virtual file systems /vsizip/ and /vsitar/.
+
+        Args:
+            archive (string): The path to the archive
+            member (string): The path of the dataset inside the archive, or a pattern matching exactly one dataset, e.g. '*/roads.geojson'.
+                             Use Worker.File.archive_lister to read more than one dataset from an archive.
+            layername (string): The layer to read from a dataset holding more than one layer, e.g. a geopackage
+
+        Returns:
+            layer (QgsVectorLayer): A QgsVectorLayer object containing the data from the archive member.
+        """
+
+        logger.info(f'Reading {member} from archive {archive}')
+        try:
+            if Path(archive).exists() == False:
+                raise FileNotFoundError(f'{archive} does not exist')
+            matches = Archive.match(archive, member)
+            if len(matches) == 0:
+                raise FileNotFoundError(f'No vector dataset in the archive matches {member}')
+            if len(matches) > 1:
+                raise ValueError(f'{len(matches)} datasets in the archive match {member}: {matches}')
+            uri = Archive.vsi_path(archive, matches[0])
+            if layername:
+                uri = f'{uri}|layername={layername}'
+            layer = QgsVectorLayer(uri, f'QgsLayer_{str(randrange(1000))}', 'ogr')
+            if not layer.isValid():
+                raise IOError(f'Could not read {uri}')
+            logger.info(f'Finished reading {matches[0]}, {layer.featureCount()} features')
+            return layer
+        except Exception as error:
+            logger.error(f'An error occured reading {member} from archive {archive}')
+            logger.error(f'{type(error).__name__}  –  {str(error)}')
+            logger.critical("Program terminated")
+            script_failed()
+
+    def stream(source, layername: str = None, batch_size: int = BATCH_SIZE, fields: list = None, bbox=None, no_geometry: bool = False):
+        """
+        Opens a data source as a stream of feature batches instead of a layer, for data sets bigger than memory.
+        Only one batch is held in memory at a time. Output_Writer.file, geopackage, postgis and mssql accept the stream
+        in place of a layer, and write it batch by batch. The workers need a layer, and do not accept a stream.
+
+        Args:
+            source (string or QgsVectorLayer): The path to a file, e.g. a shapefile or a geopackage, or an opened layer, e.g. from Input_Reader.postGIS
+            layername (string): The layer to read from a file holding more than one layer, e.g. a geopackage
+            batch_size (integer): Defaults to 10000. Number of features in each batch
+            fields (list): The names of the fields to read. Defaults to all fields
+            bbox (list or QgsRectangle): Bounding box [xmin, ymin, xmax, ymax] in the coordinate system of the source. Only features intersecting it are read
+            no_geometry (boolean): Defaults to False. Skip reading the geometries
+
+        Returns:
+            stream (FeatureStream): The stream. Iterating it yields lists of up to batch_size QgsFeatures
+        """
+
+        try:
+            if isinstance(source, QgsVectorLayer):
+                layer = source
+            else:
+                if not str(source).startswith('/vsi') and Path(source).exists() == False:
+                    raise FileNotFoundError(f'{source} does not exist')
+                uri = f'{source}|layername={layername}' if layername else source
+                layer = QgsVectorLayer(uri, f'QgsLayer_{str(randrange(1000))}', 'ogr')
+            if not layer.isValid():
+                raise IOError(f'Could not open {layer.source()}')
+            stream = FeatureStream(layer, batch_size, fields, bbox, no_geometry)
+            logger.info(f'Streaming {layer.source()} in batches of {batch_size} features')
+            return stream
+        except Exception as error:
+            logger.error(f'An error occured opening the stream {source}')
+            logger.error(f'{type(error).__name__}  –  {str(error)}')
+            logger.critical("Program terminated")
+            script_failed()
+
     def filegdb(file, layername):
         """
         A function that read a layer from an ESRI File Geodatabase using the OpenFileGDB driver.
@@ -124,7 +219,7 @@ class Input_Reader:
         layer = Input_Reader.fileBasedDB(file, layername, 'ESRI File Geodatabase')
         return layer
 
-    def postGIS(connection, dbname, schema, table, geometryname='geom'):
+    def postGIS(connection, dbname, schema, table, geometryname='geom', where=None, bbox=None, aoi_layer=None, fields=None):
         """        
         A function that reads a layer from a PostGIS database
 
@@ -134,14 +229,18 @@ class Input_Reader:
             schema (string): schema name
             table (string): table name
             geometryname (string,optional): name of geometry column. defaults to "geom"
+            where (string, optional): SQL where clause evaluated by the database, e.g. "kommunekode = '0101'"
+            bbox (list or QgsRectangle, optional): Bounding box [xmin, ymin, xmax, ymax] in the coordinate system of the table. Only features intersecting it are read.
+            aoi_layer (QgsVectorLayer, optional): A layer whose extent is used as bbox
+            fields (list, optional): The names of the fields to read. Defaults to all fields.
 
         Returns:
             A QgsVectorLayer object containing data from the postgis database
         """
-        layer = Input_Reader.sqlDB('Postgres', connection, dbname, schema, table, geometryname)
+        layer = Input_Reader.sqlDB('Postgres', connection, dbname, schema, table, geometryname, where, bbox, aoi_layer, fields)
         return layer
     
-    def mssql(connection, dbname, schema, table, geometryname='Geometri'):
+    def mssql(connection, dbname, schema, table, geometryname='Geometri', where=None, bbox=None, aoi_layer=None, fields=None):
         """        
         A function that reads a layer from a MSSQL database
 
@@ -151,16 +250,22 @@ class Input_Reader:
             schema (string): schema name
             table (string): table name
             geometryname (string,optional): name of geometry column. defaults to "geom"
+            where (string, optional): SQL where clause evaluated by the database, e.g. "kommunekode = '0101'"
+            bbox (list or QgsRectangle, optional): Bounding box [xmin, ymin, xmax, ymax] in the coordinate system of the table. Only features intersecting it are read.
+            aoi_layer (QgsVectorLayer, optional): A layer whose extent is used as bbox
+            fields (list, optional): The names of the fields to read. Defaults to all fields.
 
         Returns:
             A QgsVectorLayer object containing data from the postgis database
         """
-        layer = Input_Reader.sqlDB('MSSQL', connection, dbname, schema, table, geometryname)
+        layer = Input_Reader.sqlDB('MSSQL', connection, dbname, schema, table, geometryname, where, bbox, aoi_layer, fields)
         return layer
 
-    def sqlDB(db_type, connection, dbname, schema, table, geometryname="geom"):
+    def sqlDB(db_type, connection, dbname, schema, table, geometryname="geom", where=None, bbox=None, aoi_layer=None, fields=None):
         """        
-        A function that reads a layer from a SQL database
+        A function that reads a layer from a SQL database.
+        The where clause is added to the SQL of the provider, and the bbox and the field list are passed to the provider
+        as a filter rectangle and a subset of attributes, so only the needed rows and columns are read from the database.
 
         Args:
             db_type (string): Type of SQL database. Postgres and MSSQL supported.
@@ -169,6 +274,10 @@ class Input_Reader:
             schema (string): schema name
             table (string): table name
             geometryname (string,optional): name of geometry column. defaults to "geom"
+            where (string, optional): SQL where clause evaluated by the database, e.g. "kommunekode = '0101'"
+            bbox (list or QgsRectangle, optional): Bounding box [xmin, ymin, xmax, ymax] in the coordinate system of the table. Only features intersecting it are read.
+            aoi_layer (QgsVectorLayer, optional): A layer whose extent is used as bbox
+            fields (list, optional): The names of the fields to read. Defaults to all fields.
 
         Returns:
             A QgsVectorLayer object containing data from the postgis database
@@ -186,6 +295,8 @@ class Input_Reader:
             uri.setDataSource(schema, table, geometryname)
 
             layer = QgsVectorLayer(uri.uri(False), "layer", f"{db_type.lower()}")
+            if where or bbox is not None or aoi_layer is not None or fields:
+                layer = Input_Reader.pushdown(layer, where, bbox, aoi_layer, fields)
             
             logger.info(f'Import from {db_type} completed')
             if layerHasFeatures(layer):
@@ -197,3 +308,71 @@ class Input_Reader:
             logger.error(f'{type(error).__name__}  –  {str(error)}')
             logger.critical("Program terminated")
             script_failed()
+
+    def pushdown(layer, where=None, bbox=None, aoi_layer=None, fields=None):
+        """
+        Reads the rows and columns of a database layer that match a where clause, a bounding box and a list of fields.
+        The where clause is set as the subset string of the provider. The bounding box and the fields are read through
+        a feature request, which the provider translates to a spatial filter and a column list in its SELECT.
+
+        Args:
+            layer (QgsVectorLayer): The database layer
+            where (string): SQL where clause
+            bbox (list or QgsRectangle): Bounding box in the coordinate system of the layer
+            aoi_layer (QgsVectorLayer): A layer whose extent is used as bbox
+            fields (list): The names of the fields to read
+
+        Returns:
+            layer (QgsVectorLayer): The filtered layer
+        """
+
+        if where:
+            if not layer.setSubsetString(where):
+                raise ValueError(f'Invalid where clause: {where}')
+            logger.info(f'Where clause pushed to the database: {where}')
+        if bbox is None and aoi_layer is None and not fields:
+            ## Counting the rows would be another query on the server, the rows are counted when they are read
+            return layer
+
+        request = QgsFeatureRequest()
+        if aoi_layer is not None:
+            bbox = aoi_layer.extent()
+            if aoi_layer.crs() != layer.crs():
+                transform = QgsCoordinateTransform(aoi_layer.crs(), layer.crs(), QgsProject.instance())
+                bbox = transform.transformBoundingBox(bbox)
+        if bbox is not None:
+            if not isinstance(bbox, QgsRectangle):
+                bbox = QgsRectangle(*bbox)
+            request.setFilterRect(bbox)
+            logger.info(f'Bounding box pushed to the database: {bbox.toString(2)}')
+
+        output = QgsFields()
+        if fields:
+            missing = [name for name in fields if layer.fields().lookupField(name) == -1]
+            if missing:
+                raise KeyError(f'Fields {missing} do not exist in the table')
+            for name in fields:
+                output.append(layer.fields().field(name))
+            request.setSubsetOfAttributes(fields, layer.fields())
+            logger.info(f'Column list pushed to the database: {", ".join(fields)}')
+        else:
+            output = layer.fields()
+        indexes = [layer.fields().lookupField(field.name()) for field in output]
+
+        sink = IntermediateSink('layer', output, layer.wkbType(), layer.crs(), [layer])
+        batch = []
+        fetched = 0
+        for feature in layer.getFeatures(request):
+            result = QgsFeature(output)
+            result.setGeometry(feature.geometry())
+            attributes = feature.attributes()
+            result.setAttributes([attributes[index] for index in indexes])
+            batch.append(result)
+            fetched += 1
+            if len(batch) >= BATCH_SIZE:
+                sink.addFeatures(batch)
+                batch = []
+        if batch:
+            sink.addFeatures(batch)
+        logger.info(f'Pushdown filtered the table on the server, fetched {fetched} rows and {output.count()} of {layer.fields().count()} columns')
+        return sink.finish()
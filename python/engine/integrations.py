@@ -4,11 +4,14 @@ import sys
 import shutil
 from core.misc import get_config, create_tempfile, delete_tempfile
 from qgis.analysis import QgsNativeAlgorithms
-from qgis.core import QgsCoordinateReferenceSystem, QgsVectorLayer, QgsVectorFileWriter, QgsProject, QgsFeatureRequest, QgsProcessingContext
+from qgis.core import QgsCoordinateReferenceSystem, QgsVectorLayer, QgsVectorFileWriter, QgsProject, QgsFeatureRequest, QgsProcessingContext, QgsFeature, QgsField, QgsFields, QgsGeometry, QgsWkbTypes
 from qgis import processing
 from random import randrange
-import geopandas as gpd
+from qgis.PyQt.QtCore import QVariant, QDate, QDateTime, QTime
 from core.misc import script_failed
+from engine.pipeline import resolve
+from engine.storage import IntermediateSink
+from datetime import date, datetime
 import time
 
 
@@ -19,25 +22,65 @@ class Integrations:
     ## Geopandas import / export
     ## ##################################
 
-    def to_geopandas_df(layer: str):
+    def to_geopandas_df(layer: str, fields: list = None, geometry: bool = True, batch_size: int = 100000, method: str = 'direct'):
         """
-        Convert a QGIS layer to a Geopandas dataframe for further processing
+        Convert a QGIS layer to a Geopandas dataframe for further processing.
+        By default the dataframe is built in memory, reading geometries as WKB and attributes in column batches from the layer.
 
         Args:
             layer (string): The QGIS layer to be converted to dataframe
+            fields (list of strings): Only convert these fields. Defaults to None, converting all fields.
+            geometry (boolean): Read the geometries. If False, a pandas dataframe without geometry is returned. Defaults to True.
+            batch_size (integer): Number of features converted in each batch. Defaults to 100000.
+            method (string): 'direct' for the in memory conversion, or 'file' to convert through a temporary FlatGeobuf file. Defaults to 'direct'.
 
         Returns:
             dataframe (dataframe): The GeoPandas dataframe from the input layer
         """
 
+        import geopandas as gpd
+        import pandas as pd
+        layer = resolve(layer)
         logger.info(f'Creating Geopandas dataframe from layer  {str(layer)}')
         config = get_config()
         try:
-            tmp_path = create_tempfile(layer, 'to_dataframe')
-            logger.info('Creating dataframe')
-            df = gpd.read_file(tmp_path)
-            logger.info('Dataframe creation finished')
-            delete_tempfile(tmp_path)
+            if method == 'file':
+                tmp_path = create_tempfile(layer, 'to_dataframe')
+                logger.info('Creating dataframe')
+                df = gpd.read_file(tmp_path)
+                logger.info('Dataframe creation finished')
+                delete_tempfile(tmp_path)
+                return df
+
+            names = fields if fields is not None else layer.fields().names()
+            indexes = [layer.fields().lookupField(name) for name in names]
+            for name, index in zip(names, indexes):
+                if index == -1:
+                    raise KeyError(f'Field {name} does not exist')
+            request = QgsFeatureRequest()
+            request.setSubsetOfAttributes(indexes)
+            if not geometry:
+                request.setFlags(QgsFeatureRequest.NoGeometry)
+
+            logger.info(f'Creating dataframe, {len(names)} fields, geometry: {geometry}')
+            crs = layer.crs().authid() or layer.crs().toWkt() or None
+            frames = []
+            columns = [[] for name in names]
+            wkbs = []
+            for feature in layer.getFeatures(request):
+                attributes = feature.attributes()
+                for column, index in zip(columns, indexes):
+                    column.append(Integrations.python_value(attributes[index]))
+                if geometry:
+                    wkbs.append(bytes(feature.geometry().asWkb()) if feature.hasGeometry() else None)
+                if len(columns[0] if columns else wkbs) >= batch_size:
+                    frames.append(Integrations.dataframe_batch(names, columns, wkbs, geometry, crs))
+                    columns = [[] for name in names]
+                    wkbs = []
+            frames.append(Integrations.dataframe_batch(names, columns, wkbs, geometry, crs))
+
+            df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+            logger.info(f'Dataframe creation finished, {len(df)} rows')
             return df
 
         except Exception as error:
@@ -46,12 +89,35 @@ class Integrations:
             logger.critical("Program terminated")
             script_failed()
 
-    def from_geopandas_df(dataframe: str):
+    def dataframe_batch(names: list, columns: list, wkbs: list, geometry: bool, crs: str):
+        import geopandas as gpd
+        import pandas as pd
+        frame = pd.DataFrame(dict(zip(names, columns)), columns=names)
+        if not geometry:
+            return frame
+        return gpd.GeoDataFrame(frame, geometry=gpd.GeoSeries.from_wkb(wkbs, crs=crs), crs=crs)
+
+    def python_value(value):
+        ## Converting the Qt types returned by QGIS to python types understood by pandas
+        if isinstance(value, QVariant):
+            return None if value.isNull() else value.value()
+        if isinstance(value, QDateTime):
+            return value.toPyDateTime() if value.isValid() else None
+        if isinstance(value, QDate):
+            return value.toPyDate() if value.isValid() else None
+        if isinstance(value, QTime):
+            return value.toPyTime() if value.isValid() else None
+        return value
+
+    def from_geopandas_df(dataframe: str, batch_size: int = 50000, method: str = 'direct'):
         """
-        Convert a  a Geopandas dataframe ton QGIS layer
+        Convert a  a Geopandas dataframe ton QGIS layer.
+        By default the layer is built directly from the WKB and column arrays of the dataframe, adding the features in batches.
 
         Args:
             dataframe (dataframe): The dataframe to be converted to QGIS layer
+            batch_size (integer): Number of features added to the layer in each batch. Defaults to 50000.
+            method (string): 'direct' for the in memory conversion, or 'file' to convert through a temporary FlatGeobuf file. Defaults to 'direct'.
 
         Returns
             dataframe (dataframe): The QGIS layer from the input dataframe
@@ -60,28 +126,46 @@ class Integrations:
         logger.info(f'Creating layer from Geopandas dataframe ')
         config = get_config()
         try:
-            logger.info(f'Creating temporary layer in Temp folder')
-            tmp_path = f'{config["TempFolder"]}Q-ETL_from_dataframe_{str(randrange(1000))}.fgb'
-            dataframe.to_file(tmp_path, driver='FlatGeobuf')
-            logger.info('Temporary layer created')
-
-            logger.info('Creating QGIS layer')
-            tmp_layer =  QgsVectorLayer(tmp_path, f'QgsLayer_ {str(randrange(1000))}', "ogr")
-            #layer = tmp_layer.materialize(QgsFeatureRequest().setFilterFids(tmp_layer.allFeatureIds()))
-
-            tmp_layer.selectAll()
-            
-            context  = QgsProcessingContext()
-            layer = processing.run("native:saveselectedfeatures", {'INPUT': tmp_layer, 'OUTPUT': 'memory:'}, context=context)['OUTPUT']
-            layer.removeSelection()
-            try:
-                QgsProject.instance().removeMapLayer(tmp_layer.id())
-                context.temporaryLayerStore().removeAllMapLayers()   
-                tmp_layer = None
-                del tmp_layer, dataframe
-                os.remove(tmp_path)
-            except:
-                logger.info('Could not delete temporary layer - manual cleanup is required')
+            if method == 'file':
+                return Integrations.from_geopandas_file(dataframe)
+
+            names = [name for name in dataframe.columns if name != dataframe.geometry.name]
+            fields = QgsFields()
+            for name in names:
+                fields.append(QgsField(str(name), Integrations.field_type(dataframe[name])))
+
+            geometries = dataframe.geometry
+            types = geometries.geom_type.dropna().unique()
+            if len(types) == 0:
+                wkbType = QgsWkbTypes.NoGeometry
+            else:
+                wkbType = QgsWkbTypes.parseType(types[0])
+                if len(types) > 1:
+                    wkbType = QgsWkbTypes.multiType(wkbType)
+                if geometries.has_z.any():
+                    wkbType = QgsWkbTypes.addZ(wkbType)
+
+            crs = QgsCoordinateReferenceSystem()
+            if dataframe.crs is not None:
+                crs = QgsCoordinateReferenceSystem(dataframe.crs.to_wkt())
+
+            logger.info(f'Creating QGIS layer, {len(dataframe)} rows, {len(names)} fields, geometry type {QgsWkbTypes.displayString(wkbType)}')
+            sink = IntermediateSink('from_dataframe', fields, wkbType, crs, [])
+            for offset in range(0, len(dataframe), batch_size):
+                chunk = dataframe.iloc[offset:offset + batch_size]
+                wkbs = chunk.geometry.to_wkb().tolist()
+                columns = [Integrations.qgis_values(chunk[name]) for name in names]
+                features = []
+                for row, wkb in enumerate(wkbs):
+                    feature = QgsFeature(fields)
+                    if wkb is not None:
+                        geometry = QgsGeometry()
+                        geometry.fromWkb(wkb)
+                        feature.setGeometry(geometry)
+                    feature.setAttributes([column[row] for column in columns])
+                    features.append(feature)
+                sink.addFeatures(features)
+            layer = sink.finish()
 
             logger.info('Layer creation finished')
             return layer
@@ -90,4 +174,62 @@ class Integrations:
             logger.error("An error occured exporting layer to Pandas dataframe")
             logger.error(f'{type(error).__name__}  –  {str(error)}')
             logger.critical("Program terminated")
-            script_failed()
\ No newline at end of file
+            script_failed()
+
+    def from_geopandas_file(dataframe: str):
+        config = get_config()
+        logger.info(f'Creating temporary layer in Temp folder')
+        tmp_path = f'{config["TempFolder"]}Q-ETL_from_dataframe_{str(randrange(1000))}.fgb'
+        dataframe.to_file(tmp_path, driver='FlatGeobuf')
+        logger.info('Temporary layer created')
+
+        logger.info('Creating QGIS layer')
+        tmp_layer =  QgsVectorLayer(tmp_path, f'QgsLayer_ {str(randrange(1000))}', "ogr")
+        #layer = tmp_layer.materialize(QgsFeatureRequest().setFilterFids(tmp_layer.allFeatureIds()))
+
+        tmp_layer.selectAll()
+        
+        context  = QgsProcessingContext()
+        layer = processing.run("native:saveselectedfeatures", {'INPUT': tmp_layer, 'OUTPUT': 'memory:'}, context=context)['OUTPUT']
+        layer.removeSelection()
+        try:
+            QgsProject.instance().removeMapLayer(tmp_layer.id())
+            context.temporaryLayerStore().removeAllMapLayers()   
+            tmp_layer = None
+            del tmp_layer, dataframe
+            os.remove(tmp_path)
+        except:
+            logger.info('Could not delete temporary layer - manual cleanup is required')
+
+        logger.info('Layer creation finished')
+        return layer
+
+    def field_type(column):
+        ## Mapping a pandas column to a QGIS field type
+        import pandas as pd
+        if pd.api.types.is_bool_dtype(column):
+            return QVariant.Bool
+        if pd.api.types.is_integer_dtype(column):
+            return QVariant.LongLong
+        if pd.api.types.is_float_dtype(column):
+            return QVariant.Double
+        if pd.api.types.is_datetime64_any_dtype(column):
+            return QVariant.DateTime
+        values = column.dropna()
+        if len(values) > 0:
+            first = values.iloc[0]
+            if isinstance(first, datetime):
+                return QVariant.DateTime
+            if isinstance(first, date):
+                return QVariant.Date
+        return QVariant.String
+
+    def qgis_values(column):
+        ## Converting a pandas column to a list of values QGIS accepts, with None for missing values
+        import pandas as pd
+        if pd.api.types.is_datetime64_any_dtype(column):
+            return [QDateTime(value.to_pydatetime()) if not pd.isna(value) else None for value in column]
+        values = column.astype(object).where(column.notna(), None).tolist()
+        if pd.api.types.is_object_dtype(column):
+            return [value if value is None or isinstance(value, (str, int, float, bool, date)) else str(value) for value in values]
+        return values
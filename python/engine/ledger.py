@@ -0,0 +1,102 @@
+from core.logger import *
+from core.misc import get_config, read_jobrun, is_worker_process
+from core.db import record_step
+from core.profiler import Profiler
+import time
+import functools
+from datetime import datetime
+from qgis.core import QgsVectorLayer
+
+
+class Ledger:
+    '''
+    Records each call of a Worker, Input_Reader and Output_Writer method in the steps table of the internal DB,
+    with the processing algorithms it ran, feature counts, wall time, CPU time, change in memory use and peak memory.
+    Only the outermost call is recorded, methods called by another method are part of its step.
+    '''
+
+    depth = 0
+    algorithms = []
+    position = 0
+    run_id = None
+
+    def enabled():
+        return bool(get_config().get('StepLedger', True))
+
+    def instrument(cls, prefix: str):
+        """
+        Wraps the public methods of a class, so each call is recorded as a step.
+
+        Args:
+            cls (class): The class holding the methods, e.g. Worker.Vector
+            prefix (string): The prefix of the step names, e.g. 'Worker.Vector'
+        """
+
+        for name, member in list(vars(cls).items()):
+            if name.startswith('_') or not callable(member) or isinstance(member, type) or getattr(member, 'ledger_step', False):
+                continue
+            setattr(cls, name, Ledger.step(f'{prefix}.{name}', member))
+
+    def step(name: str, function):
+        @functools.wraps(function)
+        def recorded(*args, **kwargs):
+            ## Batch and parallel worker processes share the job run of their parent, which records the steps
+            if Ledger.depth > 0 or is_worker_process() or not Ledger.enabled():
+                return function(*args, **kwargs)
+
+            Ledger.depth += 1
+            Ledger.algorithms = []
+            now = datetime.now()
+            Profiler.step_start()
+            rss = Ledger.rss()
+            cpu = time.process_time()
+            start = time.perf_counter()
+            result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            finally:
+                wall_time = time.perf_counter() - start
+                cpu_time = time.process_time() - cpu
+                Ledger.depth -= 1
+                try:
+                    rss_delta = (Ledger.rss() - rss) / 1024**2 if rss is not None else None
+                    peak_memory = Profiler.step_peak()
+                    if peak_memory is not None:
+                        logger.info(f'Step {name} took {round(wall_time, 2)} s, peak memory {round(peak_memory)} MB')
+                    Ledger.record(name, Ledger.features(list(args) + list(kwargs.values())), Ledger.features([result]), wall_time, cpu_time, rss_delta, peak_memory, now)
+                except Exception as error:
+                    logger.info(f'Unable to record step {name}: {type(error).__name__}  –  {str(error)}')
+        recorded.ledger_step = True
+        return recorded
+
+    def algorithm(algorithm: str):
+        ## Called by run_algorithm, adding the algorithm to the running step
+        if Ledger.depth > 0:
+            Ledger.algorithms.append(algorithm)
+
+    def features(values: list):
+        ## Counts the features of the layers among the values. Lazy layers are not counted, as that would execute their plan
+        count = None
+        for value in values:
+            for layer in (value if isinstance(value, (list, tuple)) else [value]):
+                if isinstance(layer, QgsVectorLayer):
+                    count = (count or 0) + max(layer.featureCount(), 0)
+        return count
+
+    def rss():
+        try:
+            import psutil
+            return psutil.Process().memory_info().rss
+        except ImportError:
+            return None
+
+    def record(name, input_features, output_features, wall_time, cpu_time, rss_delta, peak_memory, now):
+        run_id = int(read_jobrun()['id'])
+        if run_id != Ledger.run_id:
+            Ledger.run_id = run_id
+            Ledger.position = 0
+        Ledger.position += 1
+        record_step(run_id, Ledger.position, name, ','.join(Ledger.algorithms), input_features, output_features,
+                    round(wall_time, 4), round(cpu_time, 4), round(rss_delta, 2) if rss_delta is not None else None,
+                    round(peak_memory, 2) if peak_memory is not None else None, now)
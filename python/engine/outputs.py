@@ -5,6 +5,9 @@ import subprocess
 from random import randrange
 from qgis.core import QgsVectorFileWriter, QgsVectorLayerExporter, QgsProject, QgsVectorLayer
 from core.misc import script_failed, create_tempfile, delete_tempfile
+from engine.pipeline import run_algorithm, resolve
+from engine.databases import Postgres, Mssql
+from engine.stream import FeatureStream, write_stream
 
 import processing
 from processing.core.Processing import Processing
@@ -12,6 +15,10 @@ from processing.script.ScriptUtils import *
 from qgis.analysis import QgsNativeAlgorithms
 Processing.initialize()
 
+## The loaders of the database writers
+POSTGIS_METHODS = ('ogr2ogr', 'copy', 'upsert')
+MSSQL_METHODS = ('ogr2ogr', 'bulk')
+
 class Output_Writer:
 
     logger = get_logger()
@@ -25,6 +32,8 @@ class Output_Writer:
             path (string): the ouput file to be created.
         """
 
+        layer = resolve(layer)
+
         if layerHasFeatures(layer):
             logger.info(f'Writing {str(layer.featureCount())} features to Excel : {path}')
         try:
@@ -32,7 +41,7 @@ class Output_Writer:
                     'USE_ALIAS': True,
                     'FORMATTED_VALUES': False,
                     'OUTPUT': path}
-            processing.run("native:exporttospreadsheet", parameter)
+            run_algorithm("native:exporttospreadsheet", parameter)
             logger.info(f'Parameters: {str(parameter)}')
             logger.info("Export to Excel completed")
         except Exception as error:
@@ -42,9 +51,13 @@ class Output_Writer:
             script_failed()
 
 
-    def postgis(layer: QgsVectorLayer, connection : str, dbname: str, schema: str, tablename: str, overwrite: bool = True):
+    def postgis(layer: QgsVectorLayer, connection : str, dbname: str, schema: str, tablename: str, overwrite: bool = True, method: str = 'ogr2ogr', key: str = None):
         """
         A function that exports a QgsVectorLayer into a Postgis database.
+        With method 'copy' the features are streamed into the table with COPY over a psycopg2 connection,
+        without the temporary file and the ogr2ogr process. New tables get the same layout as with ogr2ogr.
+        With method 'upsert' only the changes are applied to the table in one transaction: rows are matched on the key field,
+        and compared with a hash of their attributes and geometry stored in a qetl_hash column. Rows missing from the layer are deleted.
 
         Args:
             layer (QgsVectorLayer): The QgsVectorLayer to be exported into Postgis
@@ -53,10 +66,56 @@ class Output_Writer:
             schema (string): Schema name
             tablename (string): The name of the table that will be imported
             overwrite (boolean): Defaults to True. Should the resulting table in Postgis be overwritten if it exists. If set to False, then it will append the data.
+            method (string): Defaults to 'ogr2ogr'. The loader to use, 'ogr2ogr', 'copy' or 'upsert'.
+            key (string): The field identifying a row, required by the 'upsert' method. Overwrite is ignored by 'upsert'.
+
+        A FeatureStream from Input_Reader.stream can be written in place of the layer, with the 'copy' or 'upsert' method.
         """
 
-        if layerHasFeatures(layer):
+        try:
+            if method not in POSTGIS_METHODS:
+                raise ValueError(f'Unknown method {method}, use one of {", ".join(POSTGIS_METHODS)}')
+            if method == 'upsert' and not key:
+                raise ValueError("The 'upsert' method needs the key field")
+        except Exception as error:
+            logger.error("An error occured exporting to Postgis")
+            logger.error(f'{type(error).__name__}  –  {str(error)}')
+            logger.critical("Program terminated")
+            script_failed()
+        layer = resolve(layer)
+
+        if isinstance(layer, FeatureStream) and method == 'ogr2ogr':
+            logger.info('Streams are written with COPY, as ogr2ogr needs a temporary file of the whole layer')
+            method = 'copy'
+
+        ## A filtered stream does not know its number of features before it is read
+        if not isinstance(layer, FeatureStream) and layerHasFeatures(layer):
             logger.info(f'Exporting {str(layer.featureCount())} features to Postgis')
+
+        if method == 'copy':
+            try:
+                logger.info(f'Writing to PostGIS database {dbname} using COPY')
+                rows = Postgres.load(layer, connection, dbname, schema, tablename, overwrite)
+                logger.info(f'Export to PostGIS completed, {rows} rows written')
+            except Exception as error:
+                logger.error("An error occured exporting to Postgis")
+                logger.error(f'{type(error).__name__}  –  {str(error)}')
+                logger.critical("Program terminated")
+                script_failed()
+            return
+
+        if method == 'upsert':
+            try:
+                logger.info(f'Applying changes to {schema}.{tablename} in PostGIS database {dbname}, matching on {key}')
+                counts = Postgres.upsert(layer, connection, dbname, schema, tablename, key)
+                logger.info(f'Export to PostGIS completed, {counts["inserted"] + counts["updated"]} rows written, {counts["deleted"]} deleted')
+            except Exception as error:
+                logger.error("An error occured exporting to Postgis")
+                logger.error(f'{type(error).__name__}  –  {str(error)}')
+                logger.critical("Program terminated")
+                script_failed()
+            return
+
         tempfile = create_tempfile(layer, 'postgis')
         logger.info('Temporary layer created')
 
@@ -91,8 +150,24 @@ class Output_Writer:
             layername (string): The name of the layer in the geopackage file
             geopackage (string): The full path for the geopackage to be created
             overwrite (boolean): Specify wheather the writer will overwrite existing geopackage or append layer. Boolean True/False
+
+        A FeatureStream from Input_Reader.stream can be written in place of the layer, one batch at a time.
         """
 
+        layer = resolve(layer)
+
+        if isinstance(layer, FeatureStream):
+            try:
+                logger.info(f'Writing {layer} to geopackage : {geopackage}')
+                write_stream(layer, geopackage, 'GPKG', layername, overwrite or not os.path.isfile(geopackage))
+                logger.info("Export to Geopackage completed")
+            except Exception as error:
+                logger.error("An error occured exporting layer to geopackage")
+                logger.error(f'{type(error).__name__}  –  {str(error)}')
+                logger.critical("Program terminated")
+                script_failed()
+            return
+
         if layerHasFeatures(layer):
             logger.info(f'Writing {str(layer.featureCount())} features to geopackage : {geopackage}')
         try:
@@ -103,7 +178,7 @@ class Output_Writer:
                     'SAVE_STYLES': False,
                     'SAVE_METADATA': False,
                     'SELECTED_FEATURES_ONLY': False}
-            processing.run("native:package", parameter)
+            run_algorithm("native:package", parameter)
             logger.info(f'Parameters: {str(parameter)}')
             logger.info("Export to Geopackage completed")
         except Exception as error:
@@ -123,6 +198,8 @@ class Output_Writer:
             geopackage (string): The full path for the geopackage to be created
         """
 
+        layer = resolve(layer)
+
         logger.info("Running append layer to Geopackage")
         if os.path.isfile(geopackage):
             logger.info(f'Geopackage {geopackage} exists, appending layer')
@@ -158,8 +235,24 @@ class Output_Writer:
             layer (QgsVectorLayer): The QgsVectorLayer that is to be written to a file
             path (string): The full path for the file to be created
             format (string): The driver type used to write the data to the file. 
+
+        A FeatureStream from Input_Reader.stream can be written in place of the layer, one batch at a time.
         """
 
+        layer = resolve(layer)
+
+        if isinstance(layer, FeatureStream):
+            try:
+                logger.info(f'Writing {layer} to: {path}')
+                write_stream(layer, path, format)
+                logger.info("Export completed")
+            except Exception as error:
+                logger.error("An error occured exporting layer")
+                logger.error(f'{type(error).__name__}  –  {str(error)}')
+                logger.critical("Program terminated")
+                script_failed()
+            return
+
         if layerHasFeatures(layer):
             logger.info(f'Writing {str(layer.featureCount())} features to: {path}')
         try:
@@ -197,10 +290,12 @@ class Output_Writer:
             logger.critical("Program terminated")
             script_failed()
 
-    def mssql(layer: QgsVectorLayer, connection: str, driver: str, schema: str, table: str, overwrite: str, geom_type: str, geom_name: str, ogr2ogr_params: str):
+    def mssql(layer: QgsVectorLayer, connection: str, driver: str, schema: str, table: str, overwrite: str, geom_type: str, geom_name: str, ogr2ogr_params: str, method: str = 'ogr2ogr', batch_size: int = 10000):
         """
         A function that exports a QgsVectorLayer into a MSSQL database using ogr2ogr.
         The function writes the data to a temporary geojson file, that is then importet to the database with ogr2ogr.
+        With method 'bulk' the features are instead inserted in batches over a pyodbc connection using fast_executemany,
+        with WKB geometries and without the temporary file. New tables are created from the fields of the layer.
         
         Args:
             layer (QgsVectorLayer): The QgsVectorLayer that is to be written to a file.
@@ -212,8 +307,38 @@ class Output_Writer:
             geom_type (string): Geometry type. One of geometry/geography.
             geom_name (string): Name of the geometry coloumn.
             ogr2ogr_params (string): Extra parameters for ogr2ogr besides the default.
+            method (string): Defaults to 'ogr2ogr'. The loader to use, 'ogr2ogr' or 'bulk'.
+            batch_size (integer): Defaults to 10000. Number of rows sent to the server in each batch with method 'bulk'.
+
+        A FeatureStream from Input_Reader.stream can be written in place of the layer, with the 'bulk' method.
         """
 
+        try:
+            if method not in MSSQL_METHODS:
+                raise ValueError(f'Unknown method {method}, use one of {", ".join(MSSQL_METHODS)}')
+        except Exception as error:
+            logger.error("An error occured exporting to MSSQL")
+            logger.error(f'{type(error).__name__}  –  {str(error)}')
+            logger.critical("Program terminated")
+            script_failed()
+        layer = resolve(layer)
+
+        if isinstance(layer, FeatureStream) and method == 'ogr2ogr':
+            logger.info('Streams are written with bulk inserts, as ogr2ogr needs a temporary file of the whole layer')
+            method = 'bulk'
+
+        if method == 'bulk':
+            try:
+                logger.info(f'Exporting {layer} to MSSQL Server using bulk insert')
+                rows = Mssql.load(layer, connection, driver, schema, table, overwrite, geom_type, geom_name, batch_size)
+                logger.info(f'Export to MSSQL completed, {rows} rows written')
+            except Exception as error:
+                logger.error("An error occured exporting to MSSQL")
+                logger.error(f'{type(error).__name__}  –  {str(error)}')
+                logger.critical("Program terminated")
+                script_failed()
+            return
+
         try:
             config = get_config()
             logger.info(f'Exporting {layer} to MSSQL Server')
@@ -282,6 +407,8 @@ class Output_Writer:
             layername (string): The name of the resulting layer in the ESRI File Geodatabase
         """
 
+        layer = resolve(layer)
+
         if layerHasFeatures(layer):
             logger.info(f'Writing {str(layer.featureCount())} features to: {path}')
         try:
@@ -309,6 +436,8 @@ class Output_Writer:
             path (string): The full path for the Geopackage to be created
         """
 
+        layers = [resolve(layer) for layer in layers]
+
         logger.info("Performing packageLayers")
         logger.info(f'Processing {str(len(layers))} layers')
         try:
@@ -319,7 +448,7 @@ class Output_Writer:
                 'OUTPUT': path
             }
             logger.info(f'Parameters: {str(parameter)}')
-            processing.run('native:package', parameter)['OUTPUT']           
+            run_algorithm('native:package', parameter)['OUTPUT']           
             logger.info("packageLayers finished")
         except Exception as error:
             logger.error("An error occured in packageLayers")
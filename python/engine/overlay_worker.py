@@ -0,0 +1,29 @@
+## Worker process for the parallel overlay engine in engine/parallel.py.
+## Started as a separate python process with the path to a job file, it loads its own QGIS instance
+## and runs the overlay algorithm on each of the tiles in the job.
+
+import sys, os, json
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['QETL_WORKER'] = '1'
+
+from core import *
+import processing
+import time
+
+with open(sys.argv[1], 'r') as file:
+    job = json.load(file)
+
+for tile in job['tiles']:
+    start = time.time()
+    try:
+        parameter = {
+            'INPUT': tile['input'],
+            'OVERLAY': tile['overlay'],
+            'OUTPUT': tile['output']
+        }
+        processing.run(job['algorithm'], parameter)
+        logger.info(f'{job["algorithm"]} finished on tile {tile["id"]} in {round(time.time() - start, 2)} s')
+    except Exception as error:
+        logger.error(f'An error occured in {job["algorithm"]} on tile {tile["id"]}')
+        logger.error(f'{type(error).__name__}  –  {str(error)}')
+        sys.exit(1)
@@ -0,0 +1,295 @@
+from core.logger import *
+from core.misc import get_config, get_settings_file, get_core_count, script_failed
+import sys, os, json, math
+import subprocess
+import time
+from qgis.core import (
+                       QgsVectorLayer,
+                       QgsFeature,
+                       QgsFields,
+                       QgsRectangle,
+                       QgsWkbTypes,
+                       QgsVectorFileWriter,
+                       QgsCoordinateTransform,
+                       QgsProject,
+                       QgsProcessingUtils)
+from engine.pipeline import resolve, run_algorithm, BATCH_SIZE
+from engine.storage import IntermediateSink, tempfile_path, delete_intermediate
+from engine.constructors import Constructor
+
+## The worker script started for each process in the pool
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'overlay_worker.py')
+
+
+class Parallel:
+    '''
+    Spatially partitioned, multi-process execution of overlay algorithms.
+
+    The input layer is split into tiles from a grid over its bounding box. Every input feature is owned by exactly one tile,
+    the one containing the centre of its bounding box, so features on tile edges are never duplicated. Each tile gets the
+    overlay features intersecting the extent of the features it owns, which keeps the result identical to a single run.
+    The tiles are processed by a pool of python processes, each with its own QGIS instance.
+    '''
+
+    def settings():
+        """
+        Reads the parallel settings from settings.json.
+
+        "Parallel" : {
+            "enabled" : false,         use the parallel engine by default in clip, difference and symmetricaldifference
+            "workers" : 0,             number of processes, 0 uses the number of cores
+            "tiles_per_worker" : 4,    number of tiles per process, more tiles balance uneven data better
+            "min_features" : 50000     smaller input layers are processed in a single run
+        }
+        """
+
+        config = get_config()
+        parallel = {
+            'enabled': False,
+            'workers': 0,
+            'tiles_per_worker': 4,
+            'min_features': 50000
+        }
+        parallel.update(config.get('Parallel', {}))
+        if not parallel['workers']:
+            parallel['workers'] = get_core_count()
+        return parallel
+
+    def enabled(parallel):
+        if parallel is None:
+            return bool(Parallel.settings()['enabled'])
+        return parallel
+
+    def vector_layer(layer, name: str):
+        ## Loads a layer given as a path, like the processing algorithms accept. Anything that is not a valid vector layer
+        ## is returned untouched, and left for the algorithm to handle
+        if isinstance(layer, str):
+            loaded = QgsVectorLayer(layer, name, 'ogr')
+            if loaded.isValid():
+                return loaded
+        return layer
+
+    def overlay(algorithm: str, layer: QgsVectorLayer, overlay: QgsVectorLayer, workers: int = None):
+        """
+        Runs an overlay algorithm (native:clip or native:difference) in parallel over spatial tiles.
+
+        Args:
+            algorithm (string): The processing algorithm, one of 'native:clip' or 'native:difference'
+            layer (QgsVectorLayer): The input layer
+            overlay (QgsVectorLayer): The overlay layer
+            workers (integer): Number of worker processes. Defaults to the settings, or the number of cores.
+
+        Returns:
+            layer (QgsVectorLayer): The result of the algorithm
+        """
+
+        layer = Parallel.vector_layer(resolve(layer), 'input')
+        overlay = Parallel.vector_layer(resolve(overlay), 'overlay')
+        parallel = Parallel.settings()
+        if workers is None:
+            workers = parallel['workers']
+
+        if not isinstance(layer, QgsVectorLayer) or not isinstance(overlay, QgsVectorLayer):
+            logger.info(f'The inputs are not both vector layers, running {algorithm} in a single process')
+            parameter = {
+                'INPUT': layer,
+                'OVERLAY': overlay,
+                'OUTPUT': 'memory:extracted'
+            }
+            return run_algorithm(algorithm, parameter)['OUTPUT']
+
+        if layer.featureCount() < parallel['min_features'] or workers < 2:
+            logger.info(f'Input has {layer.featureCount()} features, running {algorithm} in a single process')
+            parameter = {
+                'INPUT': layer,
+                'OVERLAY': overlay,
+                'OUTPUT': 'memory:extracted'
+            }
+            return run_algorithm(algorithm, parameter)['OUTPUT']
+
+        start = time.time()
+        tiles = Parallel.partition(layer, overlay, workers * parallel['tiles_per_worker'])
+        logger.info(f'Running {algorithm} on {len(tiles)} tiles with {workers} worker processes')
+        try:
+            Parallel.run_workers(algorithm, tiles, workers)
+            result = Parallel.merge(tiles, layer.fields(), QgsWkbTypes.multiType(layer.wkbType()), layer.crs(), [layer])
+        finally:
+            for tile in tiles:
+                for key in ('input', 'overlay', 'output'):
+                    delete_intermediate(tile[key])
+        logger.info(f'Parallel {algorithm} finished in {round(time.time() - start, 2)} s, returning {result.featureCount()} features')
+        return result
+
+    def symmetricaldifference(layer: QgsVectorLayer, overlay: QgsVectorLayer, workers: int = None):
+        """
+        Runs native:symmetricaldifference in parallel, as the union of the differences between the two layers.
+        The output has the combined fields of both layers, like the single process algorithm.
+
+        Args:
+            layer (QgsVectorLayer): The input layer
+            overlay (QgsVectorLayer): The overlay layer
+            workers (integer): Number of worker processes. Defaults to the settings, or the number of cores.
+
+        Returns:
+            layer (QgsVectorLayer): The symmetrical difference
+        """
+
+        layer = resolve(layer)
+        overlay = resolve(overlay)
+        if max(layer.featureCount(), overlay.featureCount()) < Parallel.settings()['min_features']:
+            logger.info('Inputs are small, running native:symmetricaldifference in a single process')
+            parameter = {
+                'INPUT': layer,
+                'OVERLAY': overlay,
+                'OUTPUT': 'memory:output_from_symmetricaldifference'
+            }
+            return run_algorithm('native:symmetricaldifference', parameter)['OUTPUT']
+
+        first = Parallel.overlay('native:difference', layer, overlay, workers)
+        second = Parallel.overlay('native:difference', overlay, layer, workers)
+
+        fields = QgsProcessingUtils.combineFields(layer.fields(), overlay.fields())
+        sink = IntermediateSink('output_from_symmetricaldifference', fields, QgsWkbTypes.multiType(layer.wkbType()), layer.crs(), [layer, overlay])
+        transform = QgsCoordinateTransform(overlay.crs(), layer.crs(), QgsProject.instance())
+        padding = [None] * overlay.fields().count()
+        batch = []
+        for part, before, after in ((first, [], padding), (second, [None] * layer.fields().count(), [])):
+            for feature in part.getFeatures():
+                output = QgsFeature(fields)
+                geometry = feature.geometry()
+                if part is second and overlay.crs() != layer.crs():
+                    geometry.transform(transform)
+                output.setGeometry(geometry)
+                output.setAttributes(before + feature.attributes() + after)
+                batch.append(output)
+                if len(batch) >= BATCH_SIZE:
+                    sink.addFeatures(batch)
+                    batch = []
+        if batch:
+            sink.addFeatures(batch)
+        return sink.finish()
+
+    def partition(layer: QgsVectorLayer, overlay: QgsVectorLayer, count: int):
+        """
+        Splits the input and overlay layer into tiles written as FlatGeobuf files in the TempFolder.
+
+        Returns:
+            tiles (list of dictionaries): The tiles with paths to input, overlay and output files, and the number of features
+        """
+
+        xmin, ymin, xmax, ymax, epsg = Constructor.bboxFromLayer(layer)
+        columns = max(1, math.ceil(math.sqrt(count)))
+        rows = max(1, math.ceil(count / columns))
+        width = (xmax - xmin) / columns or 1
+        height = (ymax - ymin) / rows or 1
+
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'FlatGeobuf'
+        context = QgsProject.instance().transformContext()
+
+        ## Assigning each input feature to the tile containing the centre of its bounding box
+        tiles = {}
+        writers = {}
+        for feature in layer.getFeatures():
+            if feature.hasGeometry():
+                centre = feature.geometry().boundingBox().center()
+                column = min(columns - 1, max(0, int((centre.x() - xmin) / width)))
+                row = min(rows - 1, max(0, int((centre.y() - ymin) / height)))
+                key = row * columns + column
+            else:
+                key = 0
+            if key not in tiles:
+                tiles[key] = {
+                    'id': key,
+                    'input': tempfile_path(f'tile_{key}_input', 'flatgeobuf'),
+                    'overlay': tempfile_path(f'tile_{key}_overlay', 'flatgeobuf'),
+                    'output': tempfile_path(f'tile_{key}_output', 'flatgeobuf'),
+                    'features': 0,
+                    'extent': QgsRectangle()
+                }
+                tiles[key]['extent'].setMinimal()
+                writers[key] = QgsVectorFileWriter.create(tiles[key]['input'], layer.fields(), layer.wkbType(), layer.crs(), context, options)
+            writers[key].addFeature(feature)
+            tiles[key]['features'] += 1
+            if feature.hasGeometry():
+                tiles[key]['extent'].combineExtentWith(feature.geometry().boundingBox())
+        writers = None
+
+        ## Giving each tile the overlay features intersecting the extent of the features it owns
+        transform = QgsCoordinateTransform(overlay.crs(), layer.crs(), QgsProject.instance())
+        writers = {key: QgsVectorFileWriter.create(tile['overlay'], overlay.fields(), overlay.wkbType(), overlay.crs(), context, options) for key, tile in tiles.items()}
+        for feature in overlay.getFeatures():
+            if not feature.hasGeometry():
+                continue
+            bbox = feature.geometry().boundingBox()
+            if overlay.crs() != layer.crs():
+                bbox = transform.transformBoundingBox(bbox)
+            for key, tile in tiles.items():
+                if tile['extent'].intersects(bbox):
+                    writers[key].addFeature(feature)
+        writers = None
+
+        for tile in tiles.values():
+            del tile['extent']
+        logger.info(f'Partitioned {layer.featureCount()} features into {len(tiles)} tiles on a {columns}x{rows} grid')
+        return list(tiles.values())
+
+    def run_workers(algorithm: str, tiles: list, workers: int):
+        """
+        Distributes the tiles over a pool of worker processes and waits for them to finish.
+        """
+
+        config = get_config()
+        groups = [[] for i in range(min(workers, len(tiles)))]
+        loads = [0] * len(groups)
+        for tile in sorted(tiles, key=lambda tile: tile['features'], reverse=True):
+            index = loads.index(min(loads))
+            groups[index].append(tile)
+            loads[index] += tile['features']
+
+        environment = dict(os.environ)
+        environment['QETL_WORKER'] = '1'
+        environment['QETL_SETTINGS_FILE'] = get_settings_file()
+        environment['QETL_LOGFILE'] = get_logfile()
+
+        processes = []
+        jobfiles = []
+        for index, group in enumerate(groups):
+            jobfile = f'{config["TempFolder"]}QETL_overlay_job_{os.getpid()}_{index}.json'
+            with open(jobfile, 'w') as file:
+                json.dump({'algorithm': algorithm, 'tiles': group}, file)
+            jobfiles.append(jobfile)
+            processes.append(subprocess.Popen([sys.executable, WORKER_SCRIPT, jobfile], env=environment))
+
+        failed = 0
+        for process in processes:
+            if process.wait() != 0:
+                failed += 1
+        for jobfile in jobfiles:
+            delete_intermediate(jobfile)
+        if failed:
+            logger.error(f'{failed} of {len(processes)} worker processes failed running {algorithm}')
+            logger.critical("Program terminated" )
+            script_failed()
+
+    def merge(tiles: list, fields: QgsFields, wkbType, crs, layers: list):
+        """
+        Stitches the tile outputs together into one layer.
+        """
+
+        sink = IntermediateSink('parallel_overlay', fields, wkbType, crs, layers)
+        batch = []
+        for tile in tiles:
+            output = QgsVectorLayer(tile['output'], f'tile_{tile["id"]}', 'ogr')
+            for feature in output.getFeatures():
+                merged = QgsFeature(fields)
+                merged.setGeometry(feature.geometry())
+                merged.setAttributes(feature.attributes())
+                batch.append(merged)
+                if len(batch) >= BATCH_SIZE:
+                    sink.addFeatures(batch)
+                    batch = []
+            output = None
+        if batch:
+            sink.addFeatures(batch)
+        return sink.finish()
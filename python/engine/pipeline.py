@@ -0,0 +1,424 @@
+from core.logger import *
+from core.misc import script_failed
+import sys
+from qgis.core import (
+                       QgsVectorLayer,
+                       QgsFeature,
+                       QgsField,
+                       QgsFields,
+                       QgsExpression,
+                       QgsExpressionContext,
+                       QgsExpressionContextUtils,
+                       QgsDistanceArea,
+                       QgsProject)
+from qgis.PyQt.QtCore import QVariant
+from qgis import processing
+from engine.storage import IntermediateSink, intermediate_format, tempfile_path, open_intermediate
+from engine.ledger import Ledger
+from engine.cache import ResultCache
+
+## Number of features handed to the data provider in each addFeatures call
+BATCH_SIZE = 10000
+
+## Algorithms that modify their input in place, and never create an intermediate layer
+IN_PLACE = ('native:createspatialindex', 'native:createattributeindex')
+
+## The field types of native:fieldcalculator that can be evaluated in a lazy pipeline
+FIELD_TYPES = {
+    0: QVariant.Double,
+    1: QVariant.Int,
+    2: QVariant.String,
+    3: QVariant.Date,
+    4: QVariant.Time,
+    5: QVariant.DateTime,
+    6: QVariant.Bool,
+    7: QVariant.ByteArray
+}
+
+
+def resolve(layer):
+    """
+    Returns a layer that can be handed to QGIS. Lazy layers are materialized, all other values are returned untouched.
+
+    Args:
+        layer (QgsVectorLayer or LazyLayer): The layer to resolve
+
+    Returns:
+        layer (QgsVectorLayer): The materialized layer
+    """
+
+    if isinstance(layer, LazyLayer):
+        return layer.materialize()
+    return layer
+
+def run_algorithm(algorithm: str, parameter: dict, feedback=None):
+    """
+    Runs a processing algorithm. This is the single entry point used by the workers and writers,
+    making sure that lazy layers in the parameters are materialized before QGIS sees them.
+    Temporary outputs ('memory:' or 'TEMPORARY_OUTPUT') are placed according to the intermediate storage policy,
+    and are read from the result cache when it is enabled and holds a result for the same inputs and parameters.
+
+    Args:
+        algorithm (string): The id of the processing algorithm, e.g. 'native:clip'
+        parameter (dictionary): The parameters for the algorithm
+        feedback (QgsProcessingFeedback): Optional feedback object for progress reporting
+
+    Returns:
+        result (dictionary): The result dictionary from processing.run
+    """
+
+    Ledger.algorithm(algorithm)
+    layers = []
+    for key, value in parameter.items():
+        if isinstance(value, list):
+            parameter[key] = [resolve(elm) for elm in value]
+            layers.extend(parameter[key])
+        else:
+            parameter[key] = resolve(value)
+            layers.append(parameter[key])
+
+    output = parameter.get('OUTPUT')
+    temporary = algorithm not in IN_PLACE and isinstance(output, str) and (output.startswith('memory:') or output == 'TEMPORARY_OUTPUT')
+    key = ResultCache.key(algorithm, parameter) if temporary and ResultCache.enabled() else None
+    if key is not None:
+        cached = ResultCache.get(key, algorithm, output)
+        if cached is not None:
+            return {'OUTPUT': cached}
+
+    tempfile = None
+    if temporary:
+        format = intermediate_format(layers)
+        if format is not None:
+            tempfile = tempfile_path(output, format)
+            parameter['OUTPUT'] = tempfile
+
+    result = processing.run(algorithm, parameter, feedback=feedback)
+    if tempfile is not None:
+        result['OUTPUT'] = open_intermediate(tempfile, output)
+    if key is not None:
+        ResultCache.put(key, result['OUTPUT'])
+    return result
+
+
+class LazyLayer:
+    '''
+    A deferred layer, holding a source layer and a plan of per-feature steps.
+    The plan is only executed when the data is needed, and all steps are run in one streaming pass over the source.
+    Methods not defined here are forwarded to the materialized QgsVectorLayer.
+    '''
+
+    def __init__(self, source: QgsVectorLayer, steps: list = None):
+        self.source = source
+        self.steps = steps or []
+        self.result = None
+
+    def of(layer):
+        """
+        Returns the layer as a lazy layer, wrapping it if required.
+        """
+        if isinstance(layer, LazyLayer):
+            return layer
+        return LazyLayer(layer)
+
+    def then(self, step):
+        """
+        Returns a new lazy layer with the step appended to the plan. The current layer is not modified,
+        so a plan can be branched. If the current layer is already materialized, the new plan starts from the result.
+        """
+        if self.result is not None:
+            return LazyLayer(self.result, [step])
+        return LazyLayer(self.source, self.steps + [step])
+
+    def materialize(self):
+        """
+        Executes the plan in a single pass over the source layer.
+
+        Returns:
+            layer (QgsVectorLayer): The resulting layer, stored according to the intermediate storage policy
+        """
+
+        if self.result is not None:
+            return self.result
+
+        source = resolve(self.source)
+        logger.info(f'Running lazy pipeline with {len(self.steps)} fused steps: {", ".join(step.name for step in self.steps)}')
+        try:
+            fields = QgsFields(source.fields())
+            for step in self.steps:
+                fields = step.prepare(fields, source)
+
+            sink = IntermediateSink('lazy_pipeline', fields, source.wkbType(), source.crs(), [source])
+            batch = []
+            read = 0
+            for feature in source.getFeatures():
+                read += 1
+                attributes = feature.attributes()
+                geometry = feature.geometry()
+                for step in self.steps:
+                    attributes = step.apply(attributes, geometry)
+                    if attributes is None:
+                        break
+                if attributes is None:
+                    continue
+                output = QgsFeature(fields)
+                output.setGeometry(geometry)
+                output.setAttributes(attributes)
+                batch.append(output)
+                if len(batch) >= BATCH_SIZE:
+                    sink.addFeatures(batch)
+                    batch = []
+            if batch:
+                sink.addFeatures(batch)
+            result = sink.finish()
+
+            logger.info(f'Lazy pipeline finished, read {read} features, returning {result.featureCount()} features')
+            self.result = result
+            return result
+        except Exception as error:
+            logger.error("An error occured running lazy pipeline")
+            logger.error(f'{type(error).__name__}  –  {str(error)}')
+            logger.critical("Program terminated" )
+            script_failed()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.materialize(), name)
+
+    def __str__(self):
+        return f'LazyLayer({len(self.steps)} steps)'
+
+
+## ##################################
+## Per-feature steps for lazy layers
+## ##################################
+
+class DropFields:
+    '''
+    Drops a list of fields, like native:deletecolumn.
+    '''
+    name = 'deleteColumns'
+
+    def __init__(self, columns: list):
+        self.columns = columns
+
+    def prepare(self, fields, source):
+        self.keep = [i for i in range(fields.count()) if fields.at(i).name() not in self.columns]
+        output = QgsFields()
+        for i in self.keep:
+            output.append(fields.at(i))
+        return output
+
+    def apply(self, attributes, geometry):
+        return [attributes[i] for i in self.keep]
+
+class RenameField:
+    '''
+    Renames a field, like native:renametablefield.
+    '''
+    name = 'renameTableField'
+
+    def __init__(self, field: str, newname: str):
+        self.field = field
+        self.newname = newname
+
+    def prepare(self, fields, source):
+        index = fields.lookupField(self.field)
+        if index == -1:
+            raise KeyError(f'Field {self.field} does not exist')
+        output = QgsFields(fields)
+        output.rename(index, self.newname)
+        return output
+
+    def apply(self, attributes, geometry):
+        return attributes
+
+class AutoIncrement:
+    '''
+    Appends a sequential integer field, like native:addautoincrementalfield without grouping and sorting.
+    '''
+    name = 'addAutoIncrementalField'
+
+    def __init__(self, fieldname: str, start: int):
+        self.fieldname = fieldname
+        self.start = start
+
+    def prepare(self, fields, source):
+        self.value = self.start
+        output = QgsFields(fields)
+        output.append(QgsField(self.fieldname, QVariant.Int))
+        return output
+
+    def apply(self, attributes, geometry):
+        attributes = attributes + [self.value]
+        self.value += 1
+        return attributes
+
+class ExpressionStep:
+    '''
+    Base class for steps evaluating a QGIS expression against each feature.
+    '''
+
+    def prepare_expression(self, formula, fields, source):
+        project = QgsProject.instance()
+        self.expression = QgsExpression(formula)
+        if self.expression.hasParserError():
+            raise ValueError(self.expression.parserErrorString())
+        self.context = QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(source))
+        self.context.setFields(fields)
+        calculator = QgsDistanceArea()
+        calculator.setSourceCrs(source.crs(), project.transformContext())
+        calculator.setEllipsoid(project.ellipsoid())
+        self.expression.setGeomCalculator(calculator)
+        self.expression.setDistanceUnits(project.distanceUnits())
+        self.expression.setAreaUnits(project.areaUnits())
+        self.expression.prepare(self.context)
+        self.feature = QgsFeature(fields)
+
+    def evaluate(self, attributes, geometry):
+        self.feature.setAttributes(attributes)
+        self.feature.setGeometry(geometry)
+        self.context.setFeature(self.feature)
+        value = self.expression.evaluate(self.context)
+        if self.expression.hasEvalError():
+            raise ValueError(self.expression.evalErrorString())
+        return value
+
+class Calculate(ExpressionStep):
+    '''
+    Adds or overwrites a field with the result of an expression, like native:fieldcalculator.
+    '''
+    name = 'fieldCalculator'
+
+    def __init__(self, fieldname: str, fieldtype: int, fieldlength: int, fieldprecision: int, formula: str):
+        self.fieldname = fieldname
+        self.fieldtype = fieldtype
+        self.fieldlength = fieldlength
+        self.fieldprecision = fieldprecision
+        self.formula = formula
+
+    def prepare(self, fields, source):
+        self.prepare_expression(self.formula, fields, source)
+        output = QgsFields(fields)
+        self.index = output.lookupField(self.fieldname)
+        if self.index == -1:
+            output.append(QgsField(self.fieldname, FIELD_TYPES[self.fieldtype], '', self.fieldlength, self.fieldprecision))
+        return output
+
+    def apply(self, attributes, geometry):
+        value = self.evaluate(attributes, geometry)
+        if self.index == -1:
+            return attributes + [value]
+        attributes = list(attributes)
+        attributes[self.index] = value
+        return attributes
+
+class Filter(ExpressionStep):
+    '''
+    Keeps the features matching an expression, like native:extractbyexpression.
+    '''
+    name = 'extractByExpression'
+
+    def __init__(self, expression: str):
+        self.formula = expression
+
+    def prepare(self, fields, source):
+        self.prepare_expression(self.formula, fields, source)
+        return fields
+
+    def apply(self, attributes, geometry):
+        if self.evaluate(attributes, geometry):
+            return attributes
+        return None
+
+class Refactor:
+    '''
+    Rebuilds the attribute table from a field mapping, like native:refactorfields. Each entry of the mapping is a dictionary:
+        {'field': 'navn'}                                   keeps a field
+        {'field': 'kode', 'name': 'code'}                   renames a field
+        {'field': 'height', 'type': 0}                      casts a field to a field type of fieldCalculator
+        {'field': 'tmp', 'drop': True}                      drops a field
+        {'name': 'area', 'expression': '$area', 'type': 0}  adds a field computed from the input fields
+        {'name': 'id', 'autoincrement': 1}                  adds a sequential integer field from a start value
+    Entries can also set 'length' and 'precision'. Without keep_unmapped the output has the fields of the mapping in its order,
+    with keep_unmapped the fields not in the mapping are kept in their place, and the new fields are appended.
+    '''
+    name = 'refactorFields'
+
+    def __init__(self, mapping: list, keep_unmapped: bool = False):
+        self.mapping = mapping
+        self.keep_unmapped = keep_unmapped
+
+    def prepare(self, fields, source):
+        mapped = {}
+        added = []
+        for entry in self.mapping:
+            if 'field' in entry:
+                if fields.lookupField(entry['field']) == -1:
+                    raise KeyError(f'Field {entry["field"]} does not exist')
+                mapped[entry['field']] = entry
+            elif 'expression' in entry or 'autoincrement' in entry:
+                if 'name' not in entry:
+                    raise ValueError(f'The new field {entry} has no name')
+                added.append(entry)
+            else:
+                raise ValueError(f'The mapping entry {entry} has no field, expression or autoincrement')
+
+        if self.keep_unmapped:
+            entries = [mapped.get(fields.at(i).name(), {'field': fields.at(i).name()}) for i in range(fields.count())] + added
+        else:
+            entries = self.mapping
+
+        output = QgsFields()
+        self.columns = []
+        for entry in entries:
+            if entry.get('drop'):
+                continue
+            if 'field' in entry:
+                index = fields.lookupField(entry['field'])
+                field = QgsField(fields.at(index))
+                if 'type' in entry:
+                    field = QgsField(field.name(), FIELD_TYPES[entry['type']], '', entry.get('length', 0), entry.get('precision', 0))
+                elif 'length' in entry or 'precision' in entry:
+                    field.setLength(entry.get('length', field.length()))
+                    field.setPrecision(entry.get('precision', field.precision()))
+                if 'name' in entry:
+                    field.setName(entry['name'])
+                column = ('field', index, 'type' in entry)
+            elif 'expression' in entry:
+                field = QgsField(entry['name'], FIELD_TYPES[entry.get('type', 0)], '', entry.get('length', 0), entry.get('precision', 0))
+                step = ExpressionStep()
+                step.prepare_expression(entry['expression'], fields, source)
+                column = ('expression', step, True)
+            else:
+                field = QgsField(entry['name'], QVariant.Int)
+                column = ('autoincrement', [entry['autoincrement']], False)
+            if output.lookupField(field.name()) != -1:
+                raise ValueError(f'The field {field.name()} is in the output twice')
+            output.append(field)
+            self.columns.append((field, *column))
+        return output
+
+    def apply(self, attributes, geometry):
+        output = []
+        for field, kind, source, cast in self.columns:
+            if kind == 'field':
+                value = attributes[source]
+            elif kind == 'expression':
+                value = source.evaluate(attributes, geometry)
+            else:
+                value = source[0]
+                source[0] += 1
+            if cast:
+                value = Refactor.cast(field, value)
+            output.append(value)
+        return output
+
+    def cast(field, value):
+        ## Converts a value to the type of the output field, failing on values that can not be converted, e.g. 'abc' to an integer
+        if value is None or (isinstance(value, QVariant) and value.isNull()):
+            return None
+        try:
+            return field.convertCompatible(value)
+        except ValueError:
+            raise ValueError(f'The value {value} of the field {field.name()} can not be converted to {field.typeName()}')
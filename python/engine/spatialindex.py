@@ -0,0 +1,127 @@
+from core.logger import *
+import time
+from qgis.core import QgsVectorLayer, QgsFeatureRequest, QgsFeatureSource, QgsCoordinateTransform, QgsProject, QgsFeature
+from engine.pipeline import resolve, run_algorithm, BATCH_SIZE
+from engine.storage import IntermediateSink
+
+## Providers where native:createspatialindex builds an index the algorithms use. Database layers are indexed on the server
+INDEXED_PROVIDERS = ('memory', 'ogr')
+
+## The disjoint predicate of each location based algorithm, which matches features outside the extent of the other layer.
+## native:joinattributesbylocation has no disjoint predicate, its predicate 2 is equal
+DISJOINT = {'native:extractbylocation': 2}
+
+## Layers are pre-filtered when the extent of the other layer covers less than this share of their extent
+PREFILTER_SHARE = 0.8
+
+
+class SpatialIndex:
+    '''
+    Preparation of the inputs of the location based algorithms (joinByLocation and extractByLocation).
+    Features that can not match, as they are outside the extent of the other layer, are filtered out with a bounding box
+    request, and a spatial index is built on the layer the algorithm searches, when it has none.
+    '''
+
+    def ensure(layer: QgsVectorLayer, name: str):
+        """
+        Builds a spatial index on a layer if it does not have one.
+
+        Returns:
+            seconds (float): The time spent building the index, 0 if the layer already had one or can not be indexed here
+        """
+
+        if not isinstance(layer, QgsVectorLayer) or layer.providerType() not in INDEXED_PROVIDERS:
+            return 0
+        if layer.hasSpatialIndex() == QgsFeatureSource.SpatialIndexPresent:
+            logger.info(f'The {name} layer already has a spatial index')
+            return 0
+        start = time.time()
+        try:
+            run_algorithm('native:createspatialindex', {'INPUT': layer})
+        except Exception as error:
+            logger.info(f'Could not build a spatial index on the {name} layer: {type(error).__name__}  –  {str(error)}')
+            return 0
+        seconds = time.time() - start
+        logger.info(f'Spatial index on the {name} layer ({layer.featureCount()} features) built in {round(seconds, 2)} s')
+        return seconds
+
+    def prefilter(layer: QgsVectorLayer, other: QgsVectorLayer, name: str):
+        """
+        Keeps the features of a layer whose bounding box intersects the extent of the other layer.
+
+        Returns:
+            layer (QgsVectorLayer): The filtered layer, or the layer itself when the other layer covers most of it
+        """
+
+        if other.featureCount() <= 0:
+            return layer
+        extent = other.extent()
+        if other.crs() != layer.crs():
+            extent = QgsCoordinateTransform(other.crs(), layer.crs(), QgsProject.instance()).transformBoundingBox(extent)
+        if extent.width() == 0 or extent.height() == 0:
+            ## The extent of a single point or a straight line is grown, so the request does not see it as empty
+            extent.grow(1e-6)
+        own = layer.extent()
+        if own.isEmpty() or own.area() == 0:
+            return layer
+        covered = own.intersect(extent)
+        if covered.area() >= own.area() * PREFILTER_SHARE:
+            return layer
+
+        start = time.time()
+        request = QgsFeatureRequest().setFilterRect(extent)
+        sink = IntermediateSink(f'{name}_prefiltered', layer.fields(), layer.wkbType(), layer.crs(), [layer])
+        batch = []
+        for feature in layer.getFeatures(request):
+            output = QgsFeature(feature)
+            batch.append(output)
+            if len(batch) >= BATCH_SIZE:
+                sink.addFeatures(batch)
+                batch = []
+        if batch:
+            sink.addFeatures(batch)
+        result = sink.finish()
+        logger.info(f'Bounding box pre-filter kept {result.featureCount()} of {layer.featureCount()} {name} features in {round(time.time() - start, 2)} s')
+        return result
+
+    def searched(algorithm: str, layer: QgsVectorLayer, other: QgsVectorLayer, method: int = 0):
+        ## The algorithms iterate over the smaller layer and search the larger one, except the largest overlap join,
+        ## which always iterates over the input layer
+        if algorithm == 'native:joinattributesbylocation':
+            return 'layer' if method != 2 and 0 < other.featureCount() < layer.featureCount() else 'other'
+        return 'other' if 0 < layer.featureCount() < other.featureCount() else 'layer'
+
+    def prepare(algorithm: str, layer, other, predicate, other_name: str, prefilter_layer: bool = True, method: int = 0):
+        """
+        Prepares the two inputs of a location based algorithm.
+
+        Args:
+            algorithm (string): 'native:joinattributesbylocation' or 'native:extractbylocation'
+            layer (QgsVectorLayer): The input layer
+            other (QgsVectorLayer): The join or intersect layer
+            predicate (integer or list): The spatial predicates. Nothing is filtered out with the disjoint predicate
+            other_name (string): The name of the other layer in the log, e.g. 'join'
+            prefilter_layer (boolean): Whether features of the input layer outside the other layer may be dropped
+            method (integer): The join method
+
+        Returns:
+            layers (tuple): The prepared input and other layer
+        """
+
+        layer = resolve(layer)
+        other = resolve(other)
+        if not isinstance(layer, QgsVectorLayer) or not isinstance(other, QgsVectorLayer):
+            return layer, other
+
+        predicates = predicate if isinstance(predicate, (list, tuple)) else [predicate]
+        disjoint = DISJOINT.get(algorithm)
+        if disjoint is None or disjoint not in predicates:
+            other = SpatialIndex.prefilter(other, layer, other_name)
+            if prefilter_layer:
+                layer = SpatialIndex.prefilter(layer, other, 'input')
+
+        if SpatialIndex.searched(algorithm, layer, other, method) == 'layer':
+            SpatialIndex.ensure(layer, 'input')
+        else:
+            SpatialIndex.ensure(other, other_name)
+        return layer, other
@@ -0,0 +1,202 @@
+from core.logger import *
+from core.misc import get_config
+import os
+import atexit
+import weakref
+import uuid
+from qgis.core import QgsVectorLayer, QgsVectorFileWriter, QgsProject, QgsMemoryProviderUtils, QgsWkbTypes
+
+## The drivers and file extensions available for intermediate layers
+FORMATS = {
+    'flatgeobuf': ('FlatGeobuf', 'fgb'),
+    'geopackage': ('GPKG', 'gpkg')
+}
+
+## Number of features sampled when estimating the size of a layer
+SAMPLE_SIZE = 1000
+
+## Temporary files that could not be deleted when their layer was released
+pending_tempfiles = []
+
+## Estimated sizes of the layers seen by the auto policy, by layer id, with the feature count they were estimated at
+estimates = {}
+
+
+def storage_policy():
+    """
+    Reads the intermediate storage policy from settings.json.
+    The policy controls where the workers put the layers they create.
+
+    "IntermediateStorage" : {
+        "mode" : "memory",            one of memory, flatgeobuf, geopackage or auto
+        "format" : "flatgeobuf",      the file format used when mode is auto
+        "spill_features" : 1000000,   auto mode spills to file above this number of features
+        "spill_mb" : 1024             auto mode spills to file above this estimated size in MB
+    }
+
+    Returns:
+        policy (dictionary): The policy, with defaults for the missing keys
+    """
+
+    config = get_config()
+    policy = {
+        'mode': 'memory',
+        'format': 'flatgeobuf',
+        'spill_features': 1000000,
+        'spill_mb': 1024
+    }
+    policy.update(config.get('IntermediateStorage', {}))
+    policy['mode'] = policy['mode'].lower()
+    policy['format'] = policy['format'].lower()
+    return policy
+
+def estimate_size(layer: QgsVectorLayer):
+    """
+    Estimates the number of features and the size in MB of a layer, by sampling the first features.
+
+    Args:
+        layer (QgsVectorLayer): The layer to estimate
+
+    Returns:
+        size (tuple): Number of features and estimated size in MB
+    """
+
+    count = layer.featureCount()
+    if count <= 0:
+        return 0, 0.0
+    cached = estimates.get(layer.id())
+    if cached is not None and cached[0] == count:
+        return cached
+    sampled = 0
+    size = 0
+    for feature in layer.getFeatures():
+        size += len(feature.geometry().asWkb())
+        size += sum(len(str(value)) for value in feature.attributes())
+        sampled += 1
+        if sampled >= SAMPLE_SIZE:
+            break
+    estimate = (count, size / sampled * count / 1024**2) if sampled else (count, 0.0)
+    estimates[layer.id()] = estimate
+    return estimate
+
+def intermediate_format(layers: list):
+    """
+    Decides where an intermediate layer should be stored, based on the storage policy and the input layers.
+
+    Args:
+        layers (list of QgsVectorLayers): The input layers of the step creating the intermediate layer
+
+    Returns:
+        format (string): None for a memory layer, otherwise the key of the file format in FORMATS
+    """
+
+    policy = storage_policy()
+    if policy['mode'] in FORMATS:
+        return policy['mode']
+    if policy['mode'] != 'auto':
+        ## The inputs are only sampled by the auto policy, any other mode keeps the layers in memory
+        return None
+
+    features = 0
+    megabytes = 0.0
+    for layer in layers:
+        if isinstance(layer, QgsVectorLayer):
+            count, size = estimate_size(layer)
+            features = max(features, count)
+            megabytes = max(megabytes, size)
+    if features > policy['spill_features'] or megabytes > policy['spill_mb']:
+        logger.info(f'Input of {features} features (~{round(megabytes)} MB) exceeds the spill limit, using {policy["format"]} intermediate storage')
+        return policy['format']
+    return None
+
+def tempfile_path(name: str, format: str):
+    """
+    Returns a unique path in the TempFolder for an intermediate layer.
+    The format is a key in FORMATS, any other value is used as the file extension.
+    """
+
+    config = get_config()
+    name = name.split(':')[-1] or 'layer'
+    extension = FORMATS[format][1] if format in FORMATS else format
+    return f'{config["TempFolder"]}QETL_{name}_{uuid.uuid4().hex[:12]}.{extension}'
+
+def delete_intermediate(path: str):
+    for file in (path, path + '-wal', path + '-shm'):
+        try:
+            if os.path.exists(file):
+                os.remove(file)
+        except OSError:
+            if file not in pending_tempfiles:
+                pending_tempfiles.append(file)
+
+def open_intermediate(path: str, name: str):
+    """
+    Opens an intermediate file as a layer. The file is deleted when the layer is no longer used.
+
+    Args:
+        path (string): The path to the intermediate file
+        name (string): The layer name
+
+    Returns:
+        layer (QgsVectorLayer): The intermediate layer
+    """
+
+    layer = QgsVectorLayer(path, name.split(':')[-1], 'ogr')
+    weakref.finalize(layer, delete_intermediate, path)
+    logger.info(f'Intermediate layer stored in {path}')
+    return layer
+
+def cleanup_intermediates():
+    for file in list(pending_tempfiles):
+        try:
+            os.remove(file)
+            pending_tempfiles.remove(file)
+        except OSError:
+            pass
+    if pending_tempfiles:
+        logger.info(f'Could not delete intermediate files {pending_tempfiles} - manual cleanup is required')
+
+atexit.register(cleanup_intermediates)
+
+
+class IntermediateSink:
+    '''
+    A feature sink for intermediate layers, writing to memory or to a file in the TempFolder depending on the storage policy.
+    '''
+
+    def __init__(self, name: str, fields, wkbType, crs, layers: list):
+        self.name = name
+        self.format = intermediate_format(layers)
+        if wkbType == QgsWkbTypes.NoGeometry:
+            self.format = None
+        if self.format is None:
+            self.layer = QgsMemoryProviderUtils.createMemoryLayer(name, fields, wkbType, crs)
+            self.writer = self.layer.dataProvider()
+        else:
+            self.path = tempfile_path(name, self.format)
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = FORMATS[self.format][0]
+            self.writer = QgsVectorFileWriter.create(self.path, fields, wkbType, crs, QgsProject.instance().transformContext(), options)
+            if self.writer.hasError() != QgsVectorFileWriter.NoError:
+                raise IOError(self.writer.errorMessage())
+
+    def addFeatures(self, features: list):
+        ## A failed write, e.g. a value that does not fit the field or a full disk, would otherwise drop the features silently
+        ## Data providers return the result with the added features, file writers return the result only
+        result = self.writer.addFeatures(features)
+        if not (result[0] if isinstance(result, tuple) else result):
+            error = self.writer.lastError() if hasattr(self.writer, 'lastError') else self.writer.errorMessage()
+            raise IOError(f'Could not write {len(features)} features to the intermediate layer {self.name}: {error}')
+
+    def finish(self):
+        """
+        Closes the sink.
+
+        Returns:
+            layer (QgsVectorLayer): The finished layer
+        """
+        if self.format is None:
+            self.layer.updateExtents()
+            return self.layer
+        self.writer = None
+        return open_intermediate(self.path, self.name)
@@ -0,0 +1,145 @@
+from core.logger import *
+import time
+from qgis.core import (
+                       QgsVectorLayer,
+                       QgsFeature,
+                       QgsFields,
+                       QgsFeatureRequest,
+                       QgsRectangle,
+                       QgsWkbTypes,
+                       QgsVectorFileWriter,
+                       QgsProject)
+from engine.pipeline import BATCH_SIZE
+
+
+class FeatureStream:
+    '''
+    A stream of feature batches read from a data source, for data sets bigger than memory.
+    Only one batch is held in memory at a time. The stream can be read more than once, each read starts from the beginning.
+    It has the fields, wkbType, crs, extent and getFeatures methods of a layer, so the file and database writers can consume it directly.
+    '''
+
+    def __init__(self, layer: QgsVectorLayer, batch_size: int = BATCH_SIZE, fields: list = None, bbox=None, no_geometry: bool = False):
+        self.layer = layer
+        self.batch_size = batch_size
+        self.no_geometry = no_geometry
+        self.bbox = None
+        if bbox is not None:
+            self.bbox = bbox if isinstance(bbox, QgsRectangle) else QgsRectangle(*bbox)
+        if fields:
+            missing = [name for name in fields if layer.fields().lookupField(name) == -1]
+            if missing:
+                raise KeyError(f'Fields {missing} do not exist in the layer')
+            self.field_names = list(fields)
+        else:
+            self.field_names = None
+        self.output = QgsFields()
+        for field in layer.fields():
+            if self.field_names is None or field.name() in self.field_names:
+                self.output.append(field)
+        self.indexes = [layer.fields().lookupField(field.name()) for field in self.output]
+
+    def name(self):
+        return self.layer.name()
+
+    def fields(self):
+        return self.output
+
+    def wkbType(self):
+        return QgsWkbTypes.NoGeometry if self.no_geometry else self.layer.wkbType()
+
+    def crs(self):
+        return self.layer.crs()
+
+    def extent(self):
+        return QgsRectangle(self.bbox) if self.bbox is not None else self.layer.extent()
+
+    def featureCount(self):
+        ## The count of the source, or -1 when a bounding box makes the count unknown until the stream is read
+        return -1 if self.bbox is not None else self.layer.featureCount()
+
+    def request(self):
+        request = QgsFeatureRequest()
+        if self.bbox is not None:
+            request.setFilterRect(self.bbox)
+        if self.field_names is not None:
+            request.setSubsetOfAttributes(self.field_names, self.layer.fields())
+        if self.no_geometry:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        return request
+
+    def getFeatures(self):
+        """
+        Yields the features of the stream one at a time, with the fields of the stream.
+        """
+
+        subset = self.field_names is not None
+        for feature in self.layer.getFeatures(self.request()):
+            if subset:
+                output = QgsFeature(self.output, feature.id())
+                attributes = feature.attributes()
+                output.setAttributes([attributes[index] for index in self.indexes])
+                if not self.no_geometry and feature.hasGeometry():
+                    output.setGeometry(feature.geometry())
+                feature = output
+            elif self.no_geometry:
+                feature.clearGeometry()
+            yield feature
+
+    def batches(self):
+        """
+        Yields lists of up to batch_size features.
+        """
+
+        batch = []
+        for feature in self.getFeatures():
+            batch.append(feature)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __iter__(self):
+        return self.batches()
+
+    def __str__(self):
+        return f'FeatureStream of {self.layer.source()}'
+
+
+def write_stream(stream: FeatureStream, path: str, driver: str, layername: str = None, overwrite: bool = True):
+    """
+    Writes a feature stream to a file, one batch at a time.
+
+    Args:
+        stream (FeatureStream): The stream to write
+        path (string): The file to write
+        driver (string): The OGR driver name, e.g. 'GPKG' or 'FlatGeobuf'
+        layername (string): The layer name, for formats with more than one layer
+        overwrite (boolean): Overwrite the file, or add the layer to the existing file
+
+    Returns:
+        rows (integer): Number of features written
+    """
+
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = driver
+    if layername:
+        options.layerName = layername
+    if not overwrite:
+        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
+    writer = QgsVectorFileWriter.create(path, stream.fields(), stream.wkbType(), stream.crs(), QgsProject.instance().transformContext(), options)
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise IOError(writer.errorMessage())
+
+    start = time.time()
+    rows = 0
+    for batch in stream.batches():
+        if not writer.addFeatures(batch):
+            raise IOError(writer.errorMessage())
+        rows += len(batch)
+        logger.info(f'Written {rows} features')
+    writer = None
+    seconds = time.time() - start
+    logger.info(f'Streamed {rows} features to {path} in {round(seconds, 2)} s ({round(rows / seconds) if seconds > 0 else rows} features/s)')
+    return rows
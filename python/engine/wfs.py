@@ -0,0 +1,312 @@
+from core.logger import *
+import time
+import threading
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import urlsplit, urlunsplit, parse_qsl
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from qgis.core import QgsVectorLayer, QgsDataSourceUri, QgsFeature, QgsField, QgsFields, QgsCoordinateReferenceSystem, QgsWkbTypes
+from qgis.PyQt.QtCore import QVariant
+from engine.pipeline import BATCH_SIZE
+from engine.storage import IntermediateSink, tempfile_path, delete_intermediate
+
+## Output formats recognised as GeoJSON in the capabilities of a WFS server, in order of preference
+JSON_FORMATS = ('application/json', 'application/geo+json', 'json', 'geojson', 'application/vnd.geo+json')
+
+## Request parameters that are set by the paged download, and removed from the url of the service
+RESERVED = ('service', 'request', 'version', 'typename', 'typenames', 'srsname', 'count', 'maxfeatures', 'startindex', 'outputformat', 'resulttype', 'filter', 'sortby')
+
+## Property names used as the sort key of the pages, in order of preference, when the feature type has one of them
+ID_PROPERTIES = ('id', 'fid', 'gid', 'objectid', 'ogc_fid', 'featureid')
+
+## XML schema types of the properties that can be used as a sort key
+SORTABLE_TYPES = ('int', 'integer', 'long', 'short', 'decimal', 'string', 'nonnegativeinteger', 'positiveinteger')
+
+
+class Wfs:
+    '''
+    Paged WFS 2.0 download. The number of features is read with a hits request, and the pages are fetched
+    concurrently with STARTINDEX and COUNT, each written to a file in the TempFolder and assembled into one layer.
+    WFS 2.0 only guarantees the same order of the features in every request with SORTBY, so the pages are sorted on an
+    id property of the feature type. Without one, the layer is read with the WFS provider.
+    '''
+
+    def parse(uri: str):
+        """
+        Reads the service url and request parameters from a WFS uri, in either of the forms accepted by Input_Reader.wfs.
+
+        Returns:
+            source (dictionary): url, query, typename, srsname, filter, username, password and unsupported parameters
+        """
+
+        if uri.strip().lower().startswith('http'):
+            parts = urlsplit(uri.strip())
+            parameters = {key.lower(): value for key, value in parse_qsl(parts.query)}
+            url = urlunsplit((parts.scheme, parts.netloc, parts.path, parts.query, ''))
+            source = {
+                'typename': parameters.get('typenames', parameters.get('typename', '')),
+                'srsname': parameters.get('srsname', ''),
+                'filter': parameters.get('filter', ''),
+                'username': '',
+                'password': ''
+            }
+        else:
+            datasource = QgsDataSourceUri(uri)
+            url = datasource.param('url')
+            source = {
+                'typename': datasource.param('typename'),
+                'srsname': datasource.param('srsname'),
+                'filter': datasource.param('filter'),
+                'username': datasource.param('username') or datasource.username(),
+                'password': datasource.param('password') or datasource.password()
+            }
+            source['unsupported'] = [key for key in ('sql', 'authcfg', 'restrictToRequestBBOX') if datasource.hasParam(key)]
+
+        parts = urlsplit(url)
+        source['url'] = urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+        source['query'] = {key: value for key, value in parse_qsl(parts.query) if key.lower() not in RESERVED}
+        source.setdefault('unsupported', [])
+        if source['filter'] and not source['filter'].lstrip().startswith('<'):
+            ## QGIS expression filters are translated by the WFS provider only
+            source['unsupported'].append('filter')
+        return source
+
+    def request(session, source: dict, parameters: dict, timeout: int = 300):
+        query = dict(source['query'])
+        query.update({'SERVICE': 'WFS', 'VERSION': '2.0.0'})
+        query.update(parameters)
+        auth = (source['username'], source['password']) if source['username'] else None
+        response = session.get(source['url'], params=query, auth=auth, timeout=timeout)
+        response.raise_for_status()
+        return response
+
+    def capabilities(session, source: dict):
+        """
+        Reads the capabilities of the service.
+
+        Returns:
+            capabilities (tuple): The GeoJSON output format or None, whether the server implements result paging and sorting
+        """
+
+        response = Wfs.request(session, source, {'REQUEST': 'GetCapabilities'})
+        root = ElementTree.fromstring(response.content)
+        formats = []
+        paging = False
+        sorting = False
+        for element in root.iter():
+            tag = element.tag.split('}')[-1]
+            if tag == 'Parameter' and element.get('name', '').lower() == 'outputformat':
+                formats.extend(value.text.strip() for value in element.iter() if value.tag.split('}')[-1] == 'Value' and value.text)
+            if tag == 'Constraint' and element.get('name') == 'ImplementsResultPaging':
+                paging = any((value.text or '').strip().upper() == 'TRUE' for value in element.iter() if value.tag.split('}')[-1] in ('DefaultValue', 'Value'))
+            if tag == 'Constraint' and element.get('name') == 'ImplementsSorting':
+                sorting = any((value.text or '').strip().upper() == 'TRUE' for value in element.iter() if value.tag.split('}')[-1] in ('DefaultValue', 'Value'))
+        lowered = [format.lower() for format in formats]
+        for candidate in JSON_FORMATS:
+            for index, format in enumerate(lowered):
+                if format == candidate or format.startswith(candidate + ';'):
+                    return formats[index], paging, sorting
+        return None, paging, sorting
+
+    def sort_key(session, source: dict):
+        """
+        Finds an id property of the feature type in its DescribeFeatureType schema, to sort the pages on.
+
+        Returns:
+            property (string): The name of the property, or None if the feature type has no id property
+        """
+
+        try:
+            response = Wfs.request(session, source, {'REQUEST': 'DescribeFeatureType', 'TYPENAMES': source['typename']})
+            root = ElementTree.fromstring(response.content)
+        except Exception as error:
+            logger.info(f'Unable to read the schema of {source["typename"]}: {type(error).__name__}  –  {str(error)[:200]}')
+            return None
+        properties = {}
+        for element in root.iter():
+            if element.tag.split('}')[-1] == 'element' and element.get('name') and element.get('type'):
+                type = element.get('type').split(':')[-1].lower()
+                if type in SORTABLE_TYPES:
+                    properties[element.get('name').lower()] = element.get('name')
+        for name in ID_PROPERTIES:
+            if name in properties:
+                return properties[name]
+        return None
+
+    def hits(session, source: dict):
+        """
+        Asks the server for the number of features matching the request.
+
+        Returns:
+            hits (integer): The number of features, or None if the server does not report it
+        """
+
+        parameters = {'REQUEST': 'GetFeature', 'TYPENAMES': source['typename'], 'RESULTTYPE': 'hits'}
+        if source['filter']:
+            parameters['FILTER'] = source['filter']
+        response = Wfs.request(session, source, parameters)
+        root = ElementTree.fromstring(response.content)
+        matched = root.get('numberMatched', root.get('numberOfFeatures'))
+        if matched is None or not matched.isdigit():
+            return None
+        return int(matched)
+
+    def fetch_page(sessions, source: dict, index: int, startindex: int, count: int, outputformat: str, retries: int, sortby: str = None):
+        """
+        Downloads one page to a file in the TempFolder, retrying with exponential backoff.
+
+        Returns:
+            page (dictionary): The index, path, size in bytes and download time of the page
+        """
+
+        import requests
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        parameters = {
+            'REQUEST': 'GetFeature',
+            'TYPENAMES': source['typename'],
+            'STARTINDEX': startindex,
+            'COUNT': count
+        }
+        if source['srsname']:
+            parameters['SRSNAME'] = source['srsname']
+        if source['filter']:
+            parameters['FILTER'] = source['filter']
+        if outputformat:
+            parameters['OUTPUTFORMAT'] = outputformat
+        if sortby:
+            parameters['SORTBY'] = f'{sortby} ASC'
+
+        path = tempfile_path(f'wfs_page_{index}', 'geojson' if outputformat else 'gml')
+        for attempt in range(retries + 1):
+            start = time.time()
+            try:
+                response = Wfs.request(sessions.session, source, parameters)
+                if b'ExceptionReport' in response.content[:500]:
+                    raise IOError(response.text[:500])
+                with open(path, 'wb') as file:
+                    file.write(response.content)
+                return {'index': index, 'path': path, 'bytes': len(response.content), 'seconds': time.time() - start}
+            except Exception as error:
+                if attempt == retries:
+                    raise
+                wait = 2 ** attempt
+                logger.info(f'Page {index} failed ({type(error).__name__}  –  {str(error)[:200]}), retrying in {wait} s')
+                time.sleep(wait)
+
+    def download(uri: str, page_size: int = 1000, workers: int = 4, retries: int = 3):
+        """
+        Downloads a WFS layer in concurrent pages.
+
+        Args:
+            uri (string): The WFS uri, as accepted by Input_Reader.wfs
+            page_size (integer): Number of features in each page
+            workers (integer): Number of pages downloaded at the same time
+            retries (integer): Number of retries for a failing page
+
+        Returns:
+            layer (QgsVectorLayer): The downloaded layer, or None if the service can not be read in sorted pages
+        """
+
+        source = Wfs.parse(uri)
+        if source['unsupported']:
+            logger.info(f'The parameters {source["unsupported"]} are only supported by the WFS provider, reading without paging')
+            return None
+
+        import requests
+        session = requests.Session()
+        outputformat, paging, sorting = Wfs.capabilities(session, source)
+        if not paging:
+            logger.info('The server does not implement result paging, reading without paging')
+            return None
+        total = Wfs.hits(session, source)
+        if total is None:
+            logger.info('The server does not report the number of features, reading without paging')
+            return None
+        sortby = Wfs.sort_key(session, source) if sorting else None
+        if sortby is None:
+            ## Without SORTBY the order may change between requests, and pages could repeat or miss features
+            logger.info('The pages can not be sorted on an id property, reading without paging')
+            return None
+        logger.info(f'WFS reports {total} features, downloading {-(-total // page_size)} pages of {page_size} with {workers} workers as {outputformat or "GML"}')
+
+        start = time.time()
+        sessions = threading.local()
+        pages = []
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(Wfs.fetch_page, sessions, source, index, startindex, page_size, outputformat, retries, sortby)
+                           for index, startindex in enumerate(range(0, total, page_size))]
+                for future in as_completed(futures):
+                    page = future.result()
+                    pages.append(page)
+                    logger.info(f'Page {page["index"]} downloaded, {round(page["bytes"] / 1024**2, 2)} MB in {round(page["seconds"], 2)} s ({len(pages)}/{len(futures)})')
+            downloaded = time.time() - start
+            megabytes = sum(page['bytes'] for page in pages) / 1024**2
+            logger.info(f'Downloaded {round(megabytes, 2)} MB in {round(downloaded, 2)} s ({round(megabytes / downloaded, 2) if downloaded > 0 else megabytes} MB/s)')
+
+            pages.sort(key=lambda page: page['index'])
+            layer = Wfs.assemble([page['path'] for page in pages], source['srsname'])
+        finally:
+            for page in pages:
+                delete_intermediate(page['path'])
+                delete_intermediate(page['path'][:page['path'].rfind('.')] + '.gfs')
+
+        seconds = time.time() - start
+        if layer.featureCount() != total:
+            logger.info(f'Warning: the server reported {total} features, but {layer.featureCount()} features were downloaded')
+        logger.info(f'Read {layer.featureCount()} features in {round(seconds, 2)} s ({round(layer.featureCount() / seconds) if seconds > 0 else layer.featureCount()} features/s)')
+        return layer
+
+    def assemble(paths: list, srsname: str = ''):
+        """
+        Assembles the downloaded pages into one layer. Fields with conflicting types between pages are read as strings.
+        The layer gets the requested srsname, as OGR reports GeoJSON pages as EPSG:4326 whatever the server sent them in.
+        """
+
+        layers = [QgsVectorLayer(path, f'page_{index}', 'ogr') for index, path in enumerate(paths)]
+        fields = QgsFields()
+        for layer in layers:
+            for field in layer.fields():
+                index = fields.lookupField(field.name())
+                if index == -1:
+                    fields.append(QgsField(field))
+                elif fields.at(index).type() != field.type() and fields.at(index).type() != QVariant.String:
+                    fields.remove(index)
+                    fields.append(QgsField(field.name(), QVariant.String))
+
+        wkbTypes = [layer.wkbType() for layer in layers if layer.isValid() and layer.wkbType() not in (QgsWkbTypes.NoGeometry, QgsWkbTypes.Unknown)]
+        wkbType = wkbTypes[0] if wkbTypes else QgsWkbTypes.NoGeometry
+        multi = any(QgsWkbTypes.isMultiType(type) for type in wkbTypes)
+        if multi:
+            wkbType = QgsWkbTypes.multiType(wkbType)
+        crs = layers[0].crs() if layers else QgsCoordinateReferenceSystem()
+        if srsname:
+            requested = QgsCoordinateReferenceSystem()
+            if requested.createFromUserInput(srsname):
+                crs = requested
+            else:
+                logger.info(f'Unable to read the srsname {srsname}, using the CRS of the pages')
+
+        sink = IntermediateSink('WFS_Layer', fields, wkbType, crs, layers)
+        batch = []
+        for layer in layers:
+            mapping = [fields.lookupField(field.name()) for field in layer.fields()]
+            for feature in layer.getFeatures():
+                output = QgsFeature(fields)
+                attributes = [None] * fields.count()
+                for source, value in zip(mapping, feature.attributes()):
+                    attributes[source] = value
+                output.setAttributes(attributes)
+                if feature.hasGeometry():
+                    geometry = feature.geometry()
+                    if multi:
+                        geometry.convertToMultiType()
+                    output.setGeometry(geometry)
+                batch.append(output)
+                if len(batch) >= BATCH_SIZE:
+                    sink.addFeatures(batch)
+                    batch = []
+        if batch:
+            sink.addFeatures(batch)
+        layers = None
+        return sink.finish()
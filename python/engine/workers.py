@@ -1,13 +1,20 @@
 from core.logger import *
 from core.misc import script_failed
-import sys, os
+import sys, os, time
 import shutil
 import sqlite3
 from core.misc import get_config, layerHasFeatures
 from qgis.analysis import QgsNativeAlgorithms
 from qgis.core import QgsCoordinateReferenceSystem, QgsVectorLayer, QgsProcessingFeedback, QgsProperty
-from qgis import processing
-import requests
+from engine.pipeline import run_algorithm, LazyLayer, DropFields, RenameField, AutoIncrement, Calculate, Filter, Refactor, FIELD_TYPES
+from engine.parallel import Parallel
+from engine.batch import Batch
+from engine.downloads import Downloader
+from engine.archives import Archive
+from engine.spatialindex import SpatialIndex
+from engine.expressions import calculate
+from engine.geometries import shapely_engine
+from engine.databases import ConnectionPool
 
 
 class Worker:
@@ -38,6 +45,13 @@ class Worker:
     ## The shared element for logging across all workers
     logger = get_logger() 
 
+    ## Lazy mode - per-feature workers build up a plan that is run in one pass when the data is needed.
+    ## Enabled with "LazyPipeline" in settings.json, or by setting Worker.lazy_pipeline = True in the script.
+    lazy_pipeline = bool(get_config().get('LazyPipeline', False))
+
+    def is_lazy(layer):
+        return Worker.lazy_pipeline or isinstance(layer, LazyLayer)
+
 
     class Vector:
         '''
@@ -64,7 +78,7 @@ class Worker:
                     'FIELD': field,
                     'OUTPUT': 'memory:extracted'
                 }
-                result = processing.run('native:createattributeindex', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:createattributeindex', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info(f'Parameters: {str(parameter)}')
                 logger.info("createattributeindex  finished")
                 return result
@@ -93,7 +107,7 @@ class Worker:
                     'CRS': crs,
                     'OUTPUT': 'memory:output_from_addxyfieldstolayer'
                 }
-                result = processing.run('native:addxyfieldstolayer', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:addxyfieldstolayer', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info(f'Parameters: {str(parameter)}')
                 logger.info("addxyfieldstolayer  finished")
                 return result
@@ -103,12 +117,13 @@ class Worker:
                 logger.critical("Program terminated" )
                 sys.exit()
 
-        def convexhull(layer: QgsVectorLayer):
+        def convexhull(layer: QgsVectorLayer, engine: str = 'qgis'):
             """
             Calculates the convex hull for each feature in an input layer.
 
             Args:
                 layer (QgsVectorLayer): Input vector layer
+                engine (string): Defaults to 'qgis'. 'shapely' runs it with Shapely 2 over arrays of geometries, falling back to QGIS when not supported
 
             Returns:
                 layer (QgsVectorLayer): Specify the output vector layer.
@@ -116,11 +131,16 @@ class Worker:
 
             logger.info(f" Calculating convexhull for layer {layer}")
             try:
+                if engine == 'shapely':
+                    result = shapely_engine('convexhull', layer)
+                    if result is not None:
+                        logger.info("convexhull  finished")
+                        return result
                 parameter = {
                     'INPUT': layer,
                     'OUTPUT': 'memory:output_from_convexhull'
                 }
-                result = processing.run('native:convexhull', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:convexhull', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info(f'Parameters: {str(parameter)}')
                 logger.info("convexhull  finished")
                 return result
@@ -154,7 +174,7 @@ class Worker:
                     'OUTPUT': 'memory:output_from_concavehull'
                 }
                 logger.info(f'Parameters: {str(parameters)}')
-                result = processing.run('native:concavehull', parameters, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:concavehull', parameters, feedback=Worker.progress)['OUTPUT']
                 logger.info('concavehull finished')
                 return result
             except Exception as error:
@@ -184,7 +204,7 @@ class Worker:
                     'OUTPUT': 'memory:output_from_extractvertices'
                 }
                 logger.info(f'Parameters: {str(parameters)}')
-                result = processing.run('native:extractvertices', parameters, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:extractvertices', parameters, feedback=Worker.progress)['OUTPUT']
                 logger.info('extractvertices finished')
                 return result
             except Exception as error:
@@ -222,7 +242,7 @@ class Worker:
                     'OUTPUT': 'memory:output_from_multiringconstantbuffer'
                 }
                 logger.info(f'Parameters: {str(parameters)}')
-                result = processing.run('native:multiringconstantbuffer', parameters, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:multiringconstantbuffer', parameters, feedback=Worker.progress)['OUTPUT']
                 logger.info('multiringconstantbuffer finished')
                 return result
             except Exception as error:
@@ -254,7 +274,7 @@ class Worker:
                     'OUTPUT': 'memory:output_from_poleofinaccessibility'
                 }
                 logger.info(f'Parameters: {str(parameters)}')
-                result = processing.run('native:poleofinaccessibility', parameters, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:poleofinaccessibility', parameters, feedback=Worker.progress)['OUTPUT']
                 logger.info('poleofinaccessibility finished')
                 return result
             except Exception as error:
@@ -264,7 +284,7 @@ class Worker:
                 script_failed()
 
 
-        def symmetricaldifference(inputlayer: QgsVectorLayer, overlay_layer: QgsVectorLayer):
+        def symmetricaldifference(inputlayer: QgsVectorLayer, overlay_layer: QgsVectorLayer, parallel: bool = None):
             """
             Creates a layer containing features from both the input and overlay layers but with the overlapping areas between the two layers removed.
             The attribute table of the symmetrical difference layer contains attributes and fields from both the input and overlay layers.
@@ -272,6 +292,7 @@ class Worker:
             Args:
                 inputlayer (QgsVectorLayer): First layer to extract (parts of) features from.
                 overlay_layer (QgsVectorLayer): Second layer to extract (parts of) features from. Ideally the geometry type should be the same as input layer.
+                parallel (boolean): Run on spatial tiles in a pool of worker processes. Defaults to the "Parallel" settings.
 
             Returns:
                 layer (QgsVectorLayer): Specify the layer to contain (the parts of) the features from the input and overlay layers that do not overlap features from the other layer
@@ -279,13 +300,17 @@ class Worker:
 
             logger.info('calcualting symetrical difference')
             try:
+                if Parallel.enabled(parallel):
+                    result = Parallel.symmetricaldifference(inputlayer, overlay_layer)
+                    logger.info('Symmetricaldifference finished')
+                    return result
                 parameters = {
                     'INPUT': inputlayer,
                     'OVERLAY' : overlay_layer,
                     'OUTPUT': 'memory:output_from_symmetricaldifference'
                 }
                 logger.info(f'Parameters: {str(parameters)}')
-                result = processing.run('native:symmetricaldifference', parameters, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:symmetricaldifference', parameters, feedback=Worker.progress)['OUTPUT']
                 logger.info('Symmetricaldifference finished')
                 return result
             except Exception as error:
@@ -319,7 +344,7 @@ class Worker:
                     'OUTPUT': 'memory:output_from_lineintersections'
                 }
                 logger.info(f'Parameters: {str(parameters)}')
-                result = processing.run('native:lineintersections', parameters, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:lineintersections', parameters, feedback=Worker.progress)['OUTPUT']
                 logger.info('Lineintersections finished')
                 return result
             except Exception as error:
@@ -350,7 +375,7 @@ class Worker:
                     'OUTPUT': 'memory:output_from_kmeansclustering'
                 }
                 logger.info(f'Parameters: {str(parameters)}')
-                result = processing.run('native:kmeansclustering', parameters, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:kmeansclustering', parameters, feedback=Worker.progress)['OUTPUT']
                 logger.info('Kmeansclustering finished')
                 return result
             except Exception as error:
@@ -382,7 +407,7 @@ class Worker:
                     'OUTPUT': 'memory:output_from_dbscanclustering'
                 }
                 logger.info(f'Parameters: {str(parameters)}')
-                result = processing.run('native:dbscanclustering', parameters, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:dbscanclustering', parameters, feedback=Worker.progress)['OUTPUT']
                 logger.info('Dbscanclustering finished')
                 return result
             except Exception as error:
@@ -421,7 +446,7 @@ class Worker:
                     'OUTPUT': 'memory:output_from_countpointsinpolygon'
                 }
                 logger.info(f'Parameters: {str(parameters)}')
-                result = processing.run('native:Countpointsinpolygon', parameters, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:Countpointsinpolygon', parameters, feedback=Worker.progress)['OUTPUT']
                 logger.info('Promote to multipart finished')
                 return result
             except Exception as error:
@@ -430,12 +455,13 @@ class Worker:
                 logger.critical("Program terminated" )
                 script_failed()  
 
-        def promoteToMultipart(layer: QgsVectorLayer):
+        def promoteToMultipart(layer: QgsVectorLayer, engine: str = 'qgis'):
             """
             Generates a vectorlayer in which all geometries are multipart.
 
             Args:
                 layer (QgsVectorLayer): The QgsVectorLayer that is used as input.
+                engine (string): Defaults to 'qgis'. 'shapely' runs it with Shapely 2 over arrays of geometries, falling back to QGIS when not supported
 
             Returns:
                 layer (QgsVectorLayer): The QgsVectorLayer containing multi geometries.
@@ -443,12 +469,17 @@ class Worker:
 
             logger.info('Collecting geometries')
             try:
+                if engine == 'shapely':
+                    result = shapely_engine('multipart', layer)
+                    if result is not None:
+                        logger.info("Promote to multipart finished")
+                        return result
                 parameters = {
                     'INPUT': layer,
                     'OUTPUT': 'memory:multipart'
                 }
                 logger.info(f'Parameters: {str(parameters)}')
-                result = processing.run('native:promotetomulti', parameters, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:promotetomulti', parameters, feedback=Worker.progress)['OUTPUT']
                 logger.info('Promote to multipart finished')
                 return result
             except Exception as error:
@@ -471,6 +502,9 @@ class Worker:
             """
 
             logger.info("Extracting by expression")
+            if Worker.is_lazy(layer):
+                logger.info(f'Adding extractByExpression to lazy pipeline: {expression}')
+                return LazyLayer.of(layer).then(Filter(expression))
             try:
                 parameter = {
                     'INPUT': layer,
@@ -478,7 +512,7 @@ class Worker:
                     'OUTPUT': 'memory:extracted'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:extractbyexpression', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:extractbyexpression', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("Extractbyexpression  finished")
                 return result
             except Exception as error:
@@ -503,6 +537,9 @@ class Worker:
             """
 
             logger.info("Renaming field")
+            if Worker.is_lazy(layer):
+                logger.info(f'Adding renameTableField to lazy pipeline: {field} -> {newname}')
+                return LazyLayer.of(layer).then(RenameField(field, newname))
             try:
                 parameter = {
                     'INPUT': layer,
@@ -510,7 +547,7 @@ class Worker:
                     'NEW_NAME': newname,
                     'OUTPUT': 'memory:extracted'
                 }
-                result = processing.run('native:renametablefield', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:renametablefield', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info(f'Parameters: {str(parameter)}')
                 logger.info("renameTableField  finished")
                 return result
@@ -520,23 +557,24 @@ class Worker:
                 logger.critical("Program terminated" )
                 sys.exit()
 
-        def timeStamper(layer: QgsVectorLayer, ts_fieldname: str):
+        def timeStamper(layer: QgsVectorLayer, ts_fieldname: str, engine: str = 'qgis'):
             """
             Create an attribute woth current timestamp on features.
 
             Args:
                 layer (QgsVectorLayer): The QgsVectorLayer input for the algorithem
                 ts_fieldname (string): The name of the new timestamp field
+                engine (string): Defaults to 'qgis'. 'numpy' writes the timestamp in batches, see fieldCalculator
 
             Returns:
                 layer (QgsVectorLayer): The result output from the algorithem
             """
 
             logger.info(f'Creating timestamp {ts_fieldname} using fieldCalculator')
-            newLayer = Worker.fieldCalculator(layer, ts_fieldname, 5, 0, 0, ' now() ')
+            newLayer = Worker.Vector.fieldCalculator(layer, ts_fieldname, 5, 0, 0, ' now() ', engine=engine)
             return newLayer
 
-        def fieldCalculator (layer: QgsVectorLayer, fieldname: str, fieldtype: int, fieldlength: int, fieldprecision: int, formula: str):
+        def fieldCalculator (layer: QgsVectorLayer, fieldname: str, fieldtype: int, fieldlength: int, fieldprecision: int, formula: str, engine: str = 'qgis'):
             """
             Scripting the field calcualtor
             You can use all the supported expressions and functions.
@@ -550,12 +588,31 @@ class Worker:
                 fieldlength (integer): Lenght of the field, Default: 10.
                 fieldprecision (integer): Precision of the field, Default: 3.
                 formula (string): The expression that populates the values of the field.
+                engine (string): Defaults to 'qgis'. With 'numpy', common expressions (arithmetic, string concatenation, constants,
+                    now(), $area, $length and CASE) are evaluated as numpy column operations over batches of features.
+                    Other expressions, or a missing numpy, fall back to the QGIS evaluator. The log tells which was used.
 
             Returns:
                 layer (QgsVectorLayer): The result output from the algorithem
             """
 
             logger.info("Calculating field")
+            if engine == 'numpy':
+                try:
+                    result = calculate(layer, fieldname, fieldtype, fieldlength, fieldprecision, formula)
+                except Exception as error:
+                    logger.error("An error occured in fieldCalculator")
+                    logger.error(f'{type(error).__name__}  –  {str(error)}')
+                    logger.critical("Program terminated" )
+                    sys.exit()
+                if result is not None:
+                    logger.info("fieldCalculator  finished")
+                    return result
+            elif engine != 'qgis':
+                logger.info(f'Unknown engine {engine}, using qgis')
+            if Worker.is_lazy(layer) and fieldtype in FIELD_TYPES:
+                logger.info(f'Adding fieldCalculator to lazy pipeline: {fieldname} = {formula}')
+                return LazyLayer.of(layer).then(Calculate(fieldname, fieldtype, fieldlength, fieldprecision, formula))
             try:
                 parameter = {
                     'INPUT': layer,
@@ -566,7 +623,7 @@ class Worker:
                     'FORMULA': formula,
                     'OUTPUT': 'memory:extracted'
                 }
-                result = processing.run('native:fieldcalculator', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:fieldcalculator', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info(f'Parameters: {str(parameter)}')
                 logger.info("fieldCalculator  finished")
                 return result
@@ -589,6 +646,9 @@ class Worker:
             """
 
             logger.info("deleting fields")
+            if Worker.is_lazy(layer):
+                logger.info(f'Adding deleteColumns to lazy pipeline: {columns}')
+                return LazyLayer.of(layer).then(DropFields(columns))
 
             try:
                 parameter = {
@@ -596,7 +656,7 @@ class Worker:
                     'COLUMN':columns,
                     'OUTPUT': 'memory:extracted'
                 }
-                result = processing.run('native:deletecolumn', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:deletecolumn', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info(f'Parameters: {str(parameter)}')
                 logger.info("deleteColumns  finished")
                 return result
@@ -623,6 +683,9 @@ class Worker:
             """
 
             logger.info("Adding incremental field")
+            if Worker.is_lazy(layer):
+                logger.info(f'Adding addAutoIncrementalField to lazy pipeline: {fieldname}')
+                return LazyLayer.of(layer).then(AutoIncrement(fieldname, start))
             try:
                 parameter = {
                     'INPUT': layer,
@@ -635,7 +698,7 @@ class Worker:
                     'SORT_NULLS_FIRST':False,
                     'OUTPUT': 'memory:extracted'
                 }
-                result = processing.run('native:addautoincrementalfield', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:addautoincrementalfield', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info(f'Parameters: {str(parameter)}')
                 logger.info("addAutoIncrementalField  finished")
                 return result
@@ -644,6 +707,37 @@ class Worker:
                 logger.error(f'{type(error).__name__}  –  {str(error)}')
                 logger.critical("Program terminated" )
                 sys.exit()
+
+        def refactorFields(layer: QgsVectorLayer, mapping: list, keep_unmapped: bool = False):
+            """
+            Renames, drops, casts and adds fields in one pass over the layer, instead of a chain of renameTableField, deleteColumns,
+            addAutoIncrementalField and fieldCalculator calls each copying the layer.
+            Expressions are evaluated against the fields of the input layer.
+
+            Args:
+                layer (QgsVectorLayer): The QgsVectorLayer input for the algorithem
+                mapping (list of dictionaries): The output fields, e.g.
+                    [{'field': 'navn'},                                  keep
+                     {'field': 'kode', 'name': 'code'},                  rename
+                     {'field': 'height', 'type': 0},                     cast, with the field types of fieldCalculator
+                     {'field': 'tmp', 'drop': True},                     drop
+                     {'name': 'area', 'expression': '$area', 'type': 0}, expression
+                     {'name': 'id', 'autoincrement': 1}]                 auto-increment from a start value
+                    Entries can also set 'length' and 'precision'.
+                keep_unmapped (boolean): Defaults to False, where the output has the fields of the mapping in its order.
+                    With True, the fields not in the mapping are kept in their place and the new fields are appended.
+
+            Returns:
+                layer (QgsVectorLayer): The result output from the algorithem
+            """
+
+            logger.info("Refactoring fields")
+            if Worker.is_lazy(layer):
+                logger.info(f'Adding refactorFields to lazy pipeline: {len(mapping)} mapped fields')
+                return LazyLayer.of(layer).then(Refactor(mapping, keep_unmapped))
+            result = LazyLayer(layer, [Refactor(mapping, keep_unmapped)]).materialize()
+            logger.info("refactorFields  finished")
+            return result
     
         def spatialindex(layer: QgsVectorLayer):
             """
@@ -663,7 +757,7 @@ class Worker:
                     'INPUT': layer,
                     'OUTPUT': 'memory:extracted'
                 }
-                result = processing.run('native:createspatialindex', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:createspatialindex', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info(f'Parameters: {str(parameter)}')
                 logger.info("createspatialindex  finished")
                 return result
@@ -673,7 +767,7 @@ class Worker:
                 logger.critical("Program terminated" )
                 sys.exit()
             
-        def clip(layer: QgsVectorLayer, overlay: str):
+        def clip(layer: QgsVectorLayer, overlay: QgsVectorLayer, parallel: bool = None):
             """
             Clips a vector layer using the features of an additional polygon layer.
             Only the parts of the features in the input layer that fall within the polygons of 
@@ -682,6 +776,7 @@ class Worker:
             Args:
                 layer (QgsVectorLayer): Layer containing the features to be clipped
                 overlay (QgsVectorLayer): Layer containing the clipping features
+                parallel (boolean): Run on spatial tiles in a pool of worker processes. Defaults to the "Parallel" settings.
 
             Returns:
                 layer (QgsVectorLayer): Layer to contain the features from the input layer that are inside the overlay (clipping) layer
@@ -689,13 +784,17 @@ class Worker:
 
             logger.info("Clipping layers")
             try:
+                if Parallel.enabled(parallel):
+                    result = Parallel.overlay('native:clip', layer, overlay)
+                    logger.info("Clip  finished")
+                    return result
                 parameter = {
                     'INPUT': layer,
                     'OVERLAY': overlay,
                     'OUTPUT': 'memory:extracted'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:clip', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:clip', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("Clip  finished")
                 return result
             except Exception as error:
@@ -711,6 +810,8 @@ class Worker:
             The additional attributes and their values are taken from a second vector layer.
             A spatial criteria is applied to select the values from the second layer that are added to each 
             feature from the first layer.
+            Join features outside the extent of the input layer are filtered out with a bounding box request before the algorithm runs,
+            and a spatial index is built on the layer the algorithm searches, if it has none.
             
             Args:
                 layer (QgsVectorLayer): Input vector layer. The output layer will consist of the features of this layer with attributes from matching features in the second layer.
@@ -725,8 +826,11 @@ class Worker:
                 layer (QgsVectorLayer): the output vector layer for the join.
             """
 
-            logger.info("Clipping layers")
+            logger.info("Joining layers by location")
             try:
+                start = time.time()
+                layer, join = SpatialIndex.prepare('native:joinattributesbylocation', layer, join, predicate, 'join', discard_nomatching, method)
+                prepared = time.time()
                 parameter = {
                     'INPUT': layer,
                     'PREDICATE':predicate,
@@ -738,7 +842,8 @@ class Worker:
                     'OUTPUT': 'memory:extracted'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:joinattributesbylocation', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:joinattributesbylocation', parameter, feedback=Worker.progress)['OUTPUT']
+                logger.info(f'Inputs prepared in {round(prepared - start, 2)} s, joined in {round(time.time() - prepared, 2)} s')
                 logger.info("joinByLocation finished")
                 return result
             except Exception as error:
@@ -748,7 +853,10 @@ class Worker:
                 sys.exit()
 
         def extractByLocation(layer: QgsVectorLayer, predicate: int, intersect: str):
-            """_summary_
+            """
+            Extracts the features of the input layer that have the spatial relation with the features of the intersect layer.
+            Features outside the extent of the other layer are filtered out with a bounding box request before the algorithm runs,
+            and a spatial index is built on the layer the algorithm searches, if it has none.
 
             Args:
                 layer (QgsVectorLayer): Input vector layer. 
@@ -761,6 +869,9 @@ class Worker:
 
             logger.info("Extracting by location")
             try:
+                start = time.time()
+                layer, intersect = SpatialIndex.prepare('native:extractbylocation', layer, intersect, predicate, 'intersect')
+                prepared = time.time()
                 parameter = {
                     'INPUT': layer,
                     'PREDICATE':predicate,
@@ -768,7 +879,8 @@ class Worker:
                     'OUTPUT': 'memory:extracted'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:extractbylocation', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:extractbylocation', parameter, feedback=Worker.progress)['OUTPUT']
+                logger.info(f'Inputs prepared in {round(prepared - start, 2)} s, extracted in {round(time.time() - prepared, 2)} s')
                 logger.info("extractByLocation finished")
                 return result
             except Exception as error:
@@ -801,7 +913,7 @@ class Worker:
                     'OUTPUT': 'memory:extracted'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:randomextract', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:randomextract', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("randomExtract finished")
                 return result
             except Exception as error:
@@ -810,7 +922,7 @@ class Worker:
                 logger.critical("Program terminated" )
                 sys.exit()
 
-        def difference(layer: QgsVectorLayer, overlay: QgsVectorLayer):
+        def difference(layer: QgsVectorLayer, overlay: QgsVectorLayer, parallel: bool = None):
             """
             Extracts features from the input layer that don’t fall within the boundaries of the overlay layer.
             Input layer features that partially overlap the overlay layer feature(s) are split along the 
@@ -819,6 +931,7 @@ class Worker:
             Args:
                 layer (QgsVectorLayer): Layer to extract (parts of) features from.
                 overlay (QgsVectorLayer): Layer containing the geometries that will be subtracted from the iniput layer geometries
+                parallel (boolean): Run on spatial tiles in a pool of worker processes. Defaults to the "Parallel" settings.
 
             Returns:
                 layer (QgsVectorLayer): The result output from the algorithem
@@ -826,13 +939,17 @@ class Worker:
 
             logger.info("Finding differences")
             try:
+                if Parallel.enabled(parallel):
+                    result = Parallel.overlay('native:difference', layer, overlay)
+                    logger.info("Difference  finished")
+                    return result
                 parameter = {
                     'INPUT': layer,
                     'OVERLAY': overlay,
                     'OUTPUT': 'memory:extracted'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:difference', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:difference', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("Difference  finished")
                 return result
             except Exception as error:
@@ -865,7 +982,7 @@ class Worker:
                     'OUTPUT': 'memory:Reprojected'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:reprojectlayer', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:reprojectlayer', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("Reproject finished")
                 return result
             except Exception as error:
@@ -874,7 +991,7 @@ class Worker:
                 logger.critical("Program terminated" )
                 sys.exit()
 
-        def simplify(layer: QgsVectorLayer, method: int, tolerance:int):
+        def simplify(layer: QgsVectorLayer, method: int, tolerance:int, engine: str = 'qgis'):
                 """
                 Simplifies the geometries in a line or polygon layer. 
                 It creates a new layer with the same features as the ones in the input layer, but with geometries containing a lower number of vertices.
@@ -884,6 +1001,7 @@ class Worker:
                     layer (QgsVectorLayer): The QgsVectorLayer input for the algorithem
                     method (integer): Simplification method. One of: 0 — Distance (Douglas-Peucker), 1 — Snap to grid, 2 — Area (Visvalingam)
                     tolerance (integer): Threshold tolerance (in units of the layer): if the distance between two nodes is smaller than the tolerance value, the segment will be simplified and vertices will be removed.
+                    engine (string): Defaults to 'qgis'. 'shapely' runs it with Shapely 2 over arrays of geometries, falling back to QGIS when not supported
 
                 Returns:
                     layer (QgsVectorLayer): The result output from the algorithem
@@ -893,6 +1011,11 @@ class Worker:
                 if layerHasFeatures(layer):
                     logger.info("Processing " + str(layer.featureCount()) +" features")
                 try:
+                    if engine == 'shapely':
+                        result = shapely_engine('simplify', layer, method, tolerance)
+                        if result is not None:
+                            logger.info("Simplifygeometries finished")
+                            return result
                     parameter = {
                         'INPUT': layer,
                         'METHOD':method,
@@ -900,7 +1023,7 @@ class Worker:
                         'OUTPUT': 'memory:simplify'
                     }
                     logger.info(f'Parameters: {str(parameter)}')
-                    result = processing.run('native:simplifygeometries', parameter, feedback=Worker.progress)['OUTPUT']
+                    result = run_algorithm('native:simplifygeometries', parameter, feedback=Worker.progress)['OUTPUT']
                     logger.info("Simplifygeometries finished")
                     return result
                 except Exception as error:
@@ -932,7 +1055,7 @@ class Worker:
                     'INPUT': layer,
                     'OUTPUT': 'memory:forced'
                 }
-                result = processing.run('native:forcerhr', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:forcerhr', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("forceRHR finished")
                 return result
             except Exception as error:
@@ -979,7 +1102,7 @@ class Worker:
                     'OUTPUT': 'memory:joined'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:joinattributestable', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:joinattributestable', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("Joinattributestable finished")
                 if layerHasFeatures(result):
                     logger.info("Returning " + str(result.featureCount()) +" features")
@@ -1018,7 +1141,7 @@ class Worker:
                     'OUTPUT': 'memory:dissolved'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:dissolve', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:dissolve', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("DissolveFeatures finished")
                 if layerHasFeatures(result):
                     logger.info("Returning " + str(result.featureCount()) +" features")
@@ -1029,7 +1152,7 @@ class Worker:
                 logger.critical("Program terminated" )
                 sys.exit()
 
-        def bufferLayer(layer: QgsVectorLayer, distance: int, segements: int, endcapStyle: int, joinStyle: int, miterLimit: int, dissolve: bool):
+        def bufferLayer(layer: QgsVectorLayer, distance: int, segements: int, endcapStyle: int, joinStyle: int, miterLimit: int, dissolve: bool, engine: str = 'qgis'):
             """
             Computes a buffer area for all the features in an input layer, using a fixed or data defined distance.
             It is possible to use a negative distance for polygon input layers.
@@ -1044,6 +1167,7 @@ class Worker:
                 joinStyle (integer): Specifies whether round, miter or beveled joins should be used when offsetting corners in a line. Default: 0 (Options are: 0 — Round, 1 — Miter, 2 — Bevel)
                 miterLimit (integer): Sets the maximum distance from the offset geometry to use when creating a mitered join as a factor of the offset distance Default: 0, Minimum: 1
                 dissolve (boolean): Dissolve the final buffer. Default: false.
+                engine (string): Defaults to 'qgis'. 'shapely' runs it with Shapely 2 over arrays of geometries, falling back to QGIS when not supported
 
             Returns:
                 layer (QgsVectorLayer): The result output from the algorithem
@@ -1053,6 +1177,11 @@ class Worker:
             if layerHasFeatures(layer):
                 logger.info("Processing " + str(layer.featureCount()) +" features")
             try:
+                if engine == 'shapely':
+                    result = shapely_engine('buffer', layer, distance, segements, endcapStyle, joinStyle, miterLimit, dissolve)
+                    if result is not None:
+                        logger.info("BufferLayer finished")
+                        return result
                 parameter = {
                     'INPUT': layer,
                     'DISTANCE': distance,
@@ -1064,7 +1193,7 @@ class Worker:
                     'OUTPUT': 'memory:buffer'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:buffer', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:buffer', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("BufferLayer finished")
                 return result
             except Exception as error:
@@ -1095,7 +1224,7 @@ class Worker:
                     'OUTPUT': 'memory:buffer'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:fixgeometries', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:fixgeometries', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("FixGeometry finished")
                 return result
             except Exception as error:
@@ -1104,7 +1233,7 @@ class Worker:
                 logger.critical("Program terminated" )
                 sys.exit()
 
-        def createCentroids(layer: str):
+        def createCentroids(layer: str, engine: str = 'qgis'):
             """
             Creates a new point layer, with points representing the centroids of the geometries of the input layer.
             The centroid is a single point representing the barycenter (of all parts) of the feature, so it can be outside the feature borders. But can also be a point on each part of the feature.
@@ -1112,6 +1241,7 @@ class Worker:
 
             Args:
                 layer (QgsVectorLayer): The QgsVectorLayer input for the algorithem
+                engine (string): Defaults to 'qgis'. 'shapely' runs it with Shapely 2 over arrays of geometries, falling back to QGIS when not supported
 
             Returns:
                 layer (QgsVectorLayer): The result output from the algorithem
@@ -1121,13 +1251,18 @@ class Worker:
             if layerHasFeatures(layer):
                 logger.info("Processing " + str(layer.featureCount()) +" features")
             try:
+                if engine == 'shapely':
+                    result = shapely_engine('centroids', layer)
+                    if result is not None:
+                        logger.info("Centroids finished")
+                        return result
                 parameter = {
                     'INPUT': layer,
                     'ALL_PARTS':False,
                     'OUTPUT': 'memory:buffer'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:centroids', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:centroids', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("Centroids finished")
                 return result
             except Exception as error:
@@ -1162,7 +1297,7 @@ class Worker:
                     'OUTPUT': 'memory:buffer'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:randomextract', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:randomextract', parameter, feedback=Worker.progress)['OUTPUT']
                 if layerHasFeatures(result):
                     logger.info("Returning " + str(result.featureCount()) +" features")
                 logger.info("randomextract finished")
@@ -1180,11 +1315,13 @@ class Worker:
             The database type must be specified in the 'database' parameter (one of 'Mssql' or 'Postgres')
             The default Mssql driver is 'SQL Server' - if this needs to be overwritten, specify the parameter driver, else leave it empty.
             SQL statments must be trippel double-quoted - prepare the statement in the QGIS sql executor tool for testing. 
+            The connection is taken from a pool shared by the job, and the statement is committed when it has been executed.
+            A list of statements is run in one transaction.
 
             Args:
                 connection (string): Name of a database connection from settings.json
                 databasetype (string): The database type, one of 'Mssql' or 'Postgres'.
-                sql_expression (string): The SQL expression to be executed. Use trippel double-quotes arraound the expression
+                sql_expression (string or list): The SQL expression to be executed, or a list of expressions. Use trippel double-quotes arraound the expression
                 pgdb_name (string): Name of postgres database if databasetype is  Postgres. Defaults to None.
                 driver (string): Defaults to None. The name of the Mssql driver, if 'SQL Server' is not working.
 
@@ -1193,44 +1330,46 @@ class Worker:
 
             """
 
-            config = get_config()
+            statements = [sql_expression] if isinstance(sql_expression, str) else list(sql_expression)
+            Worker.Vector.execute_sql_batch(connection, databasetype, statements, pgdb_name, driver)
+            return 0
+
+        def execute_sql_batch(connection, databasetype, statements: list, pgdb_name=None, driver=None):
+            """
+            Execute a list of SQL statements against a database in one transaction, using a connection from the pool shared by the job.
+            Each statement is either an SQL string, or a tuple of an SQL string with placeholders and a list of parameter rows,
+            which is run with executemany. Placeholders are %s for 'Postgres' and ? for 'Mssql'.
+            If a statement fails, the whole transaction is rolled back.
+
+            Args:
+                connection (string): Name of a database connection from settings.json
+                databasetype (string): The database type, one of 'Mssql' or 'Postgres'.
+                statements (list): The statements to execute, e.g. ["TRUNCATE t", ("INSERT INTO t (a, b) VALUES (%s, %s)", [(1, 'x'), (2, 'y')])]
+                pgdb_name (string): Name of postgres database if databasetype is  Postgres. Defaults to None.
+                driver (string): Defaults to None. The name of the Mssql driver, if 'SQL Server' is not working.
+
+            Returns:
+                results (list of dictionaries): The sql, the number of affected rows ('rowcount') and the time in seconds ('seconds') of each statement.
+            """
+
             if databasetype in ('Postgres', 'Mssql'):
-                logger.info(f'Running SQL executor on {databasetype}' )
+                logger.info(f'Running SQL executor on {databasetype} with {len(statements)} statements' )
             else :
                 logger.info(f'Unsupported database: {databasetype}, use one of "Mssql" or "Postgres"' )
                 logger.critical("Program terminated" )
                 sys.exit()
             try:
-                dbconnection = config['DatabaseConnections'][connection]
-                if databasetype == 'Mssql':
-                    import pyodbc 
-                    if driver == "":
-                        mssqldriver = 'SQL Server'
-                    else :
-                        mssqldriver = 'driver'
-                    cnxn = pyodbc.connect('DRIVER={'+mssqldriver+'};Server='+dbconnection['host']+';Database='+dbconnection['databasename']+';User ID='+dbconnection['user']+';Password='+dbconnection['password'])
-                    logger.info("Using connection :" + 'DRIVER={'+mssqldriver+'};Server='+dbconnection['host']+';Database='+dbconnection['databasename']+';User ID='+dbconnection['user']+';Password=xxxxxxxx')
-                    cursor = cnxn.cursor()
-                    logger.info(f'Query: {sql_expression}' )
-                    cursor.execute(sql_expression) 
-                    logger.info("SQL executor finished")
-                    return 0
-                
-                if databasetype == 'Postgres':
-                    import psycopg2
-                    connection = psycopg2.connect(user=dbconnection['user'], password=dbconnection['password'], host=dbconnection['host'], port=dbconnection['port'], database=pgdb_name)
-                    logger.info("Using connection : user="+ dbconnection['user']+", password=xxxxxx, host="+dbconnection['host']+", port="+dbconnection['port']+", database="+pgdb_name )
-                    cursor = connection.cursor()
-                    logger.info(f'Query: {sql_expression}' )
-                    cursor.execute(sql_expression)
-                    connection.commit()
-                    cursor.close()
-                    connection.close()
-                    logger.info("SQL executor finished")
-                    return 0
-                    
+                start = time.time()
+                for statement in statements:
+                    logger.info(f'Query: {statement if isinstance(statement, str) else statement[0]}' )
+                results = ConnectionPool.run(databasetype, connection, statements, pgdb_name, driver)
+                for result in results:
+                    logger.info(f'{result["rowcount"]} rows affected in {result["seconds"]} s' )
+                logger.info(f'SQL executor finished in {round(time.time() - start, 2)} s')
+                return results
+
             except Exception as error:
-                logger.error("An error occured running SQL executor")
+                logger.error("An error occured running SQL executor, the transaction is rolled back")
                 logger.error(f'{type(error).__name__}  –  {str(error)}')
                 logger.critical("Program terminated" )
                 sys.exit()
@@ -1262,7 +1401,7 @@ class Worker:
                     'OUTPUT': 'memory:buffer'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:mergevectorlayers', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:mergevectorlayers', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info("Returning " + str(result.featureCount()) +" features")
                 logger.info("mergeVectorLayers finished")
                 return result
@@ -1291,7 +1430,7 @@ class Worker:
                         parameter = {'DATABASE':'{0}|layername={1}'.format(geopackage, layer),
                         'SQL':'drop table {0}'.format(layer)}
                         logger.info(f'Parameters: {str(parameter)}')
-                        processing.run("native:spatialiteexecutesql", parameter )
+                        run_algorithm("native:spatialiteexecutesql", parameter )
                         logger.info(f"Layer deleted")
                     logger.info(f"Finished deleting layers")
 
@@ -1324,7 +1463,7 @@ class Worker:
                     'OUTPUT': 'TEMPORARY_OUTPUT'
                 }
                 logger.info(f'Parameters: {str(parameter)}')
-                result = processing.run('native:assignprojection', parameter, feedback=Worker.progress)['OUTPUT']
+                result = run_algorithm('native:assignprojection', parameter, feedback=Worker.progress)['OUTPUT']
                 logger.info('Assigning projection finished')
                 return result
             except Exception as error:
@@ -1341,6 +1480,8 @@ class Worker:
         def download_file(url, local_filename):
             """
             Downloads a file from the given URL and saves it locally.
+            An interrupted download continues where it stopped when the job runs again, if the server accepts Range requests.
+            Large files are downloaded in concurrent byte ranges, as set in the "Downloads" settings.
 
             Args:
                 url (string): The URL of the file to download
@@ -1352,12 +1493,8 @@ class Worker:
 
             logger.info(f'Downloading file from {url}')
             try:
-                with requests.get(url, stream=True) as response:
-                    response.raise_for_status()
-                    with open(local_filename, 'wb') as file:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            file.write(chunk)
-                
+                with Downloader.session(Downloader.settings()['segments']) as session:
+                    Downloader.download(session, url, str(local_filename))
                 logger.info(f'Download completed: {local_filename}')
                 return True
             
@@ -1369,6 +1506,49 @@ class Worker:
             
             return False
 
+        def download_files(urls, folder: str = None, workers: int = None, segments: int = None, chunk_size_mb: float = None, stop_on_error: bool = True, skip_existing: bool = False):
+            """
+            Downloads a list of files concurrently over a shared connection pool.
+            Interrupted downloads continue where they stopped when the job runs again.
+            Large files are split into byte ranges downloaded at the same time, when the server accepts Range requests.
+            The defaults are read from the "Downloads" settings.
+
+            Args:
+                urls (list or dictionary): The urls to download, saved in folder with the name from the url, or a dictionary with the local path of each url
+                folder (string): The folder for a list of urls
+                workers (integer): Number of files downloaded at the same time
+                segments (integer): Number of byte ranges downloaded at the same time for each large file
+                chunk_size_mb (float): Size of the chunks read from the connection, in MB
+                stop_on_error (boolean): Defaults to True. Fail the job if a download fails, after the other downloads have finished
+                skip_existing (boolean): Defaults to False. Skip files that exist with the size of the file on the server. Only for files that do not change
+
+            Returns:
+                results (list of dictionaries): The url, path, bytes, seconds, resumed and error of each download
+            """
+
+            try:
+                if isinstance(urls, dict):
+                    downloads = {url: str(path) for url, path in urls.items()}
+                else:
+                    downloads = {url: os.path.join(folder, Downloader.filename(url)) for url in urls}
+                if len(set(downloads.values())) != len(downloads):
+                    raise ValueError('Two or more urls are saved to the same file, pass a dictionary with the local path of each url')
+                if not downloads:
+                    logger.info('No files to download')
+                    return []
+                chunk_size = int(chunk_size_mb * 1024**2) if chunk_size_mb else None
+                results = Downloader.download_many(downloads, workers, segments, chunk_size, skip_existing=skip_existing)
+            except Exception as error:
+                logger.error('An error occurred when downloading the files')
+                logger.error(f'{type(error).__name__}  –  {str(error)}')
+                logger.critical("Program terminated" )
+                script_failed()
+
+            if stop_on_error and any(result['error'] for result in results):
+                logger.critical("Program terminated" )
+                script_failed()
+            return results
+
         def folderTruncator(folder: str):
             """
             Deletes all contents of a folder (files and directories), but not the folder it self.
@@ -1474,6 +1654,51 @@ class Worker:
                 logger.critical("Program terminated" )
                 sys.exit()
 
+        def batch(files: list, pipeline, workers: int = None, stop_on_error: bool = False):
+            """
+            Runs a pipeline function on each file in a list, e.g. from lister, in a pool of worker processes.
+            Each process loads its own QGIS instance. A summary with the time and status of each file is logged at the end.
+
+            The processes import the job script again, so the pipeline function must be defined at the top level of the script,
+            and the rest of the script must be placed below the line if __name__ == '__main__':
+
+            Args:
+                files (list of strings): The files to process
+                pipeline (function): A function taking the path of one file, e.g. reading it and writing it to a database
+                workers (integer): Number of processes. Defaults to the number of cores. With 1, the files are processed one at a time in the job
+                stop_on_error (boolean): Defaults to False. If True, the job fails at the first failing file. If False, the other files are processed, and the failures are reported in the summary
+
+            Returns:
+                results (list of dictionaries): The file, status ('Finished' or 'Failed'), seconds, error and return value of each file
+            """
+
+            return Batch.run(files, pipeline, workers, stop_on_error)
+
+        def archive_lister(archive: str, file_extension: str = None):
+            """
+            Lists the vector datasets in a zip, tar, tar.gz or tgz archive, without unpacking it.
+            The paths point into the archive through /vsizip/ or /vsitar/, and can be read directly by the Input_Reader
+            methods, e.g. Input_Reader.geojson, or handed to File.batch.
+
+            Args:
+                archive (string): The full path to the archive.
+                file_extension (string): Only list datasets with this extension, e.g. '.geojson'. Defaults to all vector formats.
+
+            Returns:
+                list (list of strings): The paths of the datasets in the archive
+            """
+
+            logger.info(f'Listing {file_extension or "vector"} datasets in archive {archive}')
+            try:
+                filelist = [Archive.vsi_path(archive, member) for member in Archive.vector_members(archive, file_extension)]
+                logger.info(f'Archive lister returning {len(filelist)} elements')
+                return filelist
+            except Exception as error:
+                logger.error(f"An error occured listing the archive {archive}")
+                logger.error(f'{type(error).__name__}  –  {str(error)}')
+                logger.critical("Program terminated" )
+                script_failed()
+
         def existence_checker(input_path : str):
             """
             Checks if a specific file exists. Returns True if file exists, False if not.
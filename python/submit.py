@@ -0,0 +1,55 @@
+## Submits a job script to the Q-ETL engine daemon (daemon.py), and waits for it to finish.
+##
+## Usage:   python submit.py <FULL_PATH_TO_PYTHON_SCRIPT> [arguments]
+##          python submit.py --stop
+##
+## The exit code is 0 when the job finished, and 1 when it failed or the daemon could not be reached.
+## The client does not load QGIS, so any python interpreter can be used.
+
+import sys, os, json, time
+import socket
+from pathlib import Path
+
+## Seconds to keep trying to connect, while the daemon is starting or recycling its engine
+CONNECT_TIMEOUT = 120
+
+
+def get_config():
+    settings_file = Path(__file__).parent.parent / 'settings.json'
+    with open(settings_file, 'r') as f:
+        settings = json.load(f)
+    return settings
+
+def connect(host, port):
+    deadline = time.time() + CONNECT_TIMEOUT
+    while True:
+        try:
+            return socket.create_connection((host, port))
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(1)
+
+def submit(request):
+    daemon = {'host': '127.0.0.1', 'port': 7575}
+    daemon.update(get_config().get('Daemon', {}))
+    with connect(daemon['host'], daemon['port']) as connection:
+        connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        response = connection.makefile('r', encoding='utf-8').readline()
+    return json.loads(response)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: submit.py <FULL_PATH_TO_PYTHON_SCRIPT> [arguments] | --stop')
+        sys.exit(1)
+    try:
+        if sys.argv[1] == '--stop':
+            response = submit({'command': 'stop'})
+        else:
+            response = submit({'script': os.path.abspath(sys.argv[1]), 'args': sys.argv[2:], 'cwd': os.getcwd()})
+    except (OSError, ValueError) as error:
+        print(f'Could not reach the Q-ETL daemon: {type(error).__name__}  –  {str(error)}')
+        sys.exit(1)
+    print(json.dumps(response))
+    sys.exit(0 if response['status'] in ('Finished', 'Stopped') else 1)
@@ -0,0 +1,239 @@
+from core import *
+from engine import *
+
+## Benchmark of the workers, readers and writers on synthetic point, line and polygon layers, generated offline.
+## The results are written to tests/benchmark_results, in a file named after the Q-ETL and QGIS versions, so runs on
+## different versions can be compared.
+##
+## Usage: benchmark.py [sizes] [--geometries point line polygon] [--postgis CONNECTION DBNAME] [--compare RESULTFILE]
+## e.g.   benchmark.py 10000 100000 --postgis MyPostGIS benchmark
+
+import sys, os, json, time, random, math, argparse, platform
+from qgis.core import QgsFeature, QgsField, QgsFields, QgsGeometry, QgsPointXY, QgsWkbTypes, QgsCoordinateReferenceSystem, QgsMemoryProviderUtils
+from qgis.PyQt.QtCore import QVariant
+from engine.pipeline import resolve, BATCH_SIZE
+from engine.storage import tempfile_path, delete_intermediate
+
+parser = argparse.ArgumentParser(description='Q-ETL benchmark')
+parser.add_argument('sizes', nargs='*', type=int, default=[10000, 100000, 1000000, 5000000])
+parser.add_argument('--geometries', nargs='+', default=['point', 'line', 'polygon'])
+parser.add_argument('--postgis', nargs=2, metavar=('CONNECTION', 'DBNAME'))
+parser.add_argument('--compare', metavar='RESULTFILE')
+arguments = parser.parse_args(sys.argv[1:])
+
+reader = Input_Reader
+worker = Worker
+writer = Output_Writer
+config = get_config()
+
+## The extent of the synthetic data, in EPSG:25832
+XMIN, YMIN, XMAX, YMAX = 440000, 6050000, 890000, 6400000
+CRS = QgsCoordinateReferenceSystem('EPSG:25832')
+WKB_TYPES = {'point': QgsWkbTypes.Point, 'line': QgsWkbTypes.LineString, 'polygon': QgsWkbTypes.Polygon}
+
+
+def synthetic_layer(geometry: str, size: int):
+    ## Random features with the same seed for every run, so runs on different versions process the same data
+    rng = random.Random(42)
+    fields = QgsFields()
+    fields.append(QgsField('id', QVariant.Int))
+    fields.append(QgsField('value', QVariant.Double))
+    fields.append(QgsField('name', QVariant.String))
+    fields.append(QgsField('category', QVariant.Int))
+    layer = QgsMemoryProviderUtils.createMemoryLayer(f'synthetic_{geometry}', fields, WKB_TYPES[geometry], CRS)
+    provider = layer.dataProvider()
+    batch = []
+    for i in range(size):
+        x = rng.uniform(XMIN, XMAX)
+        y = rng.uniform(YMIN, YMAX)
+        if geometry == 'point':
+            shape = QgsGeometry.fromPointXY(QgsPointXY(x, y))
+        elif geometry == 'line':
+            points = [QgsPointXY(x, y)]
+            for vertex in range(4):
+                points.append(QgsPointXY(points[-1].x() + rng.uniform(-200, 200), points[-1].y() + rng.uniform(-200, 200)))
+            shape = QgsGeometry.fromPolylineXY(points)
+        else:
+            radius = rng.uniform(10, 150)
+            ring = [QgsPointXY(x + radius * math.cos(angle * math.pi / 4), y + radius * math.sin(angle * math.pi / 4)) for angle in range(8)]
+            shape = QgsGeometry.fromPolygonXY([ring + [ring[0]]])
+        feature = QgsFeature(fields)
+        feature.setGeometry(shape)
+        feature.setAttributes([i, rng.normalvariate(100, 25), f'feature_{i % 1000}', i % 10])
+        batch.append(feature)
+        if len(batch) >= BATCH_SIZE:
+            provider.addFeatures(batch)
+            batch = []
+    provider.addFeatures(batch)
+    layer.updateExtents()
+    return layer
+
+def overlay_layer():
+    ## A polygon covering the western half of the extent
+    wkt = f'POLYGON(({XMIN} {YMIN},{(XMIN + XMAX) / 2} {YMIN},{(XMIN + XMAX) / 2} {YMAX},{XMIN} {YMAX},{XMIN} {YMIN}))'
+    return Constructor.layerFromWKT('Polygon', [wkt], 25832)
+
+def workers(geometry: str, overlay):
+    ## The worker benchmarks for each geometry type, as (name, function of the input layer)
+    steps = [
+        ('Worker.Vector.reproject', lambda layer: worker.Vector.reproject(layer, 4326)),
+        ('Worker.Vector.extractByExpression', lambda layer: worker.Vector.extractByExpression(layer, '"value" > 100')),
+        ('Worker.Vector.fieldCalculator', lambda layer: worker.Vector.fieldCalculator(layer, 'calc', 0, 10, 2, '"value" * 2')),
+        ('Worker.Vector.deleteColumns', lambda layer: worker.Vector.deleteColumns(layer, ['name'])),
+        ('Worker.Vector.renameTableField', lambda layer: worker.Vector.renameTableField(layer, 'name', 'label')),
+        ('Worker.Vector.addAutoIncrementalField', lambda layer: worker.Vector.addAutoIncrementalField(layer, 'seq', 0)),
+        ('Worker.Vector.promoteToMultipart', lambda layer: worker.Vector.promoteToMultipart(layer)),
+        ('Worker.Vector.clip', lambda layer: worker.Vector.clip(layer, overlay)),
+        ('Worker.Vector.difference', lambda layer: worker.Vector.difference(layer, overlay)),
+        ('Worker.Vector.extractByLocation', lambda layer: worker.Vector.extractByLocation(layer, 0, overlay)),
+        ('Worker.Vector.bufferLayer', lambda layer: worker.Vector.bufferLayer(layer, 10, 5, 0, 0, 2, False))
+    ]
+    if geometry in ('line', 'polygon'):
+        steps.append(('Worker.Vector.simplify', lambda layer: worker.Vector.simplify(layer, 0, 5)))
+        steps.append(('Worker.Vector.createCentroids', lambda layer: worker.Vector.createCentroids(layer)))
+    if geometry == 'polygon':
+        steps.append(('Worker.Vector.fixGeometry', lambda layer: worker.Vector.fixGeometry(layer)))
+        steps.append(('Worker.Vector.convexhull', lambda layer: worker.Vector.convexhull(layer)))
+        steps.append(('Worker.Vector.dissolveFeatures', lambda layer: worker.Vector.dissolveFeatures(layer, ['category'], False)))
+    return steps
+
+def engines(geometry: str):
+    ## The workers with a shapely engine, as (name, function of the input layer and the engine)
+    steps = [
+        ('Worker.Vector.bufferLayer', lambda layer, engine: worker.Vector.bufferLayer(layer, 10, 5, 0, 0, 2, False, engine=engine)),
+        ('Worker.Vector.promoteToMultipart', lambda layer, engine: worker.Vector.promoteToMultipart(layer, engine=engine))
+    ]
+    if geometry in ('line', 'polygon'):
+        steps.append(('Worker.Vector.simplify', lambda layer, engine: worker.Vector.simplify(layer, 0, 5, engine=engine)))
+        steps.append(('Worker.Vector.createCentroids', lambda layer, engine: worker.Vector.createCentroids(layer, engine=engine)))
+    if geometry == 'polygon':
+        steps.append(('Worker.Vector.convexhull', lambda layer, engine: worker.Vector.convexhull(layer, engine=engine)))
+    return steps
+
+def compare_engines(expected, actual, sample: int = 100000):
+    ## Compares the geometries of the two engines on the features with an id below sample, matched on the id.
+    ## Returns the number of features with a different NULL geometry, and the largest Hausdorff distance between the others
+    geometries = {}
+    for feature in expected.getFeatures(f'"id" < {sample}'):
+        geometries[feature['id']] = feature.geometry()
+    mismatches = 0
+    distance = 0
+    for feature in actual.getFeatures(f'"id" < {sample}'):
+        other = geometries.pop(feature['id'], None)
+        if other is None or other.isNull() != feature.geometry().isNull():
+            mismatches += 1
+        elif not other.isNull():
+            distance = max(distance, other.hausdorffDistance(feature.geometry()))
+    return mismatches + len(geometries), distance
+
+def timed(name: str, geometry: str, size: int, function):
+    ## Runs a benchmark, materializing lazy results inside the timing
+    start = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        result = resolve(function())
+        features = result.featureCount() if hasattr(result, 'featureCount') else None
+        error = None
+    except SystemExit as exit:
+        ## A failing worker ends the job with script_failed. The benchmark carries on, and exits non-zero once the results are written
+        features = None
+        error = f'SystemExit  –  {str(exit)}'
+        failures.append(f'{name} on {size} {geometry} features')
+    except Exception as exception:
+        features = None
+        error = f'{type(exception).__name__}  –  {str(exception)}'
+    entry = {
+        'benchmark': name,
+        'geometry': geometry,
+        'size': size,
+        'seconds': round(time.perf_counter() - start, 3),
+        'cpu_seconds': round(time.process_time() - cpu, 3),
+        'output_features': features,
+        'error': error
+    }
+    logger.info(f'Benchmark {name} on {size} {geometry} features: {entry["seconds"]} s' + (f' FAILED {error}' if error else ''))
+    results.append(entry)
+    return entry
+
+def count_features(layer):
+    ## Reading every feature, as the readers only open the data source
+    for feature in layer.getFeatures():
+        pass
+    return layer
+
+results = []
+failures = []
+overlay = overlay_layer()
+for geometry in arguments.geometries:
+    for size in arguments.sizes:
+        start = time.perf_counter()
+        layer = synthetic_layer(geometry, size)
+        logger.info(f'Generated {size} {geometry} features in {round(time.perf_counter() - start, 2)} s')
+
+        for name, function in workers(geometry, overlay):
+            timed(name, geometry, size, lambda: function(layer))
+
+        ## The shapely engine, timed and checked against the output of the QGIS engine
+        for name, function in engines(geometry):
+            outputs = {}
+            for engine in ('qgis', 'shapely'):
+                entry = timed(f'{name} (engine={engine})', geometry, size, lambda: outputs.setdefault(engine, resolve(function(layer, engine))))
+            if len(outputs) == 2 and not entry['error']:
+                mismatches, distance = compare_engines(outputs['qgis'], outputs['shapely'])
+                entry['geometry_mismatches'] = mismatches
+                entry['max_hausdorff_distance'] = round(distance, 6)
+                logger.info(f'{name}: {mismatches} features differ in NULL geometries, largest Hausdorff distance to the QGIS output {round(distance, 6)}')
+            outputs = None
+
+        ## Writers, the written files are used for the reader benchmarks
+        geopackage = tempfile_path(f'benchmark_{geometry}_{size}', 'geopackage')
+        flatgeobuf = tempfile_path(f'benchmark_{geometry}_{size}', 'flatgeobuf')
+        timed('Output_Writer.geopackage', geometry, size, lambda: writer.geopackage(layer, 'benchmark', geopackage, True))
+        timed('Output_Writer.file (FlatGeobuf)', geometry, size, lambda: writer.file(layer, flatgeobuf, 'FlatGeobuf'))
+        if arguments.postgis:
+            connection, dbname = arguments.postgis
+            timed('Output_Writer.postgis (copy)', geometry, size, lambda: writer.postgis(layer, connection, dbname, 'public', f'qetl_benchmark_{geometry}', True, method='copy'))
+            if os.path.exists(f'{config["QGIS_bin_folder"]}/ogr2ogr.exe'):
+                timed('Output_Writer.postgis (ogr2ogr)', geometry, size, lambda: writer.postgis(layer, connection, dbname, 'public', f'qetl_benchmark_{geometry}', True))
+
+        timed('Input_Reader.geopackage', geometry, size, lambda: count_features(reader.geopackage(geopackage, 'benchmark')))
+        timed('Input_Reader.shapefile (FlatGeobuf)', geometry, size, lambda: count_features(reader.shapefile(flatgeobuf)))
+        if arguments.postgis:
+            timed('Input_Reader.postGIS', geometry, size, lambda: count_features(reader.postGIS(connection, dbname, 'public', f'qetl_benchmark_{geometry}', 'wkb_geometry')))
+
+        delete_intermediate(geopackage)
+        delete_intermediate(flatgeobuf)
+        layer = None
+
+output = {
+    'qetl_version': str(version),
+    'qgis_version': Qgis.QGIS_VERSION,
+    'python_version': platform.python_version(),
+    'platform': f'{platform.system()} {platform.release()}',
+    'processor': platform.processor(),
+    'cores': get_core_count(),
+    'timestamp': datetime.now().isoformat(timespec='seconds'),
+    'results': results
+}
+result_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+os.makedirs(result_folder, exist_ok=True)
+result_file = os.path.join(result_folder, f'benchmark_qetl-{version}_qgis-{Qgis.QGIS_VERSION.split("-")[0]}.json')
+with open(result_file, 'w') as file:
+    json.dump(output, file, indent=2)
+logger.info(f'Benchmark results written to {result_file}')
+
+if arguments.compare:
+    ## Comparing with an earlier result file, matching the benchmarks on name, geometry and size
+    with open(arguments.compare, 'r') as file:
+        earlier = json.load(file)
+    baseline = {(entry['benchmark'], entry['geometry'], entry['size']): entry for entry in earlier['results'] if not entry['error']}
+    logger.info(f'Compared with Q-ETL {earlier["qetl_version"]} on QGIS {earlier["qgis_version"]}:')
+    for entry in results:
+        before = baseline.get((entry['benchmark'], entry['geometry'], entry['size']))
+        if before is None or entry['error'] or before['seconds'] == 0:
+            continue
+        logger.info(f'    {entry["benchmark"]} {entry["geometry"]} {entry["size"]}: {before["seconds"]} s -> {entry["seconds"]} s ({round(entry["seconds"] / before["seconds"], 2)}x)')
+
+if failures:
+    logger.critical(f'{len(failures)} benchmarks ended the job: {", ".join(failures)}')
+    sys.exit(1)
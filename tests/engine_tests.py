@@ -0,0 +1,180 @@
+from core import *
+from engine import *
+
+## Checks of the alternative engines against the QGIS algorithms they replace, on small fixed layers.
+## Each check runs both engines on the same input and asserts that the outputs are the same.
+##
+## Usage: engine_tests.py
+
+import math
+from qgis.core import QgsFeature, QgsField, QgsFields, QgsGeometry, QgsWkbTypes, QgsCoordinateReferenceSystem, QgsMemoryProviderUtils
+from qgis.PyQt.QtCore import QVariant
+from engine.pipeline import resolve
+
+worker = Worker
+worker.lazy_pipeline = False
+CRS = QgsCoordinateReferenceSystem('EPSG:25832')
+
+
+def fixed_layer(wkbType, wkts: list):
+    ## A layer with one feature for each wkt, and attributes covering NULL, negative and empty values
+    fields = QgsFields()
+    fields.append(QgsField('id', QVariant.Int))
+    fields.append(QgsField('value', QVariant.Double))
+    fields.append(QgsField('count', QVariant.Int))
+    fields.append(QgsField('name', QVariant.String))
+    fields.append(QgsField('flag', QVariant.Bool))
+    layer = QgsMemoryProviderUtils.createMemoryLayer('fixed', fields, wkbType, CRS)
+    rows = [
+        [1, 12.25, 3, 'Odense', True],
+        [2, -4.0, 0, 'aarhus ', False],
+        [3, None, 7, None, None],
+        [4, 0.0, None, '', True],
+        [5, 1e6, -2, 'København', False]
+    ]
+    features = []
+    for index, wkt in enumerate(wkts):
+        feature = QgsFeature(fields)
+        feature.setGeometry(QgsGeometry.fromWkt(wkt))
+        feature.setAttributes([index + 1] + rows[index % len(rows)][1:])
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    layer.updateExtents()
+    return layer
+
+def values(layer, field: str):
+    layer = resolve(layer)
+    return [None if feature[field] is None or (isinstance(feature[field], QVariant) and feature[field].isNull()) else feature[field]
+            for feature in layer.getFeatures()]
+
+def same(expected, actual, tolerance: float = 1e-9):
+    if expected is None or actual is None:
+        return expected is None and actual is None
+    if isinstance(expected, float) or isinstance(actual, float):
+        return math.isclose(float(expected), float(actual), rel_tol=tolerance, abs_tol=tolerance)
+    return expected == actual
+
+def check(name: str, expected: list, actual: list, tolerance: float = 1e-9):
+    assert len(expected) == len(actual), f'{name}: {len(expected)} features with QGIS, {len(actual)} with the other engine'
+    for index, (a, b) in enumerate(zip(expected, actual)):
+        assert same(a, b, tolerance), f'{name}: feature {index} is {a} with QGIS, {b} with the other engine'
+    logger.info(f'{name}: the engines agree on {len(expected)} features')
+
+POLYGONS = [
+    'POLYGON((0 0,10 0,10 10,0 10,0 0))',
+    'POLYGON((100 100,130 100,130 120,100 100))',
+    'POLYGON((200 0,260 0,260 60,230 20,200 60,200 0))',
+    'POLYGON((0 200,50 200,50 250,0 250,0 200),(10 210,20 210,20 220,10 220,10 210))',
+    'POLYGON((500 500,501 500,501 501,500 501,500 500))'
+]
+polygons = fixed_layer(QgsWkbTypes.Polygon, POLYGONS)
+
+
+## ##################################
+## fieldCalculator, engine='numpy'
+## ##################################
+
+FORMULAS = [
+    (0, '"value" * 2 + "count"'),
+    (0, '"value" / "count"'),
+    (0, '"value" % 3'),
+    (1, '"count" - 1'),
+    (0, '-"value"'),
+    (0, 'round("value", 1)'),
+    (0, 'abs("value")'),
+    (2, '"name" || \'_x\''),
+    (2, 'concat("name", \'-\', \'x\')'),
+    (2, 'upper("name")'),
+    (2, 'trim("name")'),
+    (1, 'length("name")'),
+    (2, 'coalesce("name", \'none\')'),
+    (6, '"value" > 0 AND "flag"'),
+    (6, '"value" IS NULL OR "flag"'),
+    (6, 'NOT "flag"'),
+    (2, 'CASE WHEN "value" > 100 THEN \'large\' WHEN "value" > 0 THEN \'small\' ELSE \'none\' END'),
+    (0, 'CASE WHEN "count" > 0 THEN "value" END'),
+    (0, '$area'),
+    (0, '$length'),
+    (2, 'regexp_replace("name", \'a\', \'b\')')
+]
+
+for fieldtype, formula in FORMULAS:
+    expected = worker.Vector.fieldCalculator(polygons, 'calc', fieldtype, 20, 6, formula)
+    actual = worker.Vector.fieldCalculator(polygons, 'calc', fieldtype, 20, 6, formula, engine='numpy')
+    check(f'fieldCalculator {formula}', values(expected, 'calc'), values(actual, 'calc'))
+
+timestamped = worker.Vector.timeStamper(polygons, 'ts', engine='numpy')
+assert all(value is not None for value in values(timestamped, 'ts')), 'timeStamper left features without a timestamp'
+assert resolve(timestamped).fields().field('ts').type() == QVariant.DateTime, 'timeStamper did not create a datetime field'
+
+
+## ##################################
+## refactorFields
+## ##################################
+
+chained = worker.Vector.renameTableField(polygons, 'name', 'label')
+chained = worker.Vector.deleteColumns(chained, ['flag'])
+chained = worker.Vector.addAutoIncrementalField(chained, 'seq', 10)
+chained = worker.Vector.fieldCalculator(chained, 'double', 0, 20, 6, '"value" * 2')
+refactored = worker.Vector.refactorFields(polygons, [
+    {'field': 'flag', 'drop': True},
+    {'field': 'name', 'name': 'label'},
+    {'name': 'seq', 'autoincrement': 10},
+    {'name': 'double', 'expression': '"value" * 2', 'type': 0, 'length': 20, 'precision': 6}
+], keep_unmapped=True)
+assert resolve(chained).fields().names() == resolve(refactored).fields().names(), \
+    f'refactorFields returned the fields {resolve(refactored).fields().names()}, the chain {resolve(chained).fields().names()}'
+for field in resolve(chained).fields().names():
+    check(f'refactorFields {field}', values(chained, field), values(refactored, field))
+
+mapped = worker.Vector.refactorFields(polygons, [
+    {'field': 'count', 'name': 'total', 'type': 2},
+    {'field': 'id'}
+])
+assert resolve(mapped).fields().names() == ['total', 'id'], f'refactorFields returned the fields {resolve(mapped).fields().names()}'
+check('refactorFields cast', [None if value is None else str(value) for value in values(polygons, 'count')], values(mapped, 'total'))
+
+
+## ##################################
+## Geometry workers, engine='shapely'
+## ##################################
+
+def geometries(layer):
+    return [feature.geometry() for feature in resolve(layer).getFeatures()]
+
+def check_geometries(name: str, expected, actual, tolerance: float = 1e-6):
+    expected, actual = resolve(expected), resolve(actual)
+    assert QgsWkbTypes.flatType(expected.wkbType()) == QgsWkbTypes.flatType(actual.wkbType()), \
+        f'{name}: {QgsWkbTypes.displayString(expected.wkbType())} with QGIS, {QgsWkbTypes.displayString(actual.wkbType())} with shapely'
+    a, b = geometries(expected), geometries(actual)
+    assert len(a) == len(b), f'{name}: {len(a)} features with QGIS, {len(b)} with shapely'
+    for index, (first, second) in enumerate(zip(a, b)):
+        assert first.isNull() == second.isNull(), f'{name}: feature {index} is {first.asWkt()} with QGIS, {second.asWkt()} with shapely'
+        if not first.isNull():
+            distance = first.hausdorffDistance(second)
+            assert distance <= tolerance, f'{name}: feature {index} is {distance} from the QGIS geometry'
+    for field in expected.fields().names():
+        check(f'{name} {field}', values(expected, field), values(actual, field), 1e-6)
+    logger.info(f'{name}: the geometries agree on {len(a)} features')
+
+lines = fixed_layer(QgsWkbTypes.LineString, [
+    'LINESTRING(0 0,10 0.2,20 0,30 5,40 0)',
+    'LINESTRING(100 100,100.5 110,101 120)',
+    'LINESTRING(200 200,210 210)',
+    'LINESTRING(0 300,5 301,10 299,15 302,20 300)',
+    'LINESTRING(500 500,520 500,520 520,500 520,500 501)'
+])
+points = fixed_layer(QgsWkbTypes.Point, ['POINT(0 0)', 'POINT(10 10)', 'POINT(-5 20)', 'POINT(100 100)', 'POINT(1e5 6e6)'])
+
+for name, layer in (('points', points), ('lines', lines), ('polygons', polygons)):
+    for endcap, join in ((0, 0), (1, 1), (2, 2)):
+        check_geometries(f'bufferLayer {name} cap {endcap} join {join}',
+                         worker.Vector.bufferLayer(layer, 5, 8, endcap, join, 2, False),
+                         worker.Vector.bufferLayer(layer, 5, 8, endcap, join, 2, False, engine='shapely'))
+    check_geometries(f'promoteToMultipart {name}', worker.Vector.promoteToMultipart(layer), worker.Vector.promoteToMultipart(layer, engine='shapely'))
+    check_geometries(f'createCentroids {name}', worker.Vector.createCentroids(layer), worker.Vector.createCentroids(layer, engine='shapely'))
+
+for name, layer in (('lines', lines), ('polygons', polygons)):
+    check_geometries(f'simplify {name}', worker.Vector.simplify(layer, 0, 2), worker.Vector.simplify(layer, 0, 2, engine='shapely'))
+
+check_geometries('convexhull polygons', worker.Vector.convexhull(polygons), worker.Vector.convexhull(polygons, engine='shapely'))
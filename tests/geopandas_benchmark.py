@@ -0,0 +1,62 @@
+from core import *
+from engine import *
+
+## Benchmark of Integrations.from_geopandas_df, comparing the direct conversion with the FlatGeobuf based conversion.
+## Measures wall time and peak memory (RSS) at each size. Sizes can be given as arguments: geopandas_benchmark.py 100000 1000000
+
+import sys, time, json, threading
+import numpy as np
+import geopandas as gpd
+import psutil
+
+sizes = [int(size) for size in sys.argv[1:]] or [100000, 1000000, 5000000]
+integrations = Integrations
+results = []
+
+
+class PeakSampler(threading.Thread):
+    ## Samples the RSS of the process while a conversion runs
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.process = psutil.Process()
+        self.baseline = self.process.memory_info().rss
+        self.peak = self.baseline
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(0.05)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        return (self.peak - self.baseline) / 1024**2
+
+def dataframe(rows):
+    rng = np.random.default_rng(42)
+    x = rng.uniform(440000, 890000, rows)
+    y = rng.uniform(6050000, 6400000, rows)
+    return gpd.GeoDataFrame({
+        'id': np.arange(rows),
+        'value': rng.normal(100, 25, rows),
+        'name': np.array(['feature_' + str(i % 1000) for i in range(rows)], dtype=object),
+        'flag': rng.integers(0, 2, rows).astype(bool)
+    }, geometry=gpd.points_from_xy(x, y), crs='EPSG:25832')
+
+for rows in sizes:
+    df = dataframe(rows)
+    for method in ('file', 'direct'):
+        sampler = PeakSampler()
+        sampler.start()
+        start = time.perf_counter()
+        layer = integrations.from_geopandas_df(df, method=method)
+        seconds = time.perf_counter() - start
+        peak = sampler.stop()
+        result = {'rows': rows, 'method': method, 'seconds': round(seconds, 2), 'peak_mb': round(peak, 1), 'features': layer.featureCount()}
+        logger.info(f'from_geopandas_df benchmark: {result}')
+        results.append(result)
+        layer = None
+    df = None
+
+logger.info(json.dumps(results, indent=2))